@@ -64,6 +64,48 @@ class Config:
     BIKE_TRACKER_PASS = config("BIKE_TRACKER_PASS")
     RESPONSES_PATH = "fh_webhook/responses/"
 
+    # The requests are archived in an append-only journal ("journal") rather than one file per
+    # request ("files"). Segments are rotated when they reach either the size or the age.
+    ARCHIVE_FORMAT = config("ARCHIVE_FORMAT", default="journal")
+    # Under the responses dir, as that's the volume kept by docker-compose.
+    JOURNAL_PATH = "fh_webhook/responses/journal/"
+    JOURNAL_SEGMENT_BYTES = config(
+        "JOURNAL_SEGMENT_BYTES", default=64 * 1024 * 1024, cast=int
+    )
+    JOURNAL_SEGMENT_SECONDS = config(
+        "JOURNAL_SEGMENT_SECONDS", default=24 * 3600, cast=int
+    )
+    JOURNAL_COMPRESS = config("JOURNAL_COMPRESS", default=True, cast=bool)
+
+    # How the bookings are validated: "compiled" checks them against BookingSchema compiled once
+    # at startup, "marshmallow" loads them through BookingSchema on every request.
+    SCHEMA_VALIDATOR = config("SCHEMA_VALIDATOR", default="compiled")
+
+    # How the responses are written in the db: "bulk" saves the whole response in one transaction
+    # whereas "per_entity" uses the model services, one commit per entity.
+    PERSISTENCE_ENGINE = config("PERSISTENCE_ENGINE", default="bulk")
+
+    # In async mode the webhook only stores the requests and answers FH right away, then the
+    # `flask process-requests` worker processes them.
+    ASYNC_INGESTION = config("ASYNC_INGESTION", default=False, cast=bool)
+
+    # Skip the writes for the requests that repeat the last processed state of a booking.
+    DEDUPLICATE_REDELIVERIES = config(
+        "DEDUPLICATE_REDELIVERIES", default=True, cast=bool
+    )
+
+    # The reference data (items, companies, customer types...) is kept in memory for this number
+    # of seconds, up to this number of rows per worker. A TTL of 0 disables the cache.
+    REFERENCE_CACHE_TTL = config("REFERENCE_CACHE_TTL", default=300, cast=int)
+    REFERENCE_CACHE_SIZE = config("REFERENCE_CACHE_SIZE", default=10_000, cast=int)
+
+    # The periods the bikes are in use around now are kept in memory to check the conflicts of
+    # the bike tracker, and reloaded from the db after this number of seconds to pick up the
+    # changes of the other workers. Only the periods overlapping this number of hours before
+    # and after now are loaded. A TTL of 0 checks them in the db every time.
+    BIKE_OCCUPANCY_TTL = config("BIKE_OCCUPANCY_TTL", default=60, cast=int)
+    BIKE_OCCUPANCY_WINDOW = config("BIKE_OCCUPANCY_WINDOW", default=12, cast=int)
+
     # The location of the bikes' information.
     BIKE_TRACKER_BIKE_SOURCE = "fh_webhook/static/bike_info.json"
     BIKE_TRACKER_SECRET = config("BIKE_TRACKER_SECRET")
@@ -105,6 +147,16 @@ class Config:
         690082: "24.0",  # Long rent
     }
 
+    # How long the bikes of a rental are in use per customer type id. The several days rentals
+    # show 24h in DURATION_MAP but keep the bikes for the whole rental.
+    RENTAL_USAGE_MAP = {
+        **DURATION_MAP,
+        315001: "48.0",  # 2 days
+        315002: "168.0",  # 7 days
+        315003: "24.0",  # Extra day
+        601300: "240.0",  # 10 days
+    }
+
 
 class ProductionConfig(Config):
     """Override base class for production."""
@@ -126,4 +178,5 @@ class TestingConfig(Config):
     TEST_PASSWORD = "test"
     SQLALCHEMY_DATABASE_URI = "postgresql:///webhook-test"
     RESPONSES_PATH = "tests/responses/"
+    JOURNAL_PATH = "tests/journal/"
     BIKE_TRACKER_BIKE_SOURCE = "tests/sample_data/sample_bike/bike_info.json"
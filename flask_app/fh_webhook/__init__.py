@@ -1,10 +1,14 @@
 import os
+from datetime import timedelta
 
 from decouple import config
 from flask import Flask
 from flask_migrate import Migrate
 
+from . import commands
+from .cache import reference_cache
 from .models import db
+from .occupancy import bike_occupancy
 from .views import bike_tracker_views, webhook_views
 
 
@@ -18,6 +22,13 @@ def create_app(test_config=False):
 
     app.logger.info("Starting flask app.")
     db.init_app(app)
+    reference_cache.configure(
+        app.config["REFERENCE_CACHE_TTL"], app.config["REFERENCE_CACHE_SIZE"]
+    )
+    bike_occupancy.configure(
+        app.config["BIKE_OCCUPANCY_TTL"],
+        timedelta(hours=app.config["BIKE_OCCUPANCY_WINDOW"]),
+    )
     Migrate(app, db)
 
     # ensure the instance folder exists
@@ -28,4 +39,15 @@ def create_app(test_config=False):
 
     app.register_blueprint(webhook_views.bp)
     app.register_blueprint(bike_tracker_views.bp)
+    app.cli.add_command(commands.process_requests)
+    app.cli.add_command(commands.reprocess_requests)
+    app.cli.add_command(commands.show_queue_depth)
+    app.cli.add_command(commands.populate_db)
+    app.cli.add_command(commands.backfill)
+    app.cli.add_command(commands.populate_created_by)
+    app.cli.add_command(commands.populate_effective_period)
+    app.cli.add_command(commands.validate_archive)
+    app.cli.add_command(commands.index_archive)
+    app.cli.add_command(commands.booking_history)
+    app.cli.add_command(commands.import_legacy)
     return app
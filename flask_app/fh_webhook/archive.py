@@ -0,0 +1,398 @@
+"""
+Store and read back the raw requests sent by FH.
+
+Originally each request was saved in its own `<unix_timestamp>.json` file,
+which after some seasons means hundreds of thousands of tiny files in one
+directory. The journal appends the requests to segment files instead, each
+record being a small header followed by the (optionally compressed) payload:
+
+    length (uint32) | crc32 (uint32) | timestamp (float64) | flags (uint8) | payload
+
+Segments are rotated by size or by age and each one has an index alongside
+with an entry per record:
+
+    timestamp (float64) | booking pk (int64, -1 if unknown) | offset (uint64) | length (uint32)
+
+The readers yield ArchiveRecord objects for both the journal and the loose
+JSON files, so the services replaying the archive don't care about its format.
+"""
+import fcntl
+import heapq
+import logging
+import os
+import struct
+import zlib
+from contextlib import contextmanager
+
+import attr
+
+from .fast_json import extract, loads
+
+logger = logging.getLogger(__name__)
+
+RECORD_HEADER = struct.Struct(">IIdB")
+INDEX_ENTRY = struct.Struct(">dqQI")
+COMPRESSED = 0x01
+SEGMENT_SUFFIX = ".jnl"
+INDEX_SUFFIX = ".idx"
+LOCK_FILE = ".lock"
+# What the replay needs to know about a request to order and index it.
+BOOKING_KEYS = ("booking.pk", "booking.uuid", "booking.availability.pk")
+
+
+def segment_name(unix_timestamp):
+    """Name the segments after their first record so they sort in time order."""
+    return f"{unix_timestamp:017.6f}{SEGMENT_SUFFIX}"
+
+
+def segment_timestamp(name):
+    return float(name[: -len(SEGMENT_SUFFIX)])
+
+
+def list_segments(path):
+    """Return the segment names in a journal dir sorted from oldest to newest."""
+    try:
+        names = os.listdir(path)
+    except FileNotFoundError:
+        return []
+    return sorted(
+        (name for name in names if name.endswith(SEGMENT_SUFFIX)), key=segment_timestamp
+    )
+
+
+@attr.s
+class ArchiveRecord:
+    """
+    A request found in the archive.
+
+    `name` identifies the record in the archive: the filename for loose files
+    and `<segment>@<offset>` for journal records.
+    """
+
+    timestamp = attr.ib(type=float)
+    name = attr.ib(type=str)
+    body = attr.ib(type=bytes)
+
+    def load(self):
+        return loads(self.body)
+
+    def extract(self, *paths):
+        """Parse only the values on the dotted paths, see `fast_json.extract`."""
+        return extract(self.body, paths)
+
+
+@attr.s
+class JournalWriter:
+    """
+    Append requests to the journal.
+
+    Several uwsgi workers write to the same journal, so each append takes an
+    exclusive lock on the journal dir. Under the lock the writer also checks
+    that the current segment ends where its index says, so a record torn by a
+    crash is dropped before appending the next one. Each record is synced to
+    disk before the append returns, so FH is only answered once its request is
+    safe.
+    """
+
+    path = attr.ib(type=str)
+    max_bytes = attr.ib(type=int, default=64 * 1024 * 1024)
+    max_age = attr.ib(type=float, default=24 * 3600)
+    compress = attr.ib(type=bool, default=True)
+
+    @contextmanager
+    def _lock(self):
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, LOCK_FILE), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _sync_dir(self):
+        """Sync the journal dir so the segments created are not lost on a crash."""
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _repair(self, segment):
+        """Truncate the segment and its index to the last complete record."""
+        segment_path = os.path.join(self.path, segment)
+        index_path = segment_path[: -len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+        end = 0
+        if os.path.exists(index_path):
+            index_size = os.path.getsize(index_path)
+            entries = index_size // INDEX_ENTRY.size
+            if index_size != entries * INDEX_ENTRY.size:
+                os.truncate(index_path, entries * INDEX_ENTRY.size)
+            if entries:
+                with open(index_path, "rb") as index:
+                    index.seek((entries - 1) * INDEX_ENTRY.size)
+                    _, _, offset, length = INDEX_ENTRY.unpack(
+                        index.read(INDEX_ENTRY.size)
+                    )
+                end = offset + length
+        size = os.path.getsize(segment_path)
+        if size != end:
+            logger.error(f"Truncating torn record at {segment}@{end}")
+            os.truncate(segment_path, end)
+        return end
+
+    def _current_segment(self, unix_timestamp):
+        segments = list_segments(self.path)
+        if segments:
+            segment = segments[-1]
+            size = self._repair(segment)
+            age = unix_timestamp - segment_timestamp(segment)
+            if size < self.max_bytes and age < self.max_age:
+                return segment
+        return segment_name(unix_timestamp)
+
+    def encode(self, body, unix_timestamp):
+        flags = 0
+        if self.compress:
+            body = zlib.compress(body)
+            flags |= COMPRESSED
+        header = RECORD_HEADER.pack(len(body), zlib.crc32(body), unix_timestamp, flags)
+        return header + body
+
+    def append(self, body, unix_timestamp, booking_pk=None):
+        """Append the raw body of a request and return its name in the archive."""
+        record = self.encode(body, unix_timestamp)
+        with self._lock():
+            segment = self._current_segment(unix_timestamp)
+            segment_path = os.path.join(self.path, segment)
+            created = not os.path.exists(segment_path)
+            with open(segment_path, "ab") as fp:
+                offset = fp.tell()
+                fp.write(record)
+                fp.flush()
+                os.fsync(fp.fileno())
+            index_path = segment_path[: -len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+            with open(index_path, "ab") as index:
+                index.write(
+                    INDEX_ENTRY.pack(
+                        unix_timestamp,
+                        -1 if booking_pk is None else booking_pk,
+                        offset,
+                        len(record),
+                    )
+                )
+                index.flush()
+                os.fsync(index.fileno())
+            if created:
+                self._sync_dir()
+        return f"{segment}@{offset}"
+
+
+def _decode(header, body, name):
+    length, crc, unix_timestamp, flags = RECORD_HEADER.unpack(header)
+    if len(body) != length or zlib.crc32(body) != crc:
+        raise ValueError(f"Corrupted journal record {name}")
+    if flags & COMPRESSED:
+        body = zlib.decompress(body)
+    return ArchiveRecord(timestamp=unix_timestamp, name=name, body=body)
+
+
+@attr.s
+class JournalReader:
+    """
+    Stream the records of a journal from the oldest to the newest.
+
+    With `since` only the records after that timestamp are read, skipping
+    the segments whose index tells they are older.
+
+    The records are stamped when the requests arrive but appended when their
+    writer gets the lock, so a segment may hold them slightly out of order,
+    and the first records of a segment may be older than the last ones of the
+    previous segment. The reader yields them in timestamp order anyway: the
+    segments whose index is out of order are read in the order of the index,
+    and the segments whose periods overlap are merged. Still, a record can be
+    appended up to a request's duration after newer ones were read, which the
+    readers that resume from a timestamp have to allow for (see
+    ProcessStoredRequests.CATCH_UP_MARGIN).
+
+    The reader takes no lock, so the last record of the active (newest)
+    segment may still be being written. A record cut short there is taken as
+    not written yet rather than as torn.
+    """
+
+    path = attr.ib(type=str)
+    since = attr.ib(type=float, default=None)
+
+    def read_segment(self, segment, active=False):
+        with open(os.path.join(self.path, segment), "rb") as fp:
+            while True:
+                offset = fp.tell()
+                header = fp.read(RECORD_HEADER.size)
+                if not header:
+                    return
+                name = f"{segment}@{offset}"
+                complete = len(header) == RECORD_HEADER.size
+                if complete:
+                    length = RECORD_HEADER.unpack(header)[0]
+                    body = fp.read(length)
+                    complete = len(body) == length
+                if not complete:
+                    if not active:
+                        logger.error(f"Skipping torn record {name}")
+                    return
+                try:
+                    yield _decode(header, body, name)
+                except ValueError as e:
+                    logger.error(f"{e}, skipping the rest of the segment")
+                    return
+
+    def _read_sorted(self, segment, entries):
+        """Read the records of a segment in the order of the index entries given."""
+        with open(os.path.join(self.path, segment), "rb") as fp:
+            for _, _, offset, length in entries:
+                fp.seek(offset)
+                record = fp.read(length)
+                name = f"{segment}@{offset}"
+                size = RECORD_HEADER.size
+                try:
+                    yield _decode(record[:size], record[size:], name)
+                except (ValueError, struct.error) as e:
+                    logger.error(f"{e}, skipping {name}")
+
+    def read_at(self, name):
+        """Read a single record out of its name in the archive."""
+        segment, offset = name.split("@")
+        with open(os.path.join(self.path, segment), "rb") as fp:
+            fp.seek(int(offset))
+            header = fp.read(RECORD_HEADER.size)
+            body = fp.read(RECORD_HEADER.unpack(header)[0])
+        return _decode(header, body, name)
+
+    def read_index(self, segment):
+        """Yield the index entries (timestamp, booking pk, offset, length) of a segment."""
+        index_path = os.path.join(
+            self.path, segment[: -len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+        )
+        with open(index_path, "rb") as index:
+            for entry in iter(lambda: index.read(INDEX_ENTRY.size), b""):
+                if len(entry) == INDEX_ENTRY.size:
+                    yield INDEX_ENTRY.unpack(entry)
+
+    def _read_entries(self, segment):
+        try:
+            return list(self.read_index(segment))
+        except FileNotFoundError:
+            return []
+
+    def _is_older(self, segment):
+        timestamps = [entry[0] for entry in self._read_entries(segment)]
+        return bool(timestamps) and max(timestamps) <= self.since
+
+    def _read_in_order(self, segment, entries, active):
+        """Yield the records of a segment sorted by timestamp."""
+        timestamps = [entry[0] for entry in entries]
+        if timestamps == sorted(timestamps):
+            # The usual case, the records not indexed yet are still read.
+            records = self.read_segment(segment, active)
+        else:
+            entries = sorted(entries, key=lambda entry: (entry[0], entry[2]))
+            records = self._read_sorted(segment, entries)
+        for record in records:
+            if self.since is None or record.timestamp > self.since:
+                yield record
+
+    def __iter__(self):
+        segments = list_segments(self.path)
+        # Runs of segments whose periods overlap, merged when there's more than one.
+        run, run_end = list(), None
+        for n, segment in enumerate(segments, 1):
+            entries = self._read_entries(segment)
+            timestamps = [entry[0] for entry in entries]
+            if timestamps and self.since is not None and max(timestamps) <= self.since:
+                continue
+            start = min(timestamps, default=segment_timestamp(segment))
+            if run and start >= run_end:
+                yield from self._merge(run)
+                run, run_end = list(), None
+            run.append(self._read_in_order(segment, entries, n == len(segments)))
+            end = max(timestamps, default=float("inf"))
+            run_end = end if run_end is None else max(run_end, end)
+        yield from self._merge(run)
+
+    @staticmethod
+    def _merge(run):
+        if len(run) == 1:
+            return run[0]
+        return heapq.merge(*run, key=lambda record: record.timestamp)
+
+
+def get_file_timestamp(filename):
+    """Get the timestamp out of the name of a loose file or None if it's not a response."""
+    if filename.endswith(".json"):
+        try:
+            return float(filename[: -len(".json")])
+        except ValueError:
+            return None
+
+
+@attr.s
+class LooseFilesReader:
+    """
+    Read the `<unix_timestamp>.json` files saved before the journal existed.
+
+    With `since` only the files after that timestamp are opened.
+    """
+
+    path = attr.ib(type=str)
+    since = attr.ib(type=float, default=None)
+
+    def __iter__(self):
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            return
+        files = [(get_file_timestamp(f), f) for f in names]
+        files = [
+            f
+            for f in files
+            if f[0] is not None and (self.since is None or f[0] > self.since)
+        ]
+        for unix_timestamp, filename in sorted(files):
+            with open(os.path.join(self.path, filename), "rb") as fp:
+                body = fp.read()
+            yield ArchiveRecord(timestamp=unix_timestamp, name=filename, body=body)
+
+
+def read_record(responses_path, journal_path, name):
+    """Read a single request, from the journal or a loose file, out of its name."""
+    if "@" in name:
+        return JournalReader(journal_path).read_at(name)
+    with open(os.path.join(responses_path, name), "rb") as fp:
+        body = fp.read()
+    return ArchiveRecord(timestamp=get_file_timestamp(name), name=name, body=body)
+
+
+def read_archive(responses_path, journal_path, since=None):
+    """
+    Stream all the archived requests, loose files and journal, in time order.
+
+    With `since` only the requests archived after that timestamp are read.
+    """
+    return heapq.merge(
+        LooseFilesReader(responses_path, since),
+        JournalReader(journal_path, since),
+        key=lambda record: record.timestamp,
+    )
+
+
+def get_archive(app):
+    """Return a reader over the whole archive configured for the app."""
+    return read_archive(app.config["RESPONSES_PATH"], app.config["JOURNAL_PATH"])
+
+
+def get_journal_writer(app):
+    return JournalWriter(
+        app.config["JOURNAL_PATH"],
+        max_bytes=app.config["JOURNAL_SEGMENT_BYTES"],
+        max_age=app.config["JOURNAL_SEGMENT_SECONDS"],
+        compress=app.config["JOURNAL_COMPRESS"],
+    )
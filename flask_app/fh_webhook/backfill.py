@@ -0,0 +1,310 @@
+"""
+Backfill columns of the db out of the archived requests.
+
+Each time FH adds a field we used to write a script that read the whole
+archive, kept the values in dicts and updated the rows one by one through
+the ORM. Now a backfill is an extractor: a function registered for some
+columns of a model that takes the booking of a request and yields tuples
+with the pk of the row and the values for those columns, e.g.:
+
+    @extractor("headline", models.Availability, "headline")
+    def headline(booking):
+        av_data = booking["availability"]
+        if av_data.get("headline"):
+            yield av_data["pk"], av_data["headline"]
+
+The paths of the request the function reads can be declared with `paths`,
+e.g. `paths=("booking.availability.pk", "booking.availability.headline")`.
+When every extractor requested declares them, only those values are parsed
+out of the requests (see `fast_json.extract`), which is much lighter on big
+group bookings. Otherwise the whole requests are parsed.
+
+`flask backfill headline` then reads the archive once for all the extractors
+requested, keeps the values of the newest request for each row, and applies
+them with one `UPDATE ... FROM` per extractor joining a temp table, so only
+the rows whose values differ are touched. updated_at is left alone, as the
+rows did not change in FH.
+
+The values FH does not send at all, like who created the bookings, come in
+CSVs downloaded from FH and are applied the same way, see PopulateCreatedBy.
+The values worked out of other tables, like the effective period of the
+bookings, are computed in SQL, see PopulateEffectivePeriod.
+"""
+import logging
+import time
+from collections import OrderedDict
+
+import attr
+from sqlalchemy import Column, MetaData, Table, text, tuple_
+
+from . import archive, models
+from .legacy_import import stage_csv
+from .model_services import update_effective_periods
+from .models import db
+
+logger = logging.getLogger(__name__)
+
+
+@attr.s(frozen=True)
+class Extractor:
+    name = attr.ib(type=str)
+    model = attr.ib()
+    columns = attr.ib(type=tuple)
+    function = attr.ib()
+    paths = attr.ib(type=tuple, default=())
+
+
+EXTRACTORS = OrderedDict()
+
+
+def extractor(name, model, *columns, paths=()):
+    """Register a function that yields `(pk, *values)` for the columns of the model."""
+
+    def register(function):
+        EXTRACTORS[name] = Extractor(name, model, columns, function, paths)
+        return function
+
+    return register
+
+
+@attr.s
+class Backfill:
+    """
+    Run the extractors over the archive and update the rows they found.
+
+    In dry run mode the updates are rolled back, so the counts tell how many
+    rows would change. Returns, per extractor, the number of rows found in
+    the archive and the number of rows updated.
+    """
+
+    app = attr.ib()
+    names = attr.ib(type=list)
+    dry_run = attr.ib(type=bool, default=False)
+    batch_size = attr.ib(type=int, default=5000)
+
+    # Records read between the progress reports.
+    PROGRESS_EVERY = 1000
+
+    def _log_progress(self, n):
+        elapsed = time.monotonic() - self.started
+        rate = n / elapsed if elapsed else 0
+        logger.info(f"Read {n} requests ({self.errors} errors), {rate:.1f} files/sec")
+
+    def _collect(self):
+        extractors = [EXTRACTORS[name] for name in self.names]
+        self.found = OrderedDict((e.name, dict()) for e in extractors)
+        self.errors, n = 0, 0
+        paths = [path for e in extractors for path in e.paths]
+        if not all(e.paths for e in extractors):
+            paths = None
+        for n, record in enumerate(archive.get_archive(self.app), 1):
+            data = record.extract(*paths) if paths else record.load()
+            booking = data.get("booking")
+            if booking:
+                for e in extractors:
+                    try:
+                        for pk, *values in e.function(booking):
+                            self.found[e.name][pk] = values
+                    except (KeyError, TypeError) as error:
+                        self.errors += 1
+                        logger.info(f"{e.name} failed on {record.name}, error={error}")
+            if n % self.PROGRESS_EVERY == 0:
+                self._log_progress(n)
+        self._log_progress(n)
+
+    def _update(self, n, e, rows):
+        """Load the rows in a temp table and update the model joining it."""
+        table = e.model.__table__
+        temp = Table(
+            f"backfill_{n}",
+            MetaData(),
+            Column("id", table.c.id.type, primary_key=True),
+            *(Column(name, table.c[name].type) for name in e.columns),
+            prefixes=["TEMPORARY"],
+            postgresql_on_commit="DROP",
+        )
+        connection = db.session.connection()
+        temp.create(connection)
+        keys = ("id",) + e.columns
+        rows = list(rows.items())
+        for start in range(0, len(rows), self.batch_size):
+            end = start + self.batch_size
+            batch = rows[start:end]
+            values = [dict(zip(keys, [pk, *values])) for pk, values in batch]
+            connection.execute(temp.insert().values(values))
+
+        current = tuple_(*(table.c[name] for name in e.columns))
+        backfilled = tuple_(*(temp.c[name] for name in e.columns))
+        stmt = (
+            table.update()
+            .values({name: temp.c[name] for name in e.columns})
+            .where(table.c.id == temp.c.id)
+            .where(current.is_distinct_from(backfilled))
+        )
+        return connection.execute(stmt).rowcount
+
+    def run(self):
+        self.started = time.monotonic()
+        self._collect()
+        counts = OrderedDict()
+        try:
+            for n, (name, rows) in enumerate(self.found.items()):
+                updated = self._update(n, EXTRACTORS[name], rows) if rows else 0
+                counts[name] = {"found": len(rows), "updated": updated}
+                logger.info(f"{name}: {len(rows)} rows found, {updated} updated")
+            if self.dry_run:
+                db.session.rollback()
+            else:
+                db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return counts
+
+
+CREATED_BY_COLUMNS = ("Booking ID", "Created By")
+
+CREATED_BY_UPDATE = """
+WITH creators AS (
+    SELECT DISTINCT ON ("Booking ID") "Booking ID" AS display_id,
+        "Created By" AS created_by
+    FROM created_by
+    WHERE "Booking ID" IS NOT NULL AND "Created By" IS NOT NULL
+    ORDER BY "Booking ID", line
+), updated AS (
+    UPDATE booking SET created_by = creators.created_by
+    FROM creators
+    WHERE booking.display_id = creators.display_id AND booking.created_by = 'staff'
+    RETURNING booking.created_by
+)
+SELECT created_by, count(*) FROM updated GROUP BY created_by ORDER BY created_by
+"""
+
+
+@attr.s
+class PopulateCreatedBy:
+    """
+    Fill created_by out of the CSV downloaded from FH for the staff bookings.
+
+    FH does not send who created the bookings, so once in a while we download
+    a CSV with the booking display ids and their creators:
+
+        "Bookings",""
+        "Booking ID","Created By"
+        "#xxxxxxxx","John Doe"
+
+    The CSV is copied to a temp table and all the creators are applied with a
+    single `UPDATE ... FROM`. Only the bookings whose created_by is staff are
+    updated as the others carry the value of the company. When a booking is
+    found more than once in the CSV, its first creator wins. Returns the
+    number of bookings updated per creator.
+    """
+
+    path = attr.ib(type=str)
+    dry_run = attr.ib(type=bool, default=False)
+
+    def _stage(self):
+        with open(self.path, newline="") as f:
+            # FH downloads usually have some extra lines on top of the header.
+            position = f.tell()
+            line = f.readline()
+            while line and not all(c in line for c in CREATED_BY_COLUMNS):
+                position = f.tell()
+                line = f.readline()
+            f.seek(position if line else 0)
+            return stage_csv("created_by", f, CREATED_BY_COLUMNS)
+
+    def run(self):
+        try:
+            read = self._stage()
+            rows = db.session.execute(text(CREATED_BY_UPDATE))
+            counts = OrderedDict((creator, n) for creator, n in rows)
+            logger.info(f"Read {read} rows, {sum(counts.values())} bookings updated")
+            if self.dry_run:
+                db.session.rollback()
+            else:
+                db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return counts
+
+
+@attr.s
+class PopulateEffectivePeriod:
+    """
+    Fill the effective period of the bookings saved before it was computed on ingest.
+
+    It's the same period that get_effective_period computes out of the responses, but
+    worked out in SQL out of the availabilities and customers in the db, so all the
+    bookings are updated with a single `UPDATE ... FROM`. Only the rows whose period
+    differs are touched, so it can be run again after changing RENTAL_USAGE_MAP.
+    Returns the number of bookings updated.
+    """
+
+    app = attr.ib()
+    dry_run = attr.ib(type=bool, default=False)
+
+    def run(self):
+        try:
+            updated = update_effective_periods(self.app.config)
+            logger.info(f"{updated} bookings updated")
+            if self.dry_run:
+                db.session.rollback()
+            else:
+                db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return updated
+
+
+# The fields found on Aug 10th.
+
+
+@extractor(
+    "headline",
+    models.Availability,
+    "headline",
+    paths=("booking.availability.pk", "booking.availability.headline"),
+)
+def headline(booking):
+    av_data = booking["availability"]
+    if av_data.get("headline"):
+        yield av_data["pk"], av_data["headline"]
+
+
+@extractor(
+    "contact_language",
+    models.Contact,
+    "language",
+    paths=("booking.pk", "booking.contact.language"),
+)
+def contact_language(booking):
+    if booking["contact"].get("language"):
+        yield booking["pk"], booking["contact"]["language"]
+
+
+@extractor(
+    "sms_updates",
+    models.Booking,
+    "is_subscribed_for_sms_updates",
+    paths=("booking.pk", "booking.is_subscribed_for_sms_updates"),
+)
+def sms_updates(booking):
+    if booking.get("is_subscribed_for_sms_updates"):
+        yield booking["pk"], booking["is_subscribed_for_sms_updates"]
+
+
+# The customer type rates saved wrong because of the bug found on 2021-09-30.
+
+
+@extractor(
+    "customer_type_rate",
+    models.Customer,
+    "customer_type_rate_id",
+    paths=("booking.customers.*.pk", "booking.customers.*.customer_type_rate.pk"),
+)
+def customer_type_rate(booking):
+    for c_data in booking["customers"]:
+        yield c_data["pk"], c_data["customer_type_rate"]["pk"]
@@ -1,11 +1,20 @@
 import logging
-from datetime import date
+from datetime import date, datetime, time, timedelta
 from decimal import Decimal
 
 import attr
 import pytz
 from flask import current_app
-from sqlalchemy import func
+from sqlalchemy import (
+    Numeric,
+    case,
+    cast,
+    exists,
+    func,
+    literal,
+    literal_column,
+    union_all,
+)
 
 from fh_webhook.models import (
     Availability,
@@ -20,6 +29,25 @@ from fh_webhook.models import (
     bike_usages,
 )
 
+# The bookings and the bike tracker app live in Bilbao.
+BUSINESS_TIMEZONE = pytz.timezone("Europe/Madrid")
+# Hours a rental lasts when its customer type is not in DURATION_MAP.
+DEFAULT_RENTAL_DURATION = Decimal("2.0")
+
+
+def get_day_window(for_date):
+    """
+    Return when the day starts and when the next one does in Europe/Madrid.
+
+    Filter with `start <= column < end` rather than on the date of the column,
+    so the indexes on the column can be used whatever the session timezone.
+    The days are not always 24h long, because of DST.
+    """
+    start = BUSINESS_TIMEZONE.localize(datetime.combine(for_date, time.min))
+    next_day = for_date + timedelta(days=1)
+    end = BUSINESS_TIMEZONE.localize(datetime.combine(next_day, time.min))
+    return start, end
+
 
 @attr.s
 class DailyActivities:
@@ -34,29 +62,72 @@ class DailyActivities:
 
     def __attrs_post_init__(self):
         self.bike_tracker_items = current_app.config["BIKE_TRACKER_ITEMS"]
+        self.day_start, self.day_end = get_day_window(self.for_date)
+
+    def _tracked_availabilities(self):
+        """The availabilities of the day that have some bike assigned already."""
+        return (
+            db.session.query(bike_usages.c.availability_id)
+            .join(Availability, Availability.id == bike_usages.c.availability_id)
+            .filter(Availability.start_at >= self.day_start)
+            .filter(Availability.start_at < self.day_end)
+            .filter(bike_usages.c.bike_id.isnot(None))
+            .distinct()
+            .cte("tracked")
+        )
 
-    def _get_tour_activities(self, tracked_availability_ids):
+    def _rental_duration(self):
+        """
+        Resolve the duration of a rental out of the customer type.
+
+        The duration is represented by the customer type so, we need a mapping
+        to ct ids. Customer types not in the mapping get NULL.
+        """
+        duration_map = current_app.config["DURATION_MAP"]
+        if not duration_map:
+            return literal(None, Numeric)
+        return case(
+            [
+                (CustomerType.id == ct_id, cast(Decimal(duration), Numeric))
+                for ct_id, duration in duration_map.items()
+            ]
+        )
+
+    def _get_tour_activities(self, tracked):
         tour_ids = (
             self.bike_tracker_items["regular_tours"]
             + self.bike_tracker_items["private_tours"]
         )
+        # For tours, we get the duration right from the start and end date of
+        # the availability.
+        hours = (
+            cast(
+                func.extract("epoch", Availability.end_at - Availability.start_at),
+                Numeric,
+            )
+            / 3600
+        )
 
         return (
             db.session.query(
-                Availability.id,
-                Availability.headline,
-                Availability.start_at,
-                Availability.end_at - Availability.start_at,
-                Item.name,
-                func.sum(Booking.customer_count) + 1,
+                Availability.id.label("availability_id"),
+                func.coalesce(func.nullif(Availability.headline, ""), Item.name).label(
+                    "headline"
+                ),
+                Availability.start_at.label("start_at"),
+                (func.sum(Booking.customer_count) + 1).label("no_of_bikes"),
+                func.round(hours, 1).label("duration"),
+                literal(True).label("known_duration"),
+                literal(0).label("kind"),
             )
             .filter(Booking.availability_id == Availability.id)
             .filter(Item.id == Availability.item_id)
-            .filter(func.DATE(Availability.start_at) == self.for_date)
+            .filter(Availability.start_at >= self.day_start)
+            .filter(Availability.start_at < self.day_end)
             .filter(Item.id.in_(tour_ids))
             .filter(Booking.status != "cancelled")
             .filter(Booking.rebooked_to.is_(None))
-            .filter(Availability.id.notin_(tracked_availability_ids))
+            .filter(~exists().where(tracked.c.availability_id == Availability.id))
             .group_by(
                 Availability.id,
                 Availability.headline,
@@ -64,22 +135,24 @@ class DailyActivities:
                 Availability.end_at,
                 Item.name,
             )
-            .order_by(Availability.start_at.asc())
-            .all()
         )
 
-    def _get_rental_activities(self, tracked_availability_ids):
+    def _get_rental_activities(self, tracked):
         rental_ids = self.bike_tracker_items["rentals"]
+        duration = self._rental_duration()
 
         return (
             db.session.query(
-                Booking.id,
-                func.concat(Contact.name, "-", Item.name),
-                Availability.start_at,
-                Availability.end_at - Availability.start_at,
-                Item.name,
-                func.count(Booking.id),
-                CustomerType.id,
+                Booking.id.label("availability_id"),
+                func.coalesce(
+                    func.nullif(func.concat(Contact.name, "-", Item.name), ""),
+                    Item.name,
+                ).label("headline"),
+                Availability.start_at.label("start_at"),
+                func.count(Booking.id).label("no_of_bikes"),
+                func.coalesce(duration, DEFAULT_RENTAL_DURATION).label("duration"),
+                duration.isnot(None).label("known_duration"),
+                literal(1).label("kind"),
             )
             # Join
             .filter(Booking.availability_id == Availability.id)
@@ -89,11 +162,12 @@ class DailyActivities:
             .filter(CustomerTypeRate.id == Customer.customer_type_rate_id)
             .filter(CustomerType.id == CustomerTypeRate.customer_type_id)
             # Where
-            .filter(func.DATE(Availability.start_at) == self.for_date)
+            .filter(Availability.start_at >= self.day_start)
+            .filter(Availability.start_at < self.day_end)
             .filter(Item.id.in_(rental_ids))
             .filter(Booking.status != "cancelled")
             .filter(Booking.rebooked_to.is_(None))
-            .filter(Availability.id.notin_(tracked_availability_ids))
+            .filter(~exists().where(tracked.c.availability_id == Availability.id))
             .group_by(
                 Booking.id,
                 Contact.name,
@@ -102,57 +176,37 @@ class DailyActivities:
                 CustomerType.id,
                 Item.name,
             )
-            .order_by(Availability.start_at.asc())
-            .all()
         )
 
-    def _get_availabilities_with_bike_assigned(self):
-        results = (
-            db.session.query(Availability.id)
-            .join(bike_usages, Availability.id == bike_usages.c.availability_id)
-            .filter(func.DATE(Availability.start_at) == self.for_date)
-            .filter(bike_usages.c.bike_id.isnot(None))
-        )
-        return [row[0] for row in results]
-
-    @staticmethod
-    def _compute_duration(activity):
+    def run(self):
         """
-        Compute the booking duration
+        Get the tours and then the rentals of the day in a single query.
 
-        We need to know how long the activity last in order to release bikes so, they can be picked
-        up again the same day. For tours, we get that duration right from the start and
-        end date of the availability. However, for rentals, it's a bit trickier as the duration is
-        represented by the customer type so, we need a mapping to ct ids. If, for some reason, the
-        ct is not in this mapping, we assign the default of 2h
+        We need to know how long the activity last in order to release bikes so,
+        they can be picked up again the same day. If, for some reason, the
+        duration of a rental is unknown, we assign the default of 2h.
         """
-        if len(activity) == 6:
-            return round(Decimal(activity[3].seconds) / 3600, 1)
+        tracked = self._tracked_availabilities()
+        query = union_all(
+            self._get_tour_activities(tracked).statement,
+            self._get_rental_activities(tracked).statement,
+        ).order_by(literal_column("kind"), literal_column("start_at"))
 
-        duration_map = current_app.config["DURATION_MAP"]
-        duration = duration_map.get(activity[6])
-        if not duration:
-            logging.error(
-                "The customer type does not exist. Sending default duration (2h)"
-            )
-            duration = "2.0"
-        return Decimal(duration)
-
-    def run(self):
-        tracked_availability_ids = self._get_availabilities_with_bike_assigned()
-        activities_queryset = self._get_tour_activities(
-            tracked_availability_ids
-        ) + self._get_rental_activities(tracked_availability_ids)
-        mad = pytz.timezone("Europe/Madrid")
         activities = list()
-        for activity in activities_queryset:
+        for activity in db.session.execute(query):
+            if not activity.known_duration:
+                logging.error(
+                    "The customer type does not exist. Sending default duration (2h)"
+                )
             activities.append(
                 {
-                    "availability_id": activity[0],
-                    "headline": activity[1] or activity[4],
-                    "timestamp": activity[2].astimezone(mad).strftime("%X"),
-                    "no_of_bikes": activity[5],
-                    "duration": str(self._compute_duration(activity)),
+                    "availability_id": activity.availability_id,
+                    "headline": activity.headline,
+                    "timestamp": activity.start_at.astimezone(
+                        BUSINESS_TIMEZONE
+                    ).strftime("%X"),
+                    "no_of_bikes": activity.no_of_bikes,
+                    "duration": str(activity.duration),
                 }
             )
         return activities
@@ -0,0 +1,524 @@
+"""
+Persist whole FH responses in a single transaction.
+
+The per-entity services in model_services commit once per row, which for a
+booking with several customers and custom fields means dozens of commits. The
+services here collect every row contained in the response first and then write
+them with one `INSERT ... ON CONFLICT DO UPDATE` statement per table.
+"""
+import logging
+from collections import Counter, OrderedDict
+from datetime import datetime, timezone
+
+import attr
+from flask import current_app
+from sqlalchemy import case, func, literal_column, tuple_
+from sqlalchemy.dialects.postgresql import insert
+
+from . import metrics, models
+from .cache import reference_cache
+from .model_services import get_effective_period, update_effective_periods
+from .models import db
+
+logger = logging.getLogger(__name__)
+
+# Postgres sets xmax only for the rows that were updated on conflict.
+INSERTED = literal_column("xmax = 0").label("inserted")
+
+# The order in which the tables are written so foreign keys are always satisfied.
+UPSERT_ORDER = (
+    models.Item,
+    models.Availability,
+    models.Company,
+    models.Booking,
+    models.Contact,
+    models.EffectiveCancellationPolicy,
+    models.CustomerType,
+    models.CustomerPrototype,
+    models.CustomerTypeRate,
+    models.CheckinStatus,
+    models.Customer,
+    models.CustomField,
+    models.CustomFieldInstance,
+    models.CustomFieldValue,
+)
+
+
+@attr.s
+class CollectRows:
+    """
+    Walk the JSON response and collect the rows for each table.
+
+    Rows are keyed by pk (short_name for companies) so an entity that appears
+    several times in the response is only written once. Customer types,
+    prototypes and rates show up both under the availability and under each
+    customer, and custom fields under every value or instance, so the last
+    occurrence wins, as it does when each one is saved in turn, and the rest
+    are counted in `duplicates` per table.
+    Booking rows can't know the company ids beforehand, so they carry the
+    short names in `company_short_names` to be resolved after the companies
+    are saved.
+    """
+
+    data = attr.ib(type=dict)
+
+    def _add(self, model, row, key="id"):
+        model_rows = self.rows[model]
+        if row[key] in model_rows:
+            self.duplicates[model.__table_name__] += 1
+        model_rows[row[key]] = row
+
+    def _collect_item(self):
+        item_data = self.data["booking"]["availability"]["item"]
+        self._add(models.Item, {"id": item_data["pk"], "name": item_data["name"]})
+
+    def _collect_availability(self):
+        av_data = self.data["booking"]["availability"]
+        row = {
+            "id": av_data["pk"],
+            "capacity": av_data["capacity"],
+            "minimum_party_size": av_data["minimum_party_size"],
+            "maximum_party_size": av_data["maximum_party_size"],
+            "start_at": av_data["start_at"],
+            "end_at": av_data["end_at"],
+            "headline": av_data.get("headline"),
+            "item_id": av_data["item"]["pk"],
+        }
+        self._add(models.Availability, row)
+
+    def _collect_company(self, c_data):
+        if not c_data:
+            return None
+
+        # FH friends were a bit sloopy here
+        short_name = c_data.get("shortname") or c_data.get("short_name")
+        row = {
+            "name": c_data["name"],
+            "short_name": short_name,
+            "currency": c_data["currency"],
+        }
+        self._add(models.Company, row, key="short_name")
+        return short_name
+
+    def _collect_booking(self):
+        b_data = self.data["booking"]
+        company = self._collect_company(b_data["company"])
+        affiliate_company = self._collect_company(b_data["affiliate_company"])
+        self.company_short_names = {
+            "company_id": company,
+            "affiliate_company_id": affiliate_company,
+        }
+
+        created_by = affiliate_company or "staff"
+        effective_start_at, effective_end_at = get_effective_period(b_data)
+        row = {
+            "id": b_data["pk"],
+            "voucher_number": b_data["voucher_number"],
+            "display_id": b_data["display_id"],
+            "note_safe_html": b_data["note_safe_html"],
+            "agent": b_data["agent"],
+            "confirmation_url": b_data["confirmation_url"],
+            "customer_count": b_data["customer_count"],
+            "uuid": b_data["uuid"],
+            "dashboard_url": b_data["dashboard_url"],
+            "note": b_data["note"],
+            "pickup": b_data["pickup"],
+            "status": b_data["status"],
+            "created_by": created_by,
+            "availability_id": b_data["availability"]["pk"],
+            "company_id": None,
+            "affiliate_company_id": None,
+            "receipt_subtotal": b_data["receipt_subtotal"],
+            "receipt_taxes": b_data["receipt_taxes"],
+            "receipt_total": b_data["receipt_total"],
+            "amount_paid": b_data["amount_paid"],
+            "invoice_price": b_data["invoice_price"],
+            "receipt_subtotal_display": b_data["receipt_subtotal_display"],
+            "receipt_taxes_display": b_data["receipt_taxes_display"],
+            "receipt_total_display": b_data["receipt_total_display"],
+            "amount_paid_display": b_data["amount_paid_display"],
+            "invoice_price_display": b_data["invoice_price_display"],
+            "desk": b_data["desk"],
+            "is_eligible_for_cancellation": b_data["is_eligible_for_cancellation"],
+            "is_subscribed_for_sms_updates": b_data["is_subscribed_for_sms_updates"],
+            "arrival": b_data["arrival"],
+            "rebooked_to": b_data["rebooked_to"],
+            "rebooked_from": b_data["rebooked_from"],
+            "external_id": b_data["external_id"],
+            "order": b_data["order"],
+            "effective_start_at": effective_start_at,
+            "effective_end_at": effective_end_at,
+        }
+        self._add(models.Booking, row)
+
+    def _collect_contact(self):
+        b_data = self.data["booking"]
+        c_data = b_data["contact"]
+        row = {
+            "id": b_data["pk"],
+            "name": c_data["name"],
+            "email": c_data["email"],
+            "phone_country": c_data["phone_country"],
+            "phone": c_data["phone"],
+            "normalized_phone": c_data["normalized_phone"],
+            "language": c_data.get("language"),
+            "is_subscribed_for_email_updates": c_data[
+                "is_subscribed_for_email_updates"
+            ],
+        }
+        self._add(models.Contact, row)
+
+    def _collect_cancellation_policy(self):
+        b_data = self.data["booking"]
+        c_data = b_data["effective_cancellation_policy"]
+        row = {
+            "id": b_data["pk"],
+            "cutoff": c_data["cutoff"],
+            "cancellation_type": c_data["type"],
+        }
+        self._add(models.EffectiveCancellationPolicy, row)
+
+    def _collect_customer_type_rate(self, ctr_data):
+        """Collect a customer type rate along with its type and prototype."""
+        ct_data = ctr_data["customer_type"]
+        cpt_data = ctr_data["customer_prototype"]
+        ct_row = {
+            "id": ct_data["pk"],
+            "note": ct_data["note"],
+            "singular": ct_data["singular"],
+            "plural": ct_data["plural"],
+        }
+        cpt_row = {
+            "id": cpt_data["pk"],
+            "note": cpt_data["note"],
+            "total": cpt_data["total"],
+            "total_including_tax": cpt_data["total_including_tax"],
+            "display_name": cpt_data["display_name"],
+        }
+        ctr_row = {
+            "id": ctr_data["pk"],
+            "capacity": ctr_data["capacity"],
+            "minimum_party_size": ctr_data["minimum_party_size"],
+            "maximum_party_size": ctr_data["maximum_party_size"],
+            "total": ctr_data["total"],
+            "total_including_tax": ctr_data["total_including_tax"],
+            "availability_id": self.data["booking"]["availability"]["pk"],
+            "customer_prototype_id": cpt_data["pk"],
+            "customer_type_id": ct_data["pk"],
+        }
+        self._add(models.CustomerType, ct_row)
+        self._add(models.CustomerPrototype, cpt_row)
+        self._add(models.CustomerTypeRate, ctr_row)
+
+    def _collect_customer_group(self):
+        b_data = self.data["booking"]
+        for ctr_data in b_data["availability"]["customer_type_rates"]:
+            self._collect_customer_type_rate(ctr_data)
+
+        for c_data in b_data["customers"]:
+            ctr_data = c_data["customer_type_rate"]
+            self._collect_customer_type_rate(ctr_data)
+
+            cs_data = c_data["checkin_status"]
+            checkin_status_id = None
+            if cs_data:
+                checkin_status_id = cs_data["pk"]
+                cs_row = {
+                    "id": cs_data["pk"],
+                    "checkin_status_type": cs_data["type"],
+                    "name": cs_data["name"],
+                }
+                self._add(models.CheckinStatus, cs_row)
+
+            customer_row = {
+                "id": c_data["pk"],
+                "checkin_url": c_data["checkin_url"],
+                "checkin_status_id": checkin_status_id,
+                "customer_type_rate_id": ctr_data["pk"],
+                "booking_id": b_data["pk"],
+            }
+            self._add(models.Customer, customer_row)
+
+    def _collect_custom_field(self, custom_field_data, parent_id=None):
+        """
+        Collect a custom field.
+
+        Extended options are a reduced version of their parent so the fields
+        they lack are left empty.
+        """
+        if parent_id:
+            title = None
+            field_type = None
+            booking_notes = None
+            booking_notes_safe_html = None
+            is_required = False
+        else:
+            title = custom_field_data["title"]
+            field_type = custom_field_data["type"]
+            booking_notes = custom_field_data["booking_notes"]
+            booking_notes_safe_html = custom_field_data["booking_notes_safe_html"]
+            is_required = custom_field_data["is_required"]
+
+        row = {
+            "id": custom_field_data["pk"],
+            "title": title,
+            "name": custom_field_data["name"],
+            "modifier_kind": custom_field_data["modifier_kind"],
+            "modifier_type": custom_field_data["modifier_type"],
+            "field_type": field_type,
+            "offset": custom_field_data["offset"],
+            "percentage": custom_field_data["percentage"],
+            "description": custom_field_data["description"],
+            "booking_notes": booking_notes,
+            "description_safe_html": custom_field_data["description_safe_html"],
+            "booking_notes_safe_html": booking_notes_safe_html,
+            "is_required": is_required,
+            "is_taxable": custom_field_data["is_taxable"],
+            "is_always_per_customer": custom_field_data["is_always_per_customer"],
+            "extended_options": parent_id,
+        }
+        self._add(models.CustomField, row)
+
+    def _collect_custom_field_family(self, cf_family_data):
+        self._collect_custom_field(cf_family_data)
+        for extended_options_data in cf_family_data.get("extended_options", []):
+            self._collect_custom_field(extended_options_data, cf_family_data["pk"])
+        return cf_family_data["pk"]
+
+    def _collect_custom_field_instance(
+        self, cfi_data, availability_id=None, customer_type_rate_id=None
+    ):
+        custom_field_id = self._collect_custom_field_family(cfi_data["custom_field"])
+        row = {
+            "id": cfi_data["pk"],
+            "custom_field_id": custom_field_id,
+            "availability_id": availability_id,
+            "customer_type_rate_id": customer_type_rate_id,
+        }
+        models.CustomFieldInstance(**row).clean()
+        self._add(models.CustomFieldInstance, row)
+
+    def _collect_custom_field_value(self, cfv_data, booking_id=None, customer_id=None):
+        custom_field_id = self._collect_custom_field_family(cfv_data["custom_field"])
+        row = {
+            "id": cfv_data["pk"],
+            "name": cfv_data["name"],
+            "value": cfv_data["value"],
+            "display_value": cfv_data["display_value"],
+            "custom_field_id": custom_field_id,
+            "booking_id": booking_id,
+            "customer_id": customer_id,
+        }
+        models.CustomFieldValue(**row).clean()
+        self._add(models.CustomFieldValue, row)
+
+    def _collect_custom_field_group(self):
+        b_data = self.data["booking"]
+        for ctr_data in b_data["availability"]["customer_type_rates"]:
+            for cfi_data in ctr_data["custom_field_instances"]:
+                self._collect_custom_field_instance(
+                    cfi_data, customer_type_rate_id=ctr_data["pk"]
+                )
+
+        for cfi_data in b_data["availability"]["custom_field_instances"]:
+            self._collect_custom_field_instance(
+                cfi_data, availability_id=b_data["availability"]["pk"]
+            )
+
+        for cfv_data in b_data["custom_field_values"]:
+            self._collect_custom_field_value(cfv_data, booking_id=b_data["pk"])
+
+        for c_data in b_data["customers"]:
+            for cfv_data in c_data["custom_field_values"]:
+                self._collect_custom_field_value(cfv_data, customer_id=c_data["pk"])
+
+    def run(self):
+        self.rows = OrderedDict((model, OrderedDict()) for model in UPSERT_ORDER)
+        self.duplicates = Counter()
+        self._collect_item()
+        self._collect_availability()
+        self._collect_booking()
+        self._collect_contact()
+        self._collect_cancellation_policy()
+        self._collect_customer_group()
+        self._collect_custom_field_group()
+        return self
+
+
+def upsert_statement(
+    model, rows, index_elements=("id",), returning=(), unordered=False
+):
+    """
+    Build an `INSERT ... ON CONFLICT DO UPDATE` statement for the given rows.
+
+    On conflict every column but the key and created_at is overwritten with the
+    incoming value, which mirrors what the Update* services do. As them, the
+    rows whose values did not change are left untouched, updated_at included,
+    so they don't leave dead tuples behind.
+
+    When the rows may be older than the ones in the table (`unordered`), they
+    only overwrite the rows last written by an older snapshot, and lower
+    created_at when they are the oldest seen so far. updated_at then tells the
+    last snapshot carrying the row rather than the last one that changed it.
+
+    The statement returns a row for each inserted or updated row telling
+    whether it was inserted, followed by the `returning` columns.
+    """
+    table = model.__table__
+    stmt = insert(table).values(rows)
+    keep = set(index_elements) | {"id", "created_at"}
+    update_columns = {
+        name: stmt.excluded[name] for name in rows[0].keys() if name not in keep
+    }
+    if unordered:
+        newer = table.c.updated_at <= stmt.excluded.updated_at
+        older = stmt.excluded.created_at < table.c.created_at
+        update_columns = {
+            name: case([(newer, value)], else_=table.c[name])
+            for name, value in update_columns.items()
+        }
+        update_columns["created_at"] = func.least(
+            table.c.created_at, stmt.excluded.created_at
+        )
+        return stmt.on_conflict_do_update(
+            index_elements=list(index_elements),
+            set_=update_columns,
+            where=newer | older,
+        ).returning(INSERTED, *returning)
+
+    compared = [name for name in update_columns if name != "updated_at"]
+    changed = tuple_(*(table.c[name] for name in compared)).is_distinct_from(
+        tuple_(*(stmt.excluded[name] for name in compared))
+    )
+    return stmt.on_conflict_do_update(
+        index_elements=list(index_elements), set_=update_columns, where=changed
+    ).returning(INSERTED, *returning)
+
+
+@attr.s
+class BulkUpsertJSONResponse:
+    """
+    Save all the entities in the JSON response in one transaction.
+
+    It's the bulk counterpart of ProcessJSONResponse. Companies are written
+    first as FH gives no pk for them and we need their ids for the booking.
+    Returns the number of rows written per table, while the number of rows
+    that changed or not is kept in `changes`.
+
+    Every row is sent to the db, which skips the ones that didn't change, as
+    the reference cache may lag behind the other workers. The cache is only
+    read to resolve the ids of the unchanged companies, and the reference rows
+    written are invalidated once the transaction is committed.
+
+    Set `unordered` when the response may be older than the rows already
+    saved, as when the archive is replayed by several workers at once. The
+    rows are then written sorted by key, so concurrent transactions lock the
+    shared rows in the same order.
+
+    When the availability changes, as when it's rescheduled, the effective
+    period of its other bookings is recomputed in the same transaction.
+
+    The rows inserted get `created_at` when it's given rather than the
+    timestamp, as when only the last snapshot of a booking is replayed.
+    """
+
+    data = attr.ib(type=dict)
+    timestamp = attr.ib(type=datetime, default=datetime.now(timezone.utc))
+    unordered = attr.ib(type=bool, default=False)
+    created_at = attr.ib(type=datetime, default=None)
+
+    def _timestamped(self, rows):
+        created_at = self.created_at or self.timestamp
+        return [
+            dict(row, created_at=created_at, updated_at=self.timestamp) for row in rows
+        ]
+
+    def _save_companies(self, rows):
+        company = models.Company
+        stmt = upsert_statement(
+            company,
+            rows,
+            index_elements=("short_name",),
+            returning=(company.id, company.short_name),
+            unordered=self.unordered,
+        )
+        written = db.session.execute(stmt).fetchall()
+        company_ids = {short_name: pk for _, pk, short_name in written}
+
+        # The unchanged companies are not returned by the upsert, their ids never change
+        # so they can be taken from the cache.
+        unchanged = [
+            r["short_name"] for r in rows if r["short_name"] not in company_ids
+        ]
+        if unchanged:
+            cached = reference_cache.get_many(
+                db.session, company, company.short_name, unchanged
+            )
+            company_ids.update({key: values["id"] for key, values in cached.items()})
+        return written, company_ids
+
+    def _resolve_companies(self, booking_rows, company_ids):
+        for row in booking_rows:
+            for field, short_name in self.collector.company_short_names.items():
+                row[field] = company_ids.get(short_name)
+
+    def _count_changes(self, model, total, written):
+        table_name = model.__table_name__
+        changed = len(written)
+        self.changes[table_name] = {
+            "changed": changed,
+            "unchanged": total - changed,
+        }
+        for outcome, n in self.changes[table_name].items():
+            if n:
+                metrics.increment(f"{table_name}.{outcome}", n)
+
+    def run(self):
+        self.collector = CollectRows(self.data).run()
+        duplicates = self.collector.duplicates
+        if duplicates:
+            logger.info(
+                f"Dropped {sum(duplicates.values())} duplicated rows: {dict(duplicates)}"
+            )
+        counts, self.changes = OrderedDict(), OrderedDict()
+        self.written_references = list()
+        try:
+            company_ids, updated = dict(), list()
+            for model, rows in self.collector.rows.items():
+                if not rows:
+                    continue
+                total = len(rows)
+                if self.unordered:
+                    rows = [rows[key] for key in sorted(rows)]
+                else:
+                    rows = list(rows.values())
+                rows = self._timestamped(rows)
+                if model is models.Company:
+                    written, saved_ids = self._save_companies(rows)
+                    company_ids.update(saved_ids)
+                else:
+                    if model is models.Booking:
+                        self._resolve_companies(rows, company_ids)
+                    stmt = upsert_statement(
+                        model, rows, returning=(model.id,), unordered=self.unordered
+                    )
+                    written = db.session.execute(stmt).fetchall()
+                if model.cached:
+                    self.written_references += [(model, row[-1]) for row in written]
+                if model is models.Availability:
+                    updated = [pk for inserted, pk in written if not inserted]
+                self._count_changes(model, total, written)
+                counts[model.__table_name__] = total
+            # The other bookings of an availability that changed, maybe rescheduled, follow
+            # it. They are locked after the availability row, so the workers replaying the
+            # bookings of the same availability wait for each other rather than deadlock.
+            for availability_id in updated:
+                update_effective_periods(current_app.config, availability_id)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        for model, key in self.written_references:
+            reference_cache.invalidate(model, key)
+        logger.debug(f"Rows changed per table: {dict(self.changes)}")
+        return counts
@@ -0,0 +1,147 @@
+"""
+Keep the reference data, the small catalogs that rarely change, in memory.
+
+Items, companies, customer types & prototypes, checkin statuses and custom
+fields come in every booking but they hardly ever change, so there's no point
+in asking the db for them on each request.
+
+The cache holds snapshots of the rows (dicts with the column values) rather
+than instances, as these belong to the session of the thread that loaded
+them. Snapshots are turned back into instances of the current session with
+`Session.merge(load=False)`, which does not touch the db. Each uwsgi worker has
+its own cache, so the entries are also invalidated after a TTL to pick up the
+changes committed by the other workers.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+import attr
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, lazyload, make_transient_to_detached
+
+from . import metrics
+
+
+def snapshot(instance):
+    """Return the column values of an instance."""
+    mapper = inspect(instance).mapper
+    return {column.key: getattr(instance, column.key) for column in mapper.column_attrs}
+
+
+def restore(session, model, values):
+    """Return the instance for a snapshot attached to the session."""
+    key = inspect(model).identity_key_from_primary_key((values["id"],))
+    instance = session.identity_map.get(key)
+    if instance is not None:
+        # Don't override the changes the session may hold.
+        return instance
+    instance = model(**values)
+    make_transient_to_detached(instance)
+    return session.merge(instance, load=False)
+
+
+@attr.s
+class ReferenceCache:
+    """A thread safe LRU cache whose entries expire after some seconds."""
+
+    ttl = attr.ib(type=float, default=300)
+    max_size = attr.ib(type=int, default=10_000)
+
+    def __attrs_post_init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits, self.misses = 0, 0
+
+    def configure(self, ttl, max_size):
+        with self._lock:
+            self.ttl, self.max_size = ttl, max_size
+            self._entries.clear()
+
+    def get(self, model, key):
+        """Return the snapshot for the key or None if it's not cached."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get((model, key))
+            if entry is not None and entry[0] <= now:
+                del self._entries[(model, key)]
+                entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end((model, key))
+                self.hits += 1
+        metrics.increment(
+            "reference_cache.misses" if entry is None else "reference_cache.hits"
+        )
+        return None if entry is None else entry[1]
+
+    def set(self, model, key, values):
+        if self.ttl <= 0 or self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[(model, key)] = (time.monotonic() + self.ttl, values)
+            self._entries.move_to_end((model, key))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, model, key):
+        with self._lock:
+            self._entries.pop((model, key), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits, self.misses = 0, 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_or_load(self, session, model, key, load):
+        """Return the instance for the key, calling `load` if it's not cached."""
+        values = self.get(model, key)
+        if values is not None:
+            return restore(session, model, values)
+        instance = load()
+        if instance is not None:
+            self.set(model, key, snapshot(instance))
+        return instance
+
+    def get_many(self, session, model, column, keys):
+        """Return the snapshots for the keys, loading the ones not cached in one query."""
+        found, missing = dict(), list()
+        for key in keys:
+            values = self.get(model, key)
+            if values is None:
+                missing.append(key)
+            else:
+                found[key] = values
+        if missing:
+            query = session.query(model).options(lazyload("*"))
+            for instance in query.filter(column.in_(missing)):
+                key = getattr(instance, column.key)
+                found[key] = snapshot(instance)
+                self.set(model, key, found[key])
+        return found
+
+
+reference_cache = ReferenceCache()
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_changed_references(session, flush_context):
+    changed = session.info.setdefault("changed_references", set())
+    for instance in session.dirty | session.deleted:
+        if getattr(instance, "cached", False):
+            changed.add((type(instance), instance.cache_key))
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_changed_references(session):
+    for model, key in session.info.pop("changed_references", ()):
+        reference_cache.invalidate(model, key)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_changed_references(session):
+    session.info.pop("changed_references", None)
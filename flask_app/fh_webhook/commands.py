@@ -0,0 +1,247 @@
+"""Command line entry points, run them with `flask <command>`."""
+import json
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from .backfill import EXTRACTORS, Backfill, PopulateCreatedBy, PopulateEffectivePeriod
+from .legacy_import import LegacyImport
+from .services import (
+    IndexArchive,
+    PopulateDB,
+    ProcessStoredRequests,
+    get_history,
+    queue_depth,
+)
+from .validators import ValidateArchive
+
+
+@click.command("process-requests")
+@click.option("--once", is_flag=True, help="Drain the queue and exit.")
+@click.option("--batch-size", default=50, show_default=True)
+@click.option(
+    "--interval", default=1.0, show_default=True, help="Seconds between polls."
+)
+@with_appcontext
+def process_requests(once, batch_size, interval):
+    """Process the requests stored by the webhook in async mode."""
+    ProcessStoredRequests(current_app, batch_size=batch_size, interval=interval).run(
+        once=once
+    )
+
+
+@click.command("reprocess-requests")
+@click.option("--batch-size", default=50, show_default=True)
+@click.option(
+    "--min-age",
+    default=60,
+    show_default=True,
+    help="Seconds a request is left to the webhook before reprocessing it.",
+)
+@click.option(
+    "--catch-up/--no-catch-up",
+    default=True,
+    show_default=True,
+    help="Store first the archived requests missing in the db.",
+)
+@click.option(
+    "--ignore-backoff", is_flag=True, help="Retry the failed requests right away."
+)
+@with_appcontext
+def reprocess_requests(batch_size, min_age, catch_up, ignore_backoff):
+    """Process once the requests left unprocessed, to be run on a schedule."""
+    worker = ProcessStoredRequests(
+        current_app,
+        batch_size=batch_size,
+        min_age=min_age,
+        ignore_backoff=ignore_backoff,
+    )
+    worker.run(once=True, catch_up=catch_up)
+    click.echo(
+        f"{worker.recovered} requests caught up, {worker.processed} processed, "
+        + f"{worker.failed} failed."
+    )
+
+
+@click.command("queue-depth")
+@with_appcontext
+def show_queue_depth():
+    """Print the number of stored requests waiting to be processed."""
+    click.echo(queue_depth())
+
+
+@click.command("populate-db")
+@click.option(
+    "--workers",
+    default=1,
+    show_default=True,
+    help="Processes replaying the archive, partitioned by booking.",
+)
+@click.option(
+    "--restart", is_flag=True, help="Read the whole archive ignoring the checkpoint."
+)
+@click.option(
+    "--compact",
+    is_flag=True,
+    help="Replay only the newest snapshot of each booking and availability.",
+)
+@click.option(
+    "--audit", is_flag=True, help="Store the requests skipped by --compact too."
+)
+@with_appcontext
+def populate_db(workers, restart, compact, audit):
+    """Replay the archived requests into the database."""
+    PopulateDB(
+        current_app, workers=workers, resume=not restart, compact=compact, audit=audit
+    ).run()
+
+
+@click.command("backfill")
+@click.argument("names", nargs=-1)
+@click.option("--dry-run", is_flag=True, help="Count the rows to update and roll back.")
+@click.option("--batch-size", default=5000, show_default=True)
+@with_appcontext
+def backfill(names, dry_run, batch_size):
+    """Fill columns out of the archive, list the extractors if none is given."""
+    if not names:
+        for e in EXTRACTORS.values():
+            click.echo(f"{e.name}: {e.model.__table_name__}.{', '.join(e.columns)}")
+        return
+    unknown = [name for name in names if name not in EXTRACTORS]
+    if unknown:
+        raise click.BadParameter(f"Unknown extractors: {', '.join(unknown)}")
+    counts = Backfill(current_app, names, dry_run, batch_size).run()
+    verb = "would be updated" if dry_run else "updated"
+    for name, count in counts.items():
+        click.echo(f"{name}: {count['found']} rows found, {count['updated']} {verb}")
+
+
+@click.command("populate-created-by")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--dry-run", is_flag=True, help="Count the rows to update and roll back.")
+@with_appcontext
+def populate_created_by(path, dry_run):
+    """Fill created_by of the staff bookings out of a CSV downloaded from FH."""
+    try:
+        counts = PopulateCreatedBy(path, dry_run).run()
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    verb = "would be updated" if dry_run else "updated"
+    for creator, n in counts.items():
+        click.echo(f"{creator}: {n} bookings {verb}")
+
+
+@click.command("populate-effective-period")
+@click.option("--dry-run", is_flag=True, help="Count the rows to update and roll back.")
+@with_appcontext
+def populate_effective_period(dry_run):
+    """Fill when the bikes of the bookings are in use out of their availabilities."""
+    updated = PopulateEffectivePeriod(current_app, dry_run).run()
+    verb = "would be updated" if dry_run else "updated"
+    click.echo(f"{updated} bookings {verb}")
+
+
+@click.command("validate-archive")
+@click.option("--workers", default=4, show_default=True)
+@click.option(
+    "--samples", default=3, show_default=True, help="Request names kept per error."
+)
+@click.option("--as-json", is_flag=True, help="Print the report as JSON.")
+@with_appcontext
+def validate_archive(workers, samples, as_json):
+    """Validate the whole archive and report the errors found per field."""
+    report = ValidateArchive(current_app, workers, samples).run().as_dict()
+    if as_json:
+        click.echo(json.dumps(report, indent=2))
+        return
+    click.echo(f"{report['invalid']} of {report['total']} requests are invalid.")
+    for error in report["errors"]:
+        click.echo(
+            f"{error['count']:>8} {error['path']}: {error['message']} "
+            + f"({error['first_seen']} - {error['last_seen']}) "
+            + ", ".join(error["samples"])
+        )
+
+
+@click.command("index-archive")
+@with_appcontext
+def index_archive():
+    """Rebuild the index of the archive by booking."""
+    click.echo(f"{IndexArchive(current_app).run()} requests indexed.")
+
+
+@click.command("booking-history")
+@click.argument("key")
+@click.option(
+    "--availability", is_flag=True, help="Take the key as an availability pk."
+)
+@with_appcontext
+def booking_history(key, availability):
+    """Print the archived requests of a booking, by pk or uuid, oldest first."""
+    if availability:
+        filters = {"availability_id": int(key)}
+    elif key.isdigit():
+        filters = {"booking_id": int(key)}
+    else:
+        filters = {"booking_uuid": key}
+    for entry in get_history(current_app, **filters):
+        click.echo(json.dumps(entry))
+
+
+@click.command("import-legacy")
+@click.argument("availabilities", type=click.Path(exists=True, dir_okay=False))
+@click.argument("bookings", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--rejected",
+    default="rejected_rows.csv",
+    show_default=True,
+    help="Where to write the rows rejected and the reason.",
+)
+@click.option(
+    "--thirty-min-articles",
+    envvar="THIRTY_MIN_ARTICLES",
+    default="",
+    help="Comma separated ids of the items lasting 30'.",
+)
+@click.option(
+    "--three-hour-articles",
+    envvar="THREE_HOUR_ARTICLES",
+    default="",
+    help="Comma separated ids of the items lasting 3h.",
+)
+@click.option(
+    "--affiliates",
+    envvar="AFFILIATE_MAP",
+    default="{}",
+    help="JSON object mapping the affiliate names to company ids.",
+)
+@click.option("--company-id", default=1, show_default=True)
+@with_appcontext
+def import_legacy(
+    availabilities,
+    bookings,
+    rejected,
+    thirty_min_articles,
+    three_hour_articles,
+    affiliates,
+    company_id,
+):
+    """Load the legacy availabilities & bookings CSVs with COPY."""
+    try:
+        counts = LegacyImport(
+            availabilities,
+            bookings,
+            rejected,
+            thirty_min_articles=[a for a in thirty_min_articles.split(",") if a],
+            three_hour_articles=[a for a in three_hour_articles.split(",") if a],
+            affiliates=json.loads(affiliates),
+            company_id=company_id,
+        ).run()
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    for table, count in counts.items():
+        click.echo(
+            f"{table}: {count['read']} rows read, {count['rejected']} rejected, "
+            + f"{count['inserted']} inserted"
+        )
@@ -21,3 +21,10 @@ class TooManyInstances(BaseFHWebhookException):
 
     def __init__(self, model):
         super().__init__(f"The query returned several entries.")
+
+
+class ReplayWorkerDied(BaseFHWebhookException):
+    """Raised when a worker of a parallel replay exits before its records are done."""
+
+    def __init__(self, name, exitcode):
+        super().__init__(f"The replay worker {name} exited with code {exitcode}.")
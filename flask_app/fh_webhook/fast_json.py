@@ -0,0 +1,119 @@
+"""
+Parse the JSON bodies sent by FH.
+
+orjson parses the payloads several times faster than the standard library.
+
+When only a few fields of a request are needed, `extract` streams the body
+with ijson and builds just those, so the rest of a big group booking is never
+turned into objects.
+
+Both are pinned in requirements.txt. The fallbacks, json and a full parse
+pruned afterwards, give the same results and only keep the scripts working
+where they are not installed.
+"""
+import io
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+def loads(body):
+    """Parse a JSON document given as bytes or str."""
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+def split_paths(paths):
+    """
+    Turn dotted paths like `booking.customers.*.pk` into tuples of keys.
+
+    `*` stands for every item of a list.
+    """
+    return [tuple(path.split(".")) for path in paths]
+
+
+def prune(data, paths):
+    """Return a copy of the document with just the values on the paths."""
+    if any(not path for path in paths):
+        return data
+    if isinstance(data, dict):
+        pruned = dict()
+        for key, value in data.items():
+            inner = [path[1:] for path in paths if path[0] == key]
+            if inner:
+                pruned[key] = prune(value, inner)
+        return pruned
+    if isinstance(data, list):
+        inner = [path[1:] for path in paths if path[0] == "*"]
+        return [prune(value, inner) for value in data] if inner else []
+    return data
+
+
+def _parse(body):
+    """Yield the ijson events, raising ValueError like `loads` on invalid JSON."""
+    try:
+        yield from ijson.parse(io.BytesIO(body), use_float=True)
+    except ijson.JSONError as e:
+        raise ValueError(f"Not a valid JSON document: {e}") from e
+
+
+def _stream(body, paths):
+    """Build the values on the paths out of the ijson events."""
+    prefixes = {".".join("item" if k == "*" else k for k in path) for path in paths}
+    kept = dict()
+
+    def keep(prefix):
+        # Whether the prefix is on a path or inside the value of one.
+        if prefix not in kept:
+            kept[prefix] = not prefix or any(
+                prefix == p or prefix.startswith(p + ".") or p.startswith(prefix + ".")
+                for p in prefixes
+            )
+        return kept[prefix]
+
+    if isinstance(body, str):
+        body = body.encode()
+    root, stack, keys = list(), [None], [None]
+    for prefix, event, value in _parse(body):
+        if event == "map_key":
+            keys[-1] = value
+            continue
+        if event in ("end_map", "end_array"):
+            stack.pop(), keys.pop()
+            continue
+        parent = stack[-1] if len(stack) > 1 else root
+        if parent is not None and keep(prefix):
+            if event in ("start_map", "start_array"):
+                value = dict() if event == "start_map" else list()
+            if isinstance(parent, dict):
+                parent[keys[-1]] = value
+            else:
+                parent.append(value)
+        else:
+            value = None
+        if event in ("start_map", "start_array"):
+            stack.append(value), keys.append(None)
+    return root[0]
+
+
+def extract(body, paths):
+    """
+    Parse only the values on the dotted paths of a JSON document.
+
+    Returns the document pruned to those paths, with the same shape as the
+    full one, e.g. `{"booking": {"pk": 1}}` for `booking.pk`. Missing keys
+    are left out.
+    """
+    split = split_paths(paths)
+    if ijson is not None:
+        return _stream(body, split)
+    return prune(loads(body), split)
@@ -0,0 +1,58 @@
+"""Prefetch the instances a FH response refers to."""
+import attr
+from sqlalchemy.orm import lazyload
+
+from . import models
+from .bulk_services import CollectRows
+
+
+@attr.s
+class IdentityMap:
+    """
+    Hold the existing instances of the entities contained in a JSON response.
+
+    Instead of asking the db for every nested object, the response is walked
+    once to collect the pks for each model and then the existing rows are
+    loaded with one `WHERE id IN (...)` query per table. Companies are keyed by
+    short_name as FH does not provide pk for them.
+
+    It lives as long as the request, so the instances created while processing
+    the response should be added to the map to be found by later lookups. The
+    reference data is loaded from the db as well rather than from the reference
+    cache, since the services decide what to update comparing against these
+    instances and the cache may lag behind the other workers.
+    """
+
+    data = attr.ib(type=dict)
+
+    @staticmethod
+    def _key_column(model):
+        if model is models.Company:
+            return models.Company.short_name
+        return model.id
+
+    def _load(self, model, keys):
+        if not keys:
+            return dict()
+        column = self._key_column(model)
+        # Relationships are not needed to pick the service, so don't eager load them.
+        query = model.query.options(lazyload("*"))
+        instances = query.filter(column.in_(keys)).all()
+        return {getattr(instance, column.key): instance for instance in instances}
+
+    def get(self, model, key):
+        """Return the instance for the key or None if it's not in the db."""
+        return self.instances[model].get(key)
+
+    def add(self, model, key, instance):
+        """Register an instance and return it."""
+        self.instances[model][key] = instance
+        return instance
+
+    def run(self):
+        rows = CollectRows(self.data).run().rows
+        self.instances = {
+            model: self._load(model, list(model_rows.keys()))
+            for model, model_rows in rows.items()
+        }
+        return self
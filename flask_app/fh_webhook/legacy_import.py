@@ -0,0 +1,334 @@
+"""
+Load the legacy bookings, the ones collected before the webhook, out of CSVs.
+
+The legacy data (spreadsheets, odoo and FH exports) was cleaned into two CSVs,
+one with the availabilities and one with the bookings and their contacts. We
+used to build an ORM object per row in one huge session, which doesn't go far
+with millions of rows. Now:
+
+1. each CSV is streamed with `COPY` into a temp staging table with a text
+   column per CSV column, so nothing is held in memory;
+2. the rows are validated in SQL, the reason for the rejected ones is written
+   next to them and dumped with `COPY` to the rejected file;
+3. the valid rows are transformed (prices to cents, end times out of the
+   article) and merged into the real tables with one `INSERT ... SELECT` per
+   table. Rows already in the db are left alone, as the webhook data is
+   fresher than the legacy one.
+
+Everything runs in one transaction, so a failed import leaves no trace.
+"""
+import csv
+import json
+import logging
+from collections import OrderedDict
+
+import attr
+from sqlalchemy import BigInteger, Column, MetaData, Table, Text, text
+
+from .models import db
+
+logger = logging.getLogger(__name__)
+
+AVAILABILITY_COLUMNS = (
+    "av_id",
+    "article_id",
+    "start_date",
+    "start_hour",
+    "public_header",
+    "create_date",
+    "create_time",
+)
+BOOKING_COLUMNS = (
+    "id",
+    "av_id",
+    "voucher",
+    "pax",
+    "notes",
+    "cancelled",
+    "subtotal",
+    "tax_total",
+    "total",
+    "invoice_total",
+    "opt_in_txt",
+    "affiliate",
+    "contact",
+    "email",
+    "language",
+    "phone",
+    "opt_in_email",
+    "create_date",
+    "create_time",
+)
+
+# Return NULL rather than failing for the values that can't be cast.
+TIMESTAMP_FUNCTION = """
+CREATE OR REPLACE FUNCTION pg_temp.legacy_timestamp(value text) RETURNS timestamptz AS $$
+BEGIN
+    RETURN (value || '+00:00')::timestamptz;
+EXCEPTION WHEN others THEN
+    RETURN NULL;
+END $$ LANGUAGE plpgsql STABLE
+"""
+
+# The prices come as variable floats, take up to two decimals like
+# `get_int_prices` did and turn them into cents (stripe style).
+PRICE_PATTERN = r"^\d+\.\d{1,2}"
+
+
+def price(column):
+    return f"(substring({column} from '{PRICE_PATTERN}')::numeric * 100)::integer"
+
+
+def created_at(table):
+    return (
+        f"pg_temp.legacy_timestamp({table}.create_date || ' ' || {table}.create_time)"
+    )
+
+
+AVAILABILITY_REASONS = f"""
+UPDATE legacy_availability AS s SET reason = CASE
+    WHEN s.av_id !~ '^\\d+$' THEN 'invalid av_id'
+    WHEN replace(s.article_id, '#', '') !~ '^\\d+$' THEN 'invalid article_id'
+    WHEN pg_temp.legacy_timestamp(s.start_date || ' ' || s.start_hour) IS NULL
+        THEN 'invalid start date'
+    WHEN {created_at("s")} IS NULL THEN 'invalid create date'
+    WHEN NOT EXISTS (
+        SELECT 1 FROM item WHERE item.id = replace(s.article_id, '#', '')::bigint
+    ) THEN 'unknown item'
+END
+"""
+
+BOOKING_REASONS = f"""
+UPDATE legacy_booking AS s SET reason = CASE
+    WHEN s.id !~ '^\\d+$' THEN 'invalid id'
+    WHEN s.av_id !~ '^\\d+$' THEN 'invalid av_id'
+    WHEN s.pax !~ '^\\d{{1,4}}$' THEN 'invalid pax'
+    WHEN s.subtotal !~ '{PRICE_PATTERN}' OR s.tax_total !~ '{PRICE_PATTERN}'
+        OR s.total !~ '{PRICE_PATTERN}' OR s.invoice_total !~ '{PRICE_PATTERN}'
+        THEN 'invalid price'
+    WHEN {created_at("s")} IS NULL THEN 'invalid create date'
+    WHEN NOT EXISTS (
+        SELECT 1 FROM availability WHERE availability.id = s.av_id::bigint
+    ) THEN 'unknown availability'
+    WHEN (CAST(:affiliates AS jsonb) ->> s.affiliate) IS NOT NULL AND NOT EXISTS (
+        SELECT 1 FROM company
+        WHERE company.id = (CAST(:affiliates AS jsonb) ->> s.affiliate)::bigint
+    ) THEN 'unknown affiliate company'
+END
+"""
+
+# Only the first one of the rows sharing a pk is loaded.
+DUPLICATED = """
+UPDATE {table} AS s SET reason = 'duplicated {pk}'
+WHERE s.reason IS NULL AND EXISTS (
+    SELECT 1 FROM {table} AS earlier
+    WHERE earlier.{pk} = s.{pk} AND earlier.reason IS NULL AND earlier.line < s.line
+)
+"""
+
+MERGE_AVAILABILITIES = f"""
+INSERT INTO availability (
+    created_at, updated_at, id, capacity, minimum_party_size, maximum_party_size,
+    start_at, end_at, headline, item_id
+)
+SELECT
+    {created_at("s")},
+    {created_at("s")},
+    s.av_id::bigint,
+    50,
+    2,
+    10,
+    pg_temp.legacy_timestamp(s.start_date || ' ' || s.start_hour),
+    pg_temp.legacy_timestamp(s.start_date || ' ' || s.start_hour) + CASE
+        WHEN replace(s.article_id, '#', '') = ANY(:thirty_min_articles)
+            THEN interval '30 minutes'
+        WHEN replace(s.article_id, '#', '') = ANY(:three_hour_articles)
+            THEN interval '3 hours'
+        ELSE interval '24 hours'
+    END,
+    s.public_header,
+    replace(s.article_id, '#', '')::bigint
+FROM legacy_availability AS s
+WHERE s.reason IS NULL
+ON CONFLICT (id) DO NOTHING
+"""
+
+MERGE_BOOKINGS = f"""
+INSERT INTO booking (
+    created_at, updated_at, id, voucher_number, display_id, customer_count, uuid,
+    note, status, created_by, receipt_subtotal, receipt_taxes, receipt_total,
+    invoice_price, is_subscribed_for_sms_updates, availability_id, company_id,
+    affiliate_company_id
+)
+SELECT
+    {created_at("s")},
+    {created_at("s")},
+    s.id::bigint,
+    s.voucher,
+    '#' || s.id,
+    s.pax::smallint,
+    md5(random()::text || clock_timestamp()::text || s.id),
+    s.notes,
+    CASE WHEN s.cancelled = 'Cancelled' THEN 'cancelled' ELSE 'booked' END,
+    'staff',
+    {price("s.subtotal")},
+    {price("s.tax_total")},
+    {price("s.total")},
+    {price("s.invoice_total")},
+    coalesce(s.opt_in_txt = 'Subscribed', false),
+    s.av_id::bigint,
+    :company_id,
+    (CAST(:affiliates AS jsonb) ->> s.affiliate)::bigint
+FROM legacy_booking AS s
+WHERE s.reason IS NULL
+ON CONFLICT (id) DO NOTHING
+"""
+
+MERGE_CONTACTS = f"""
+INSERT INTO contact (
+    created_at, updated_at, id, name, email, phone_country, phone, normalized_phone,
+    is_subscribed_for_email_updates
+)
+SELECT
+    {created_at("s")},
+    {created_at("s")},
+    s.id::bigint,
+    coalesce(s.contact, ''),
+    s.email,
+    s.language,
+    coalesce(s.phone, ''),
+    coalesce(s.phone, ''),
+    coalesce(s.opt_in_email = 'Subscribed', false)
+FROM legacy_booking AS s
+WHERE s.reason IS NULL
+ON CONFLICT (id) DO NOTHING
+"""
+
+REJECTED = """
+COPY (
+    SELECT 'availabilities' AS file, line + 1 AS line, reason,
+        to_jsonb(s) - 'line' - 'reason' AS row
+    FROM legacy_availability AS s WHERE reason IS NOT NULL
+    UNION ALL
+    SELECT 'bookings', line + 1, reason, to_jsonb(s) - 'line' - 'reason'
+    FROM legacy_booking AS s WHERE reason IS NOT NULL
+    ORDER BY file, line
+) TO STDOUT WITH (FORMAT csv, HEADER true)
+"""
+
+
+def stage_csv(name, f, required=()):
+    """
+    COPY a CSV into a temp table with a text column per CSV column.
+
+    The file must be positioned at the header. Besides the CSV columns, the
+    table has the `line` of each row (1 for the first one after the header)
+    and an empty `reason` to flag the rows rejected. It's dropped on commit.
+    Returns the number of rows copied.
+    """
+    header = next(csv.reader([f.readline()]), [])
+    missing = [column for column in required if column not in header]
+    if missing:
+        raise ValueError(f"{f.name} misses the columns {', '.join(missing)}")
+    table = Table(
+        name,
+        MetaData(),
+        Column("line", BigInteger, primary_key=True),
+        Column("reason", Text),
+        *(Column(column, Text) for column in header),
+        prefixes=["TEMPORARY"],
+        postgresql_on_commit="DROP",
+    )
+    connection = db.session.connection()
+    table.create(connection)
+    quote = connection.dialect.identifier_preparer.quote
+    columns = ", ".join(quote(column) for column in header)
+    cursor = connection.connection.cursor()
+    cursor.copy_expert(f"COPY {name} ({columns}) FROM STDIN WITH (FORMAT csv)", f)
+    connection.execute(text(f"ANALYZE {name}"))
+    return cursor.rowcount
+
+
+@attr.s
+class LegacyImport:
+    """
+    Load the availabilities, bookings and contacts of the legacy CSVs.
+
+    The articles lasting 30' and 3h are given as lists of item ids, the rest
+    last 24h. `affiliates` maps the affiliate names in the CSV to company ids.
+    Returns, per table, the number of rows read, rejected and inserted.
+    """
+
+    availabilities_path = attr.ib(type=str)
+    bookings_path = attr.ib(type=str)
+    rejected_path = attr.ib(type=str)
+    thirty_min_articles = attr.ib(type=list, factory=list)
+    three_hour_articles = attr.ib(type=list, factory=list)
+    affiliates = attr.ib(type=dict, factory=dict)
+    company_id = attr.ib(type=int, default=1)
+
+    def _stage(self, name, path, required):
+        with open(path, newline="") as f:
+            read = stage_csv(name, f, required)
+        logger.info(f"Copied {read} rows of {path}")
+        return read
+
+    def _validate(self, name, reasons, pk):
+        params = {"affiliates": json.dumps(self.affiliates)}
+        db.session.execute(text(reasons), params)
+        db.session.execute(text(DUPLICATED.format(table=name, pk=pk)))
+        stmt = text(f"SELECT count(*) FROM {name} WHERE reason IS NOT NULL")
+        return db.session.execute(stmt).scalar()
+
+    def _merge(self, stmt):
+        params = {
+            "thirty_min_articles": [str(a) for a in self.thirty_min_articles],
+            "three_hour_articles": [str(a) for a in self.three_hour_articles],
+            "affiliates": json.dumps(self.affiliates),
+            "company_id": self.company_id,
+        }
+        return db.session.execute(text(stmt), params).rowcount
+
+    def _write_rejected(self):
+        cursor = db.session.connection().connection.cursor()
+        with open(self.rejected_path, "w", newline="") as f:
+            cursor.copy_expert(REJECTED, f)
+
+    def run(self):
+        counts = OrderedDict()
+        try:
+            db.session.execute(text(TIMESTAMP_FUNCTION))
+            read = self._stage(
+                "legacy_availability", self.availabilities_path, AVAILABILITY_COLUMNS
+            )
+            rejected = self._validate(
+                "legacy_availability", AVAILABILITY_REASONS, "av_id"
+            )
+            inserted = self._merge(MERGE_AVAILABILITIES)
+            counts["availability"] = {
+                "read": read,
+                "rejected": rejected,
+                "inserted": inserted,
+            }
+
+            read = self._stage("legacy_booking", self.bookings_path, BOOKING_COLUMNS)
+            rejected = self._validate("legacy_booking", BOOKING_REASONS, "id")
+            counts["booking"] = {
+                "read": read,
+                "rejected": rejected,
+                "inserted": self._merge(MERGE_BOOKINGS),
+            }
+            counts["contact"] = {
+                "read": read,
+                "rejected": rejected,
+                "inserted": self._merge(MERGE_CONTACTS),
+            }
+
+            self._write_rejected()
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        for table, count in counts.items():
+            logger.info(f"{table}: {count}")
+        return counts
@@ -0,0 +1,26 @@
+"""
+Count events in the worker process.
+
+Each uwsgi worker keeps its own counters, so the figures shown on the metrics
+endpoint are the ones of the worker that happens to answer.
+"""
+from collections import Counter
+from threading import Lock
+
+_counters = Counter()
+_lock = Lock()
+
+
+def increment(name, value=1):
+    with _lock:
+        _counters[name] += value
+
+
+def get_counters():
+    with _lock:
+        return dict(_counters)
+
+
+def reset():
+    with _lock:
+        _counters.clear()
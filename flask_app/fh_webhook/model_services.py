@@ -1,15 +1,53 @@
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
 
 import attr
 from flask import current_app
 from sqlalchemy import text
 
-from fh_webhook import models
+from fh_webhook import metrics, models
 from fh_webhook.exceptions import DoesNotExist
 from fh_webhook.models import db
-from fh_webhook.queries import BIKES_IN_USE_QUERY
+from fh_webhook.occupancy import bike_occupancy
+from fh_webhook.queries import (
+    BIKES_IN_USE_QUERY,
+    BIKES_IN_USE_STATEMENT,
+    EFFECTIVE_PERIOD_UPDATE,
+)
 from fh_webhook.result import Result
 
+# The format of the timestamps in FH responses, e.g. 2021-04-05T12:30:00+0200.
+FH_TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S%z"
+
+
+def parse_timestamp(value):
+    """
+    Turn a timestamp of the FH responses into an aware datetime.
+
+    The datetime columns must be given datetimes rather than the strings, otherwise
+    they never equal the values loaded and the rows always look changed.
+    """
+    if value is None or isinstance(value, datetime):
+        return value
+    return datetime.strptime(value, FH_TIMESTAMP_FORMAT)
+
+
+def save_changes(instance, timestamp):
+    """
+    Commit an updated instance, bumping updated_at only if some column changed.
+
+    SQLAlchemy leaves out of the UPDATE the columns set to the value they
+    already had, so an instance without changes is not written at all. The
+    outcome is counted per table in the metrics.
+    """
+    changed = db.session.is_modified(instance, include_collections=False)
+    if changed:
+        instance.updated_at = timestamp
+    outcome = "changed" if changed else "unchanged"
+    metrics.increment(f"{instance.__table_name__}.{outcome}")
+    db.session.commit()
+    return changed
+
 
 @attr.s
 class CreateStoredRequest:
@@ -19,6 +57,8 @@ class CreateStoredRequest:
     filename = attr.ib(type=str)
     body = attr.ib(type=str)
     timestamp = attr.ib(type=datetime, default=datetime.now(timezone.utc))
+    booking_id = attr.ib(type=int, default=None)
+    content_hash = attr.ib(type=str, default=None)
 
     def run(self):
         new_stored_request = models.StoredRequest(
@@ -27,6 +67,8 @@ class CreateStoredRequest:
             id=self.request_id,
             filename=self.filename,
             body=self.body,
+            booking_id=self.booking_id,
+            content_hash=self.content_hash,
         )
         db.session.add(new_stored_request)
         db.session.commit()
@@ -80,8 +122,7 @@ class UpdateItem:
     def run(self):
         item = models.Item.get(self.item_id)
         item.name = self.name
-        item.updated_at = self.timestamp
-        db.session.commit()
+        save_changes(item, self.timestamp)
         return item
 
 
@@ -142,7 +183,6 @@ class UpdateAvailability:
 
     def run(self):
         availability = models.Availability.get(self.availability_id)
-        availability.updated_at = self.timestamp
         availability.capacity = self.capacity
         availability.minimum_party_size = self.minimum_party_size
         availability.maximum_party_size = self.maximum_party_size
@@ -151,7 +191,7 @@ class UpdateAvailability:
         availability.item_id = self.item_id
         availability.headline = self.headline
 
-        db.session.commit()
+        save_changes(availability, self.timestamp)
         return availability
 
 
@@ -212,6 +252,8 @@ class CreateBooking:
     rebooked_from = attr.ib(type=str)
     external_id = attr.ib(type=str)
     order = attr.ib(type=str)
+    effective_start_at = attr.ib(type=datetime, default=None)
+    effective_end_at = attr.ib(type=datetime, default=None)
 
     def run(self):
         new_booking = models.Booking(
@@ -251,6 +293,8 @@ class CreateBooking:
             rebooked_from=self.rebooked_from,
             external_id=self.external_id,
             order=self.order,
+            effective_start_at=self.effective_start_at,
+            effective_end_at=self.effective_end_at,
         )
         db.session.add(new_booking)
         db.session.commit()
@@ -294,10 +338,11 @@ class UpdateBooking:
     rebooked_from = attr.ib(type=str)
     external_id = attr.ib(type=str)
     order = attr.ib(type=str)
+    effective_start_at = attr.ib(type=datetime, default=None)
+    effective_end_at = attr.ib(type=datetime, default=None)
 
     def run(self):
         booking = models.Booking.get(self.booking_id)
-        booking.updated_at = self.timestamp
         booking.voucher_number = self.voucher_number
         booking.display_id = self.display_id
         booking.note_safe_html = self.note_safe_html
@@ -331,7 +376,9 @@ class UpdateBooking:
         booking.rebooked_from = self.rebooked_from
         booking.external_id = self.external_id
         booking.order = self.order
-        db.session.commit()
+        booking.effective_start_at = self.effective_start_at
+        booking.effective_end_at = self.effective_end_at
+        save_changes(booking, self.timestamp)
         return booking
 
 
@@ -394,7 +441,6 @@ class UpdateContact:
     def run(self):
         opt_in = self.is_subscribed_for_email_updates
         contact = models.Contact.get(self.id)
-        contact.updated_at = self.timestamp
         contact.name = self.name
         contact.email = self.email
         contact.phone_country = self.phone_country
@@ -402,7 +448,7 @@ class UpdateContact:
         contact.normalized_phone = self.normalized_phone
         contact.is_subscribed_for_email_updates = opt_in
         contact.language = self.language
-        db.session.commit()
+        save_changes(contact, self.timestamp)
         return contact
 
 
@@ -462,11 +508,10 @@ class UpdateCompany:
 
     def run(self):
         company = models.Company.get(self.short_name)
-        company.updated_at = self.timestamp
         company.name = self.name
         company.currency = self.currency
 
-        db.session.commit()
+        save_changes(company, self.timestamp)
         return company
 
 
@@ -514,9 +559,8 @@ class UpdateCancellationPolicy:
         cp = models.EffectiveCancellationPolicy.get(self.cp_id)
         cp.cutoff = self.cutoff
         cp.cancellation_type = self.cancellation_type
-        cp.updated_at = self.timestamp
 
-        db.session.commit()
+        save_changes(cp, self.timestamp)
         return cp
 
 
@@ -562,11 +606,10 @@ class UpdateCheckinStatus:
 
     def run(self):
         checkin_status = models.CheckinStatus.get(self.checkin_status_id)
-        checkin_status.updated_at = self.timestamp
         checkin_status.checkin_status_type = self.checkin_status_type
         checkin_status.name = self.name
 
-        db.session.commit()
+        save_changes(checkin_status, self.timestamp)
         return checkin_status
 
 
@@ -622,12 +665,11 @@ class UpdateCustomer:
 
     def run(self):
         customer = models.Customer.get(self.customer_id)
-        customer.updated_at = self.timestamp
         customer.checkin_url = self.checkin_url
         customer.checkin_status_id = self.checkin_status_id
         customer.customer_type_rate_id = self.customer_type_rate_id
         customer.booking_id = self.booking_id
-        db.session.commit()
+        save_changes(customer, self.timestamp)
         return customer
 
 
@@ -688,7 +730,6 @@ class UpdateCustomerTypeRate:
 
     def run(self):
         ctr = models.CustomerTypeRate.get(self.ctr_id)
-        ctr.updated_at = self.timestamp
         ctr.capacity = self.capacity
         ctr.minimum_party_size = self.minimum_party_size
         ctr.maximum_party_size = self.maximum_party_size
@@ -697,7 +738,7 @@ class UpdateCustomerTypeRate:
         ctr.availability_id = self.availability_id
         ctr.customer_prototype_id = self.customer_prototype_id
         ctr.customer_type_id = self.customer_type_id
-        db.session.commit()
+        save_changes(ctr, self.timestamp)
         return ctr
 
 
@@ -746,13 +787,12 @@ class UpdateCustomerPrototype:
 
     def run(self):
         customer_prototype = models.CustomerPrototype.get(self.customer_prototype_id)
-        customer_prototype.updated_at = self.timestamp
         customer_prototype.total = self.total
         customer_prototype.total_including_tax = self.total_including_tax
         customer_prototype.display_name = self.display_name
         customer_prototype.note = self.note
 
-        db.session.commit()
+        save_changes(customer_prototype, self.timestamp)
         return customer_prototype
 
 
@@ -798,12 +838,11 @@ class UpdateCustomerType:
 
     def run(self):
         customer_type = models.CustomerType.get(self.customer_type_id)
-        customer_type.updated_at = self.timestamp
         customer_type.note = self.note
         customer_type.singular = self.singular
         customer_type.plural = self.plural
 
-        db.session.commit()
+        save_changes(customer_type, self.timestamp)
         return customer_type
 
 
@@ -898,7 +937,6 @@ class UpdateCustomField:
 
     def run(self):
         cf = models.CustomField.get(self.custom_field_id)
-        cf.updated_at = self.timestamp
         cf.title = self.title
         cf.name = self.name
         cf.modifier_kind = self.modifier_kind
@@ -915,7 +953,7 @@ class UpdateCustomField:
         cf.is_always_per_customer = self.is_always_per_customer
         cf.extended_options = self.extended_options
 
-        db.session.commit()
+        save_changes(cf, self.timestamp)
         return cf
 
 
@@ -964,12 +1002,11 @@ class UpdateCustomFieldInstance:
         custom_field_instance = models.CustomFieldInstance.get(
             self.custom_field_instance_id
         )
-        custom_field_instance.updated_at = self.timestamp
         custom_field_instance.custom_field_id = self.custom_field_id
         custom_field_instance.availability_id = self.availability_id
         custom_field_instance.customer_type_rate_id = self.customer_type_rate_id
         custom_field_instance.clean()
-        db.session.commit()
+        save_changes(custom_field_instance, self.timestamp)
         return custom_field_instance
 
 
@@ -1025,7 +1062,6 @@ class UpdateCustomFieldValue:
 
     def run(self):
         cfv = models.CustomFieldValue.get(self.custom_field_value_id)
-        cfv.updated_at = self.timestamp
         cfv.name = self.name
         cfv.value = self.value
         cfv.display_value = self.display_value
@@ -1033,7 +1069,7 @@ class UpdateCustomFieldValue:
         cfv.booking_id = self.booking_id
         cfv.customer_id = self.customer_id
         cfv.clean()
-        db.session.commit()
+        save_changes(cfv, self.timestamp)
         return cfv
 
 
@@ -1068,19 +1104,66 @@ class CreateBike:
         return new_bike
 
 
-def bikes_in_use(target_bikes, target_timestamp):
-    """Determine which of the given bikes are in use at the moment if any."""
+def get_effective_period(b_data):
+    """
+    Tell when the bikes of the booking contained in the data are taken and given back.
 
-    raw_sql = text(
-        BIKES_IN_USE_QUERY.format(
-            target_timestamp=target_timestamp,
-            rentals_ids=tuple(current_app.config["BIKE_TRACKER_ITEMS"]["rentals"]),
+    For tours that's the availability itself, but the availabilities of the rentals last
+    half an hour and the customer types tell how long the bikes are kept, so the longest of
+    them is taken. The rentals without known customer types keep the availability end.
+    """
+    av_data = b_data["availability"]
+    start_at = parse_timestamp(av_data["start_at"])
+    end_at = parse_timestamp(av_data["end_at"])
+    if av_data["item"]["pk"] in current_app.config["BIKE_TRACKER_ITEMS"]["rentals"]:
+        durations = current_app.config["RENTAL_USAGE_MAP"]
+        customer_types = (
+            c_data["customer_type_rate"]["customer_type"]["pk"]
+            for c_data in b_data["customers"]
         )
-    )
-    q = db.session.execute(raw_sql)
+        hours = [Decimal(durations[ct]) for ct in customer_types if ct in durations]
+        if hours:
+            end_at = start_at + timedelta(hours=float(max(hours)))
+    return start_at, max(start_at, end_at)
+
+
+def update_effective_periods(config, availability_id=None):
+    """
+    Recompute the effective period of the bookings of an availability, or of all of them.
+
+    It's the period get_effective_period computes, worked out in SQL out of the rows in
+    the db, as the other bookings of an availability must follow when it's rescheduled.
+    Only the bookings whose period differs are updated and their number is returned.
+    The caller commits.
+    """
+    durations = config["RENTAL_USAGE_MAP"]
+    params = {
+        "rental_ids": config["BIKE_TRACKER_ITEMS"]["rentals"],
+        "customer_type_ids": list(durations),
+        "hours": [Decimal(hours) for hours in durations.values()],
+        "availability_id": availability_id,
+    }
+    return db.session.execute(text(EFFECTIVE_PERIOD_UPDATE), params).rowcount
+
+
+def bikes_in_use(target_bikes, target_timestamp):
+    """
+    Determine which of the given bikes are in use at the moment if any.
+
+    The query is prepared the first time it runs on each connection of the pool, the
+    connection info remembers it for the rest of the calls.
+    """
+    connection = db.session.connection()
+    info = connection.connection.info
+    if BIKES_IN_USE_STATEMENT not in info:
+        connection.execute(text(BIKES_IN_USE_QUERY))
+        info[BIKES_IN_USE_STATEMENT] = True
+
+    raw_sql = text(f"EXECUTE {BIKES_IN_USE_STATEMENT} (:target_timestamp)")
+    q = connection.execute(raw_sql, target_timestamp=target_timestamp)
     results = q.fetchall()
 
-    # Results will return something like this: [(None, ), ("some_uuid"), ("some_other_uuid")]
+    # Results will return something like this: [("some_uuid"), ("some_other_uuid")]
     booked_bikes = {bike_uuid for entry in results for bike_uuid in entry if bike_uuid}
     return booked_bikes.intersection(target_bikes)
 
@@ -1105,7 +1188,11 @@ class BikeOperations:
         # can check how many issues this cause. For instance, it could happen that some customer
         # returns the bike before the hour he has allocated and that bike might be used in another
         # service.
-        conflicting_bikes = bikes_in_use(bikes_set, datetime.utcnow())
+        now = datetime.now(timezone.utc)
+        if bike_occupancy.enabled:
+            conflicting_bikes = bike_occupancy.in_use(db.session, bikes_set, now)
+        else:
+            conflicting_bikes = bikes_in_use(bikes_set, now)
         if conflicting_bikes:
             current_app.logger.warning(
                 f"Bike(s) {conflicting_bikes} was/were already in use, continuing."
@@ -1142,6 +1229,7 @@ class CreateBikeUsages(BikeOperations):
         # to availabilities.
         self.availability.bike_usages = bikes.all()
         db.session.commit()
+        bike_occupancy.reload_availability(db.session, self.availability.id)
         return Result.from_success(self.availability)
 
 
@@ -1171,7 +1259,7 @@ class UpdateBikeUsage(BikeOperations):
         if self.errors:
             return Result.from_failure(self.errors)
 
-        self._check_conflicting_bikes(set(self.bike_picked_uuid))
+        self._check_conflicting_bikes({self.bike_picked_uuid})
 
         # If the bike was not in the availability notify the user.
         av = self.availability
@@ -1184,4 +1272,5 @@ class UpdateBikeUsage(BikeOperations):
 
         av.bike_usages.append(bike_picked)
         db.session.commit()
+        bike_occupancy.reload_availability(db.session, av.id)
         return Result.from_success(av)
@@ -4,6 +4,7 @@ from sqlalchemy import MetaData
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy_json import mutable_json_type
 
+from .cache import reference_cache
 from .exceptions import DoesNotExist
 
 metadata = MetaData()
@@ -17,6 +18,13 @@ class BaseMixin:
     created_at = db.Column(db.DateTime(timezone=True), nullable=False)
     updated_at = db.Column(db.DateTime(timezone=True), nullable=False)
 
+    # Whether the instances are kept in the reference cache.
+    cached = False
+
+    @property
+    def cache_key(self):
+        return self.id
+
     @classmethod
     def get(cls, id):
         """
@@ -37,6 +45,10 @@ class BaseMixin:
 
         This method is a wrapper of query.get() that is less readable.
         """
+        if cls.cached:
+            return reference_cache.get_or_load(
+                db.session, cls, id, lambda: cls.query.get(id)
+            )
         return cls.query.get(id)
 
 
@@ -47,13 +59,67 @@ class StoredRequest(db.Model, BaseMixin):
     The target of this model is to spot files that are not correctly processed
     as they will show created_at field but not processed_at one. Also we might
     want to avoid processing a file twice when populating the database.
+
+    The content hash identifies the state of the booking sent, so redeliveries
+    of the same state can be spotted.
+
+    Each failed attempt to process a request is counted, and the next one is
+    not tried before retry_at.
     """
 
     __table_name__ = "stored_request"
+    # The requests waiting to be processed are a tiny part of the table. The requests of a
+    # booking are looked up newest first, see services.is_redelivery.
+    __table_args__ = (
+        db.Index(
+            "ix_stored_request_unprocessed",
+            "created_at",
+            "id",
+            postgresql_where=db.text("processed_at IS NULL"),
+        ),
+        db.Index(
+            "ix_stored_request_booking_id_created_at", "booking_id", "created_at", "id"
+        ),
+    )
     id = db.Column(db.BigInteger, primary_key=True)
     processed_at = db.Column(db.DateTime(timezone=True), nullable=True)
     filename = db.Column(db.String(64))
     body = db.Column(db.Text)
+    booking_id = db.Column(db.BigInteger)
+    content_hash = db.Column(db.String(64), index=True)
+    failures = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    last_error = db.Column(db.Text)
+    retry_at = db.Column(db.DateTime(timezone=True))
+
+
+class ReplayCheckpoint(db.Model, BaseMixin):
+    """
+    Keep how far PopulateDB got replaying an archive.
+
+    Every request archived up to `archived_at` (a unix timestamp) has already
+    been replayed, so an interrupted replay resumes right after it. The id
+    names the archive replayed.
+    """
+
+    __table_name__ = "replay_checkpoint"
+    id = db.Column(db.String(255), primary_key=True)
+    archived_at = db.Column(db.Float, nullable=False)
+
+
+class ArchiveEntry(db.Model, BaseMixin):
+    """
+    Index the archived requests by booking.
+
+    The name is the one of the request in the archive (the loose file or the
+    journal record) and created_at the time it was archived, so the history
+    of a booking can be read back in order without scanning the archive.
+    """
+
+    __table_name__ = "archive_entry"
+    name = db.Column(db.String(64), primary_key=True)
+    booking_id = db.Column(db.BigInteger, index=True)
+    booking_uuid = db.Column(db.String(40), index=True)
+    availability_id = db.Column(db.BigInteger, index=True)
 
 
 class Booking(db.Model, BaseMixin):
@@ -65,6 +131,15 @@ class Booking(db.Model, BaseMixin):
     """
 
     __table_name__ = "booking"
+    # The bike tracker looks for the bookings going on at some point.
+    __table_args__ = (
+        db.Index(
+            "ix_booking_effective_period",
+            db.text("tstzrange(effective_start_at, effective_end_at, '[]')"),
+            postgresql_using="gist",
+            postgresql_where=db.text("effective_start_at IS NOT NULL"),
+        ),
+    )
     id = db.Column(db.BigInteger, primary_key=True)
     voucher_number = db.Column(db.String(64))
     display_id = db.Column(db.String(64), nullable=False)
@@ -105,6 +180,10 @@ class Booking(db.Model, BaseMixin):
     MutableJson = mutable_json_type(dbtype=JSONB, nested=False)
     order = db.Column(MutableJson)
 
+    # When the bikes are taken and given back, see model_services.get_effective_period.
+    effective_start_at = db.Column(db.DateTime(timezone=True))
+    effective_end_at = db.Column(db.DateTime(timezone=True))
+
     # Foreign key fields
     availability_id = db.Column(
         db.BigInteger, db.ForeignKey("availability.id"), nullable=False
@@ -160,6 +239,10 @@ class Availability(db.Model, BaseMixin):
     """
 
     __table_name__ = "availability"
+    # The bike tracker looks for the availabilities of some items in a day.
+    __table_args__ = (
+        db.Index("ix_availability_start_at_item_id", "start_at", "item_id"),
+    )
     id = db.Column(db.BigInteger, primary_key=True)
     capacity = db.Column(db.Integer, nullable=False)
     minimum_party_size = db.Column(db.SmallInteger)
@@ -186,6 +269,7 @@ class Item(db.Model, BaseMixin):
     """Items are the products we sell in the business."""
 
     __table_name__ = "item"
+    cached = True
     id = db.Column(db.BigInteger, primary_key=True)
     name = db.Column(db.String(200))
 
@@ -195,6 +279,7 @@ class Item(db.Model, BaseMixin):
 
 class CheckinStatus(db.Model, BaseMixin):
     __table_name__ = "checkin_status"
+    cached = True
     id = db.Column(db.BigInteger, primary_key=True)
     checkin_status_type = db.Column(db.String(64))
     name = db.Column(db.String(64))
@@ -262,6 +347,7 @@ class CustomerPrototype(db.Model, BaseMixin):
     """
 
     __table_name__ = "customer_prototype"
+    cached = True
     id = db.Column(db.BigInteger, primary_key=True)
     total = db.Column(db.Integer)
     total_including_tax = db.Column(db.Integer)
@@ -277,6 +363,7 @@ class CustomerType(db.Model, BaseMixin):
     """
 
     __table_name__ = "customer_type"
+    cached = True
     id = db.Column(db.BigInteger, primary_key=True)
     note = db.Column(db.Text)
     singular = db.Column(db.String(64), nullable=False)
@@ -357,6 +444,7 @@ class CustomField(db.Model, BaseMixin):
     """Store the types of custom fields available."""
 
     __table_name__ = "custom_field"
+    cached = True
     id = db.Column(db.BigInteger, primary_key=True)
     title = db.Column(db.String(64))
     name = db.Column(db.String(64), nullable=False)
@@ -410,6 +498,7 @@ class Company(db.Model, BaseMixin):
     """
 
     __table_name__ = "company"
+    cached = True
     id = db.Column(db.BigInteger, primary_key=True)
     name = db.Column(db.String(256), nullable=False)
     short_name = db.Column(db.String(64), nullable=False, unique=True)
@@ -431,7 +520,16 @@ class Company(db.Model, BaseMixin):
 
         This method is a wrapper of query.get() that is less readable.
         """
-        return cls.query.filter_by(short_name=short_name).first()
+        return reference_cache.get_or_load(
+            db.session,
+            cls,
+            short_name,
+            lambda: cls.query.filter_by(short_name=short_name).first(),
+        )
+
+    @property
+    def cache_key(self):
+        return self.short_name
 
 
 class EffectiveCancellationPolicy(db.Model, BaseMixin):
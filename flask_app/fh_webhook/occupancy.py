@@ -0,0 +1,148 @@
+"""
+Keep the periods the bikes are in use in memory.
+
+The bike tracker checks whether the bikes are already in use each time bikes
+are added to or replaced in an availability, and during the morning rush those
+checks run back to back against the same data. So each worker keeps an index
+of the periods of the bikes around now (see Booking.effective_start_at):
+
+* the periods overlapping the window, some hours before and after now, are
+  loaded from the db in one query;
+* the usages of an availability are reloaded alone when the bike tracker
+  commits them, so the index follows the changes of the worker;
+* the whole index is reloaded after a TTL, to pick up the changes committed by
+  the other workers and by FH (cancelled, rebooked or rescheduled bookings).
+"""
+import threading
+import time
+from bisect import bisect_right
+from datetime import timedelta
+
+import attr
+from sqlalchemy import text
+
+from . import metrics
+
+OCCUPANCY_QUERY = """
+SELECT bk.uuid, b.availability_id, b.effective_start_at, b.effective_end_at
+FROM booking b
+JOIN bike_usages bu ON bu.availability_id = b.availability_id
+JOIN bike bk ON bk.id = bu.bike_id
+WHERE b.rebooked_to IS NULL AND b.status != 'cancelled'
+    AND b.effective_start_at IS NOT NULL
+    AND tstzrange(b.effective_start_at, b.effective_end_at, '[]')
+        && tstzrange(:window_start, :window_end, '[]')
+"""
+
+
+@attr.s
+class BikePeriods:
+    """
+    The periods of a bike sorted by start, along with the latest end seen so far.
+
+    A bike is in use at some point if one of the periods started before ends
+    after it, which is the latest end of the periods started before, so it's
+    found with a bisection.
+    """
+
+    periods = attr.ib(type=list, factory=list)
+
+    def __attrs_post_init__(self):
+        self._index()
+
+    def _index(self):
+        self.starts = [start for start, end, availability_id in self.periods]
+        self.latest_ends, latest = list(), None
+        for start, end, availability_id in self.periods:
+            latest = end if latest is None else max(latest, end)
+            self.latest_ends.append(latest)
+
+    def extend(self, periods):
+        self.periods = sorted(self.periods + periods)
+        self._index()
+
+    def discard(self, availability_id):
+        self.periods = [p for p in self.periods if p[2] != availability_id]
+        self._index()
+
+    def in_use(self, at):
+        n = bisect_right(self.starts, at)
+        return n > 0 and self.latest_ends[n - 1] >= at
+
+
+@attr.s
+class BikeOccupancy:
+    """A thread safe index of the periods each bike is in use around now."""
+
+    ttl = attr.ib(type=float, default=60)
+    window = attr.ib(type=timedelta, default=timedelta(hours=12))
+
+    def __attrs_post_init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def configure(self, ttl, window):
+        with self._lock:
+            self.ttl, self.window = ttl, window
+        self.clear()
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def clear(self):
+        with self._lock:
+            self._bikes, self._availabilities = dict(), dict()
+            self.window_start = self.window_end = None
+            self._expires = 0
+
+    def _add(self, rows):
+        periods = dict()
+        for uuid, availability_id, start, end in rows:
+            periods.setdefault(uuid, list()).append((start, end, availability_id))
+            self._availabilities.setdefault(availability_id, set()).add(uuid)
+        for uuid, bike_periods in periods.items():
+            self._bikes.setdefault(uuid, BikePeriods()).extend(bike_periods)
+
+    def reload(self, session, at):
+        """Load the periods overlapping the window around `at`."""
+        params = {"window_start": at - self.window, "window_end": at + self.window}
+        rows = session.execute(text(OCCUPANCY_QUERY), params).fetchall()
+        with self._lock:
+            self._bikes, self._availabilities = dict(), dict()
+            self._add(rows)
+            self.window_start = params["window_start"]
+            self.window_end = params["window_end"]
+            self._expires = time.monotonic() + self.ttl
+        metrics.increment("bike_occupancy.reloads")
+
+    def reload_availability(self, session, availability_id):
+        """Replace the periods of the bikes of an availability with the ones in the db."""
+        if self.window_start is None:
+            return
+        stmt = text(OCCUPANCY_QUERY + "AND b.availability_id = :availability_id")
+        params = {
+            "window_start": self.window_start,
+            "window_end": self.window_end,
+            "availability_id": availability_id,
+        }
+        rows = session.execute(stmt, params).fetchall()
+        with self._lock:
+            for uuid in self._availabilities.pop(availability_id, ()):
+                self._bikes[uuid].discard(availability_id)
+            self._add(rows)
+
+    def in_use(self, session, bike_uuids, at):
+        """Return which of the bikes are in use at some point."""
+        stale = time.monotonic() >= self._expires
+        if stale or not self.window_start <= at <= self.window_end:
+            self.reload(session, at)
+        with self._lock:
+            return {
+                uuid
+                for uuid in bike_uuids
+                if uuid in self._bikes and self._bikes[uuid].in_use(at)
+            }
+
+
+bike_occupancy = BikeOccupancy()
@@ -1,44 +1,52 @@
-BIKES_IN_USE_QUERY = """
+BIKES_IN_USE_STATEMENT = "bikes_in_use"
+
+# Prepared once per connection (see model_services.bikes_in_use), so the plan
+# can be reused across calls. $1 is the target timestamp.
+BIKES_IN_USE_QUERY = f"""
+    PREPARE {BIKES_IN_USE_STATEMENT} (timestamptz) AS
     -- Redash query: 105
     SELECT distinct bk.uuid
     FROM booking b
-    LEFT JOIN availability av ON b.availability_id = av.id
-    LEFT JOIN customer c ON c.booking_id = b.id
-    LEFT JOIN customer_type_rate ctr ON ctr.id = c.customer_type_rate_id
-    LEFT JOIN customer_type ct ON ct.id = ctr.customer_type_id
-
-    LEFT JOIN bike_usages bu ON bu.availability_id = av.id
-    LEFT JOIN bike bk ON bk.id = bu.bike_id
+    JOIN bike_usages bu ON bu.availability_id = b.availability_id
+    JOIN bike bk ON bk.id = bu.bike_id
     WHERE
         -- The usual filters for bookings: either won't happen or happening at some other
         -- point in th the future.
-        b.rebooked_to IS NULL AND b.status != 'cancelled' 
-
-        -- Filter now depending the type of service. For tours we can rely on availability end
-        -- date. But for rentals is sigthly more tricky as availabilities last .5h and
-        -- durations are represented by customer types
+        b.rebooked_to IS NULL AND b.status != 'cancelled'
 
-        AND (
-                (
-                    -- Happy path: tours (excluding walkings)
-                    av.item_id IN (159053, 159055, 159056, 159057, 159058, 159060)
-                    AND '{target_timestamp}' BETWEEN av.start_at AND av.end_at
-                )
+        -- The effective period tells when the bikes are taken and given back, either the
+        -- availability for tours or the duration given by the customer types for rentals.
+        -- It's served by the ix_booking_effective_period index.
+        AND b.effective_start_at IS NOT NULL
+        AND tstzrange(b.effective_start_at, b.effective_end_at, '[]') @> $1
+"""
 
-                OR
-                (
-                    -- Unhappy path: rentals
-                    av.item_id IN {rentals_ids}  -- rentals
-                    AND (
-                        (ct.id = 314997 AND '{target_timestamp}' BETWEEN av.start_at AND av.start_at + interval '2 hours')
-                        OR (ct.id = 314998 AND '{target_timestamp}' BETWEEN av.start_at AND av.start_at + interval '4 hours')
-                        OR (ct.id = 314999 AND '{target_timestamp}' BETWEEN av.start_at AND av.start_at + interval '8 hours')
-                        OR (ct.id = 315000 AND '{target_timestamp}' BETWEEN av.start_at AND av.start_at + interval '24 hours')
-                        OR (ct.id = 315001 AND '{target_timestamp}' BETWEEN av.start_at AND av.start_at + interval '2 days')
-                        OR (ct.id = 315002 AND '{target_timestamp}' BETWEEN av.start_at AND av.start_at + interval '7 days')
-                        OR (ct.id = 315003 AND '{target_timestamp}' BETWEEN av.start_at AND av.start_at + interval '24 hours')  -- Extra day
-                        OR (ct.id = 601300 AND '{target_timestamp}' BETWEEN av.start_at AND av.start_at + interval '10 days')
-                    )
-                )
-            )
+# The effective period of the bookings worked out of the availabilities and customers in
+# the db, see model_services.update_effective_periods. Only the bookings of :availability_id
+# are recomputed unless it's NULL.
+EFFECTIVE_PERIOD_UPDATE = """
+WITH periods AS (
+    SELECT b.id, av.start_at AS effective_start_at, greatest(
+        av.start_at,
+        CASE WHEN av.item_id = ANY(:rental_ids) THEN coalesce(
+            av.start_at + max(d.hours) * interval '1 hour', av.end_at
+        ) ELSE av.end_at END
+    ) AS effective_end_at
+    FROM booking b
+    JOIN availability av ON av.id = b.availability_id
+    LEFT JOIN customer c ON c.booking_id = b.id
+    LEFT JOIN customer_type_rate ctr ON ctr.id = c.customer_type_rate_id
+    LEFT JOIN unnest(
+        CAST(:customer_type_ids AS bigint[]), CAST(:hours AS numeric[])
+    ) AS d(customer_type_id, hours) ON d.customer_type_id = ctr.customer_type_id
+    WHERE CAST(:availability_id AS bigint) IS NULL OR b.availability_id = :availability_id
+    GROUP BY b.id, av.start_at, av.end_at, av.item_id
+)
+UPDATE booking SET
+    effective_start_at = periods.effective_start_at,
+    effective_end_at = periods.effective_end_at
+FROM periods
+WHERE booking.id = periods.id
+    AND (booking.effective_start_at, booking.effective_end_at)
+        IS DISTINCT FROM (periods.effective_start_at, periods.effective_end_at)
 """
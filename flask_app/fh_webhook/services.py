@@ -1,7 +1,12 @@
+import hashlib
 import json
 import logging
+import multiprocessing
 import os
-from datetime import datetime, timezone
+import queue
+import time
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta, timezone
 from email.message import EmailMessage
 from email.utils import localtime
 from logging import LogRecord
@@ -10,13 +15,25 @@ from smtplib import SMTP_SSL
 from ssl import create_default_context
 
 import attr
-from sqlalchemy.exc import OperationalError
+from flask import current_app
+from marshmallow import ValidationError
+from sqlalchemy import and_, func, or_, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import OperationalError, SQLAlchemyError
 
-from . import model_services, models
+from . import archive, bulk_services, metrics, model_services, models
+from .exceptions import ReplayWorkerDied
+from .identity_map import IdentityMap
+from .validators import validate_booking
 
 logger = logging.getLogger(__name__)
 
 
+def get_request_id(unix_timestamp):
+    """Get the unique id of a request out of the timestamp it was received."""
+    return int(str(unix_timestamp).replace(".", ""))
+
+
 def get_request_id_or_none(filename):
     """Get a unique id out of a filename."""
     if filename.endswith(".json"):
@@ -25,58 +42,382 @@ def get_request_id_or_none(filename):
 
 class PopulateDB:
     """
-    Populate the database using json files.
-
-    For the last months we were collecting FH responses in JSON files, this
-    service populates the database with such responses.
+    Populate the database using the archived responses.
+
+    For the last months we were collecting FH responses in JSON files, and
+    then in the journal, this service populates the database with such
+    responses.
+
+    With several `workers` the archive is replayed by that many processes,
+    each with its own db connection. The records are partitioned by booking
+    pk, so all the snapshots of a booking are still applied in time order by
+    the same worker while different bookings are written concurrently. As the
+    rows shared among bookings (items, availabilities, companies, custom
+    fields...) may then arrive out of order, they are upserted in unordered
+    mode, where an older snapshot never overwrites a newer one. A record that
+    fails is logged and left unprocessed rather than stopping the replay, but
+    a worker that dies aborts it with ReplayWorkerDied.
+
+    The ids of the requests already stored are loaded at once to skip them
+    without asking the db for each record. As the replay goes on, the
+    timestamp up to which every record is done is saved as a checkpoint, so
+    an interrupted replay resumes there rather than reading the whole archive
+    again, unless `resume` is False.
+
+    In `compact` mode a first pass over the archive finds the newest snapshot
+    of each booking and of each availability, and only those are replayed,
+    in time order, with the rows created at the time the booking was first
+    seen. The rows only found in older snapshots (e.g. a customer removed
+    from the booking) are not created then. The superseded requests are still
+    stored, in bulk and closed, when `audit` is set.
     """
 
-    def __init__(self, app):
+    # Postgres error code for deadlocks, the transactions are retried then.
+    DEADLOCK = "40P01"
+    RETRIES = 3
+    # Records waiting in each worker's queue.
+    QUEUE_SIZE = 100
+    # Seconds between the progress reports of the parallel replay.
+    PROGRESS_INTERVAL = 10
+    # Records done between the saves of the checkpoint.
+    CHECKPOINT_INTERVAL = 1000
+    # Superseded requests stored per insert in audit mode.
+    AUDIT_BATCH_SIZE = 500
+
+    def __init__(self, app, workers=1, resume=True, compact=False, audit=False):
         """
         Class constructor.
 
         We need the app instance to get the path where the files are stored.
         """
         self.path = app.config.get("RESPONSES_PATH")
-        self.processed, self.skipped = 0, 0
+        self.journal_path = app.config.get("JOURNAL_PATH")
+        self.archive_name = f"{self.path}:{self.journal_path}"
+        self.workers = workers
+        self.resume = resume
+        self.compact, self.audit = compact, audit
+        self.processed, self.skipped, self.failed, self.compacted = 0, 0, 0, 0
+        self.stored_ids = None
+        self.superseded, self.first_seen = set(), None
+        self.audit_rows = list()
         self.logger = app.logger
 
-    @staticmethod
-    def _request_exists(request_id):
-        return models.StoredRequest.get_object_or_none(request_id)
+    def _load_stored_ids(self):
+        """Load the ids of the stored requests streaming them in one query."""
+        query = models.db.session.query(models.StoredRequest.id).yield_per(10_000)
+        self.stored_ids = {request_id for request_id, in query}
 
-    def _process_file(self, f):
-        request_id = get_request_id_or_none(f)
-        if request_id and not self._request_exists(request_id):
-            unix_timestamp = float(f.replace(".json", ""))
-            timestamp = datetime.fromtimestamp(unix_timestamp, tz=timezone.utc)
-            filename = os.path.join(self.path, f)
-            with open(filename, "r") as response:
-                data = json.load(response)
-            if data.get("booking"):
-                stored_request = model_services.CreateStoredRequest(
-                    request_id=request_id,
-                    filename=f,
-                    body=json.dumps(data),
-                    timestamp=timestamp,
+    def _request_exists(self, request_id):
+        if self.stored_ids is None:
+            self._load_stored_ids()
+        return request_id in self.stored_ids
+
+    def _load_checkpoint(self):
+        """Return the timestamp to resume the replay after, if any."""
+        self.archived_at = None
+        if not self.resume:
+            return None
+        checkpoint = models.ReplayCheckpoint.get_object_or_none(self.archive_name)
+        if checkpoint:
+            self.archived_at = checkpoint.archived_at
+            self.logger.info(f"Resuming the replay after {self.archived_at}")
+        return self.archived_at
+
+    def _save_checkpoint(self):
+        # The checkpoint can't get past the requests not stored yet.
+        self._insert_audit_rows()
+        self.since_checkpoint = 0
+        if self.archived_at is None:
+            return
+        now = datetime.now(timezone.utc)
+        stmt = insert(models.ReplayCheckpoint.__table__).values(
+            id=self.archive_name,
+            archived_at=self.archived_at,
+            created_at=now,
+            updated_at=now,
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["id"],
+            set_={
+                "archived_at": stmt.excluded.archived_at,
+                "updated_at": stmt.excluded.updated_at,
+            },
+        )
+        models.db.session.execute(stmt)
+        models.db.session.commit()
+
+    def _finish(self, n):
+        """Mark the nth record as done, moving the checkpoint past the ones done in order."""
+        self.finished.add(n)
+        while self.pending and next(iter(self.pending)) in self.finished:
+            done, self.archived_at = self.pending.popitem(last=False)
+            self.finished.remove(done)
+        self.since_checkpoint += 1
+        if self.since_checkpoint >= self.CHECKPOINT_INTERVAL:
+            self._save_checkpoint()
+
+    def _log_progress(self, logger):
+        seen = self.processed + self.skipped + self.failed + self.compacted
+        elapsed = time.monotonic() - self.started
+        rate = seen / elapsed if elapsed else 0
+        logger.info(
+            f"Processed {self.processed} requests ({self.skipped} skipped, "
+            + f"{self.compacted} compacted, {self.failed} failed), "
+            + f"{rate:.1f} files/sec"
+        )
+
+    def _find_superseded(self, since):
+        """
+        Scan the archive for the records superseded by a newer snapshot.
+
+        A record is kept when it's the newest snapshot of its booking or of
+        its availability, as it decides the final state of their rows. Also
+        keep when each booking was first seen.
+        """
+        latest, names, self.first_seen = dict(), list(), dict()
+        for record in archive.read_archive(self.path, self.journal_path, since):
+            booking = record.extract(*archive.BOOKING_KEYS).get("booking")
+            if not booking:
+                continue
+            names.append(record.name)
+            booking_pk = booking.get("pk")
+            self.first_seen.setdefault(booking_pk, record.timestamp)
+            latest[(models.Booking, booking_pk)] = record.name
+            av_pk = (booking.get("availability") or {}).get("pk")
+            latest[(models.Availability, av_pk)] = record.name
+        kept = set(latest.values())
+        self.superseded = {name for name in names if name not in kept}
+        self.logger.info(
+            f"Replaying {len(kept)} of {len(names)} snapshots, "
+            + f"{len(self.superseded)} are superseded"
+        )
+
+    def _insert_audit_rows(self):
+        if not self.audit_rows:
+            return
+        stmt = insert(models.StoredRequest.__table__).values(self.audit_rows)
+        models.db.session.execute(stmt.on_conflict_do_nothing(index_elements=["id"]))
+        models.db.session.commit()
+        self.audit_rows = list()
+
+    def _skip_superseded(self, n, record):
+        """Tell whether the record is superseded, storing it for audit if asked."""
+        if record.name not in self.superseded:
+            return False
+        request_id = get_request_id(record.timestamp)
+        if self.audit and not self._request_exists(request_id):
+            data = record.load()
+            timestamp = datetime.fromtimestamp(record.timestamp, tz=timezone.utc)
+            self.audit_rows.append(
+                {
+                    "id": request_id,
+                    "created_at": timestamp,
+                    "updated_at": timestamp,
+                    "processed_at": datetime.now(timezone.utc),
+                    "filename": record.name,
+                    "body": record.body.decode(),
+                    "booking_id": data["booking"].get("pk"),
+                    "content_hash": get_content_hash(data),
+                }
+            )
+            self.stored_ids.add(request_id)
+            if len(self.audit_rows) >= self.AUDIT_BATCH_SIZE:
+                self._insert_audit_rows()
+        self.compacted += 1
+        self._finish(n)
+        return True
+
+    def _process_record(self, record):
+        request_id = get_request_id(record.timestamp)
+        if self._request_exists(request_id):
+            self.skipped += 1
+        else:
+            self._save_record(record, request_id)
+
+    def _process_data(self, data, timestamp):
+        if self.workers == 1 and self.first_seen is None:
+            return ProcessJSONResponse(data, timestamp).run()
+        created_at = None
+        if self.first_seen is not None:
+            first_seen = self.first_seen[data["booking"].get("pk")]
+            created_at = datetime.fromtimestamp(first_seen, tz=timezone.utc)
+        for attempt in range(1, self.RETRIES + 1):
+            try:
+                return bulk_services.BulkUpsertJSONResponse(
+                    data, timestamp, unordered=self.workers > 1, created_at=created_at
                 ).run()
-                ProcessJSONResponse(data, timestamp).run()
-                model_services.CloseStoredRequest(stored_request).run()
-                self.processed += 1
-            else:
-                self.skipped += 1
+            except OperationalError as e:
+                deadlock = getattr(e.orig, "pgcode", None) == self.DEADLOCK
+                if not deadlock or attempt == self.RETRIES:
+                    raise
+                self.logger.info(
+                    f"Deadlock saving booking {data['booking']['pk']}, retrying"
+                )
+
+    def _save_record(self, record, request_id):
+        timestamp = datetime.fromtimestamp(record.timestamp, tz=timezone.utc)
+        data = record.load()
+        if data.get("booking"):
+            stored_request = model_services.CreateStoredRequest(
+                request_id=request_id,
+                filename=record.name,
+                body=record.body.decode(),
+                timestamp=timestamp,
+                booking_id=data["booking"].get("pk"),
+                content_hash=get_content_hash(data),
+            ).run()
+            if self.stored_ids is not None:
+                self.stored_ids.add(request_id)
+            self._process_data(data, timestamp)
+            model_services.CloseStoredRequest(stored_request).run()
+            self.processed += 1
         else:
             self.skipped += 1
 
+    def _process_file(self, f):
+        """Process a loose JSON file in the responses path."""
+        unix_timestamp = archive.get_file_timestamp(f)
+        if unix_timestamp is None:
+            self.skipped += 1
+            return
+        request_id = get_request_id(unix_timestamp)
+        if self._request_exists(request_id):
+            self.skipped += 1
+            return
+        with open(os.path.join(self.path, f), "rb") as response:
+            body = response.read()
+        self._save_record(archive.ArchiveRecord(unix_timestamp, f, body), request_id)
+
+    def _partition(self, record):
+        """Return the worker for the record, None if it has no booking to replay."""
+        booking = record.extract("booking.pk").get("booking")
+        if not booking:
+            return None
+        return hash(booking.get("pk")) % self.workers
+
+    def _replay_partition(self, records, results):
+        """Replay the records sent to a worker, reporting the outcome of each."""
+        for n, record, request_id in iter(records.get, None):
+            processed = self.processed
+            try:
+                self._save_record(record, request_id)
+            except Exception as e:
+                models.db.session.rollback()
+                self.logger.error(f"Record {record.name} failed, error={e}")
+                outcome = "failed"
+            else:
+                outcome = "processed" if self.processed > processed else "skipped"
+            results.put((outcome, n))
+        results.put(None)
+
+    def _count(self, outcome, n):
+        setattr(self, outcome, getattr(self, outcome) + 1)
+        self._finish(n)
+        if time.monotonic() - self.last_report >= self.PROGRESS_INTERVAL:
+            self.last_report = time.monotonic()
+            self._log_progress(self.logger)
+
+    def _collect_results(self, results):
+        while True:
+            try:
+                outcome = results.get_nowait()
+            except queue.Empty:
+                return
+            self._count(*outcome)
+
+    def _send(self, process, records, item, results):
+        """Queue an item for a worker, failing if the worker is gone."""
+        while True:
+            try:
+                records.put(item, timeout=self.PROGRESS_INTERVAL)
+                return
+            except queue.Full:
+                if not process.is_alive():
+                    raise ReplayWorkerDied(process.name, process.exitcode)
+                self._collect_results(results)
+
+    def _run_parallel(self, records):
+        context = multiprocessing.get_context("fork")
+        partitions = [context.Queue(self.QUEUE_SIZE) for _ in range(self.workers)]
+        results = context.Queue()
+        # The forked workers must open connections of their own.
+        models.db.session.remove()
+        models.db.engine.dispose()
+        processes = [
+            context.Process(target=self._replay_partition, args=(records, results))
+            for records in partitions
+        ]
+        for process in processes:
+            process.start()
+
+        self.last_report = time.monotonic()
+        try:
+            for n, record in records:
+                self.pending[n] = record.timestamp
+                if self._skip_superseded(n, record):
+                    continue
+                request_id = get_request_id(record.timestamp)
+                partition = self._partition(record)
+                if partition is None or self._request_exists(request_id):
+                    self.skipped += 1
+                    self._finish(n)
+                else:
+                    item = (n, record, request_id)
+                    self._send(
+                        processes[partition], partitions[partition], item, results
+                    )
+                self._collect_results(results)
+            for process, records in zip(processes, partitions):
+                self._send(process, records, None, results)
+        except Exception:
+            # The records already queued are lost along with the workers, the
+            # checkpoint stays before them.
+            for process in processes:
+                process.terminate()
+                process.join()
+            raise
+
+        finished = 0
+        while finished < self.workers:
+            try:
+                outcome = results.get(timeout=self.PROGRESS_INTERVAL)
+            except queue.Empty:
+                if not any(process.is_alive() for process in processes):
+                    self.logger.error("The replay workers exited unexpectedly.")
+                    break
+                continue
+            if outcome is None:
+                finished += 1
+            else:
+                self._count(*outcome)
+        for process in processes:
+            process.join()
+
     def run(self):
-        files = sorted([f for f in os.listdir(self.path)])
-        for n, f in enumerate(files):
-            if n % 10 == 0:
-                self.logger.info(
-                    f"Processed {self.processed} JSON files ({self.skipped} skipped)"
-                )
-            self._process_file(f)
-        logger.info(f"Processed {self.processed} JSON files ({self.skipped} skipped)")
+        self.started = time.monotonic()
+        self._load_stored_ids()
+        since = self._load_checkpoint()
+        if self.compact:
+            self._find_superseded(since)
+        self.pending, self.finished, self.since_checkpoint = OrderedDict(), set(), 0
+        records = enumerate(archive.read_archive(self.path, self.journal_path, since))
+        try:
+            if self.workers > 1:
+                self._run_parallel(records)
+            else:
+                for n, record in records:
+                    if n % 10 == 0:
+                        self._log_progress(self.logger)
+                    self.pending[n] = record.timestamp
+                    if self._skip_superseded(n, record):
+                        continue
+                    self._process_record(record)
+                    self._finish(n)
+        finally:
+            # Only the record that was being saved when interrupted is lost.
+            models.db.session.rollback()
+            self._save_checkpoint()
+        self._log_progress(logger)
 
 
 @attr.s
@@ -86,6 +427,12 @@ class ProcessJSONResponse:
 
     The constructor argument should be a python object created
     out of the json response in the webhook endpoint or the stored data.
+
+    By default the whole response is saved in one transaction by the bulk
+    engine, set PERSISTENCE_ENGINE to "per_entity" to go through the
+    model services one entity at a time instead. In that case the existing
+    instances are prefetched in an identity map, so the _save_* methods don't
+    need to query the db to choose between create and update services.
     """
 
     data = attr.ib(type=dict)
@@ -94,40 +441,45 @@ class ProcessJSONResponse:
     def _save_item(self):
         """Save the item contained in the data."""
         item_data = self.data["booking"]["availability"]["item"]
-        item = models.Item.get_object_or_none(item_data["pk"])
+        item = self.identity_map.get(models.Item, item_data["pk"])
         if item:
             service = model_services.UpdateItem
         else:
             service = model_services.CreateItem
-        return service(
+        instance = service(
             timestamp=self.timestamp, item_id=item_data["pk"], name=item_data["name"]
         ).run()
+        return self.identity_map.add(models.Item, item_data["pk"], instance)
 
     def _save_availability(self, item_id):
         """Save the availability contained in the data."""
         av_data = self.data["booking"]["availability"]
-        av = models.Availability.get_object_or_none(av_data["pk"])
+        av = self.identity_map.get(models.Availability, av_data["pk"])
+        start_at = model_services.parse_timestamp(av_data["start_at"])
+        end_at = model_services.parse_timestamp(av_data["end_at"])
         if av:
             service = model_services.UpdateAvailability
+            self.rescheduled = (av.start_at, av.end_at) != (start_at, end_at)
         else:
             service = model_services.CreateAvailability
 
-        return service(
+        instance = service(
             availability_id=av_data["pk"],
             timestamp=self.timestamp,
             capacity=av_data["capacity"],
             minimum_party_size=av_data["minimum_party_size"],
             maximum_party_size=av_data["maximum_party_size"],
-            start_at=av_data["start_at"],
-            end_at=av_data["end_at"],
+            start_at=start_at,
+            end_at=end_at,
             headline=av_data.get("headline"),
             item_id=item_id,
         ).run()
+        return self.identity_map.add(models.Availability, av_data["pk"], instance)
 
     def _save_booking(self, av_id, company_id, affiliate_company_id):
         """Save the booking information contained in the data."""
         b_data = self.data["booking"]
-        booking = models.Booking.get_object_or_none(b_data["pk"])
+        booking = self.identity_map.get(models.Booking, b_data["pk"])
         if booking:
             service = model_services.UpdateBooking
         else:
@@ -140,7 +492,10 @@ class ProcessJSONResponse:
 
         cancx = b_data["is_eligible_for_cancellation"]
         sms_opt_in = b_data["is_subscribed_for_sms_updates"]
-        return service(
+        effective_start_at, effective_end_at = model_services.get_effective_period(
+            b_data
+        )
+        instance = service(
             booking_id=b_data["pk"],
             voucher_number=b_data["voucher_number"],
             display_id=b_data["display_id"],
@@ -176,21 +531,24 @@ class ProcessJSONResponse:
             rebooked_from=b_data["rebooked_from"],
             external_id=b_data["external_id"],
             order=b_data["order"],
+            effective_start_at=effective_start_at,
+            effective_end_at=effective_end_at,
         ).run()
+        return self.identity_map.add(models.Booking, b_data["pk"], instance)
 
     def _save_contact(self, booking_id):
         """
         Save the contact information contained in the data.
         """
         c_data = self.data["booking"]["contact"]
-        contact = models.Contact.get_object_or_none(booking_id)
+        contact = self.identity_map.get(models.Contact, booking_id)
         if contact:
             service = model_services.UpdateContact
         else:
             service = model_services.CreateContact
 
         opt_in = c_data["is_subscribed_for_email_updates"]
-        return service(
+        instance = service(
             id=booking_id,
             timestamp=self.timestamp,
             name=c_data["name"],
@@ -201,6 +559,7 @@ class ProcessJSONResponse:
             language=c_data.get("language"),
             is_subscribed_for_email_updates=opt_in,
         ).run()
+        return self.identity_map.add(models.Contact, booking_id, instance)
 
     def _save_company_group(self):
         """
@@ -228,36 +587,40 @@ class ProcessJSONResponse:
         # FH friends were a bit sloopy here
         short_name = c_data.get("shortname") or c_data.get("short_name")
 
-        company = models.Company.get_object_or_none(short_name)
+        company = self.identity_map.get(models.Company, short_name)
         if company:
             service = model_services.UpdateCompany
         else:
             service = model_services.CreateCompany
 
-        return service(
+        instance = service(
             name=c_data["name"],
             short_name=short_name,
             currency=c_data["currency"],
             timestamp=self.timestamp,
         ).run()
+        return self.identity_map.add(models.Company, short_name, instance)
 
     def _save_cancellation_policy(self, booking_id):
         """
         Save cancellation policy information contained in the data.
         """
         c_data = self.data["booking"]["effective_cancellation_policy"]
-        cp = models.EffectiveCancellationPolicy.get_object_or_none(booking_id)
+        cp = self.identity_map.get(models.EffectiveCancellationPolicy, booking_id)
         if cp:
             service = model_services.UpdateCancellationPolicy
         else:
             service = model_services.CreateCancellationPolicy
 
-        return service(
+        instance = service(
             cp_id=booking_id,
-            cutoff=c_data["cutoff"],
+            cutoff=model_services.parse_timestamp(c_data["cutoff"]),
             cancellation_type=c_data["type"],
             timestamp=self.timestamp,
         ).run()
+        return self.identity_map.add(
+            models.EffectiveCancellationPolicy, booking_id, instance
+        )
 
     def _save_customer_type(self, ct_data):
         """
@@ -267,19 +630,20 @@ class ProcessJSONResponse:
         under booking__availability__customer_type_rates arrays, so we should
         iterate through to get all of them.
         """
-        cp = models.CustomerType.get_object_or_none(ct_data["pk"])
+        cp = self.identity_map.get(models.CustomerType, ct_data["pk"])
         if cp:
             service = model_services.UpdateCustomerType
         else:
             service = model_services.CreateCustomerType
 
-        return service(
+        instance = service(
             customer_type_id=ct_data["pk"],
             note=ct_data["note"],
             singular=ct_data["singular"],
             plural=ct_data["plural"],
             timestamp=self.timestamp,
         ).run()
+        return self.identity_map.add(models.CustomerType, ct_data["pk"], instance)
 
     def _save_customer_prototype(self, ct_data):
         """
@@ -289,13 +653,13 @@ class ProcessJSONResponse:
         customer types: under bookings__customers and under
         booking__availability__customer_type_rates
         """
-        cpt = models.CustomerPrototype.get_object_or_none(ct_data["pk"])
+        cpt = self.identity_map.get(models.CustomerPrototype, ct_data["pk"])
         if cpt:
             service = model_services.UpdateCustomerPrototype
         else:
             service = model_services.CreateCustomerPrototype
 
-        return service(
+        instance = service(
             customer_prototype_id=ct_data["pk"],
             note=ct_data["note"],
             total=ct_data["total"],
@@ -303,6 +667,7 @@ class ProcessJSONResponse:
             display_name=ct_data["display_name"],
             timestamp=self.timestamp,
         ).run()
+        return self.identity_map.add(models.CustomerPrototype, ct_data["pk"], instance)
 
     def _save_customer_type_rate(
         self, ctr_data, availability_id, customer_prototype_id, customer_type_id
@@ -314,13 +679,13 @@ class ProcessJSONResponse:
         customer types: under bookings__customers and under
         booking__availability__customer_type_rates
         """
-        ctr = models.CustomerTypeRate.get_object_or_none(ctr_data["pk"])
+        ctr = self.identity_map.get(models.CustomerTypeRate, ctr_data["pk"])
         if ctr:
             service = model_services.UpdateCustomerTypeRate
         else:
             service = model_services.CreateCustomerTypeRate
 
-        return service(
+        instance = service(
             ctr_id=ctr_data["pk"],
             capacity=ctr_data["capacity"],
             minimum_party_size=ctr_data["minimum_party_size"],
@@ -332,18 +697,19 @@ class ProcessJSONResponse:
             customer_type_id=customer_type_id,
             timestamp=self.timestamp,
         ).run()
+        return self.identity_map.add(models.CustomerTypeRate, ctr_data["pk"], instance)
 
     def _save_customer(self, c_data, ctr_id, booking_id, checkin_status_id):
         """
         Save the customer information contained in the data.
         """
-        customer = models.Customer.get_object_or_none(c_data["pk"])
+        customer = self.identity_map.get(models.Customer, c_data["pk"])
         if customer:
             service = model_services.UpdateCustomer
         else:
             service = model_services.CreateCustomer
 
-        return service(
+        instance = service(
             customer_id=c_data["pk"],
             checkin_url=c_data["checkin_url"],
             checkin_status_id=checkin_status_id,
@@ -351,23 +717,47 @@ class ProcessJSONResponse:
             booking_id=booking_id,
             timestamp=self.timestamp,
         ).run()
+        return self.identity_map.add(models.Customer, c_data["pk"], instance)
 
     def _save_checkin_status(self, cs_data):
         """
         Save the checkin status contained in the data.
         """
-        checkin_status = models.CheckinStatus.get_object_or_none(cs_data["pk"])
+        checkin_status = self.identity_map.get(models.CheckinStatus, cs_data["pk"])
         if checkin_status:
             service = model_services.UpdateCheckinStatus
         else:
             service = model_services.CreateCheckinStatus
 
-        return service(
+        instance = service(
             checkin_status_id=cs_data["pk"],
             checkin_status_type=cs_data["type"],
             name=cs_data["name"],
             timestamp=self.timestamp,
         ).run()
+        return self.identity_map.add(models.CheckinStatus, cs_data["pk"], instance)
+
+    def _save_once(self, model, entity_data, save, *args):
+        """
+        Save an entity once for each different version of it in the data.
+
+        Customer types, prototypes and rates appear both under the availability
+        and under each customer, and custom fields appear under every value or
+        instance that uses them. The repeated copies whose own fields match
+        the saved one are just counted, while a copy that differs is saved
+        again so the last occurrence wins. Nested entities are left out of the
+        comparison since they are saved on their own.
+        """
+        key = (model, entity_data["pk"])
+        fields = {
+            k: v for k, v in entity_data.items() if not isinstance(v, (dict, list))
+        }
+        saved = self.saved.get(key)
+        if saved and saved[0] == (fields, args):
+            self.duplicates[model.__table_name__] += 1
+        else:
+            saved = self.saved[key] = ((fields, args), save(entity_data, *args))
+        return saved[1]
 
     def _save_customer_group(self, booking_id, availability_id):
         """
@@ -381,25 +771,45 @@ class ProcessJSONResponse:
         for ctr_data in customer_type_rates:
             ct_data = ctr_data["customer_type"]
             cpt_data = ctr_data["customer_prototype"]
-            customer_type_id = self._save_customer_type(ct_data).id
-            customer_prototype_id = self._save_customer_prototype(cpt_data).id
-            self._save_customer_type_rate(
-                ctr_data, availability_id, customer_prototype_id, customer_type_id
+            customer_type_id = self._save_once(
+                models.CustomerType, ct_data, self._save_customer_type
+            ).id
+            customer_prototype_id = self._save_once(
+                models.CustomerPrototype, cpt_data, self._save_customer_prototype
+            ).id
+            self._save_once(
+                models.CustomerTypeRate,
+                ctr_data,
+                self._save_customer_type_rate,
+                availability_id,
+                customer_prototype_id,
+                customer_type_id,
             )
 
         for c_data in customers:
             ctr_data = c_data["customer_type_rate"]
             ct_data = ctr_data["customer_type"]
             cpt_data = ctr_data["customer_prototype"]
-            customer_type_id = self._save_customer_type(ct_data).id
-            customer_prototype_id = self._save_customer_prototype(cpt_data).id
+            customer_type_id = self._save_once(
+                models.CustomerType, ct_data, self._save_customer_type
+            ).id
+            customer_prototype_id = self._save_once(
+                models.CustomerPrototype, cpt_data, self._save_customer_prototype
+            ).id
 
             cs_data = c_data["checkin_status"]
             checkin_status_id = None
             if cs_data:
-                checkin_status_id = self._save_checkin_status(cs_data).id
-            ctr = self._save_customer_type_rate(
-                ctr_data, availability_id, customer_prototype_id, customer_type_id
+                checkin_status_id = self._save_once(
+                    models.CheckinStatus, cs_data, self._save_checkin_status
+                ).id
+            ctr = self._save_once(
+                models.CustomerTypeRate,
+                ctr_data,
+                self._save_customer_type_rate,
+                availability_id,
+                customer_prototype_id,
+                customer_type_id,
             )
             self._save_customer(c_data, ctr.id, booking_id, checkin_status_id)
 
@@ -453,10 +863,17 @@ class ProcessJSONResponse:
         A custom field family is a custom field with its descendants, the
         extended options, that are a reduced instance of the parent object.
         """
-        cf = self._save_custom_field(cf_family_data)
+        cf = self._save_once(
+            models.CustomField, cf_family_data, self._save_custom_field
+        )
         try:
             for extended_options_data in cf_family_data["extended_options"]:
-                self._save_custom_field(extended_options_data, cf.id)
+                self._save_once(
+                    models.CustomField,
+                    extended_options_data,
+                    self._save_custom_field,
+                    cf.id,
+                )
         except KeyError:
             # It can happen that some parents have no children
             pass
@@ -469,7 +886,9 @@ class ProcessJSONResponse:
         field. Note also that extended options has a subset of fields to that
         of its parent.
         """
-        custom_field = models.CustomField.get_object_or_none(custom_field_data["pk"])
+        custom_field = self.identity_map.get(
+            models.CustomField, custom_field_data["pk"]
+        )
         if custom_field:
             service = model_services.UpdateCustomField
         else:
@@ -488,7 +907,7 @@ class ProcessJSONResponse:
             booking_notes_safe_html = custom_field_data["booking_notes_safe_html"]
             is_required = custom_field_data["is_required"]
 
-        return service(
+        instance = service(
             custom_field_id=custom_field_data["pk"],
             timestamp=self.timestamp,
             title=title,
@@ -507,6 +926,9 @@ class ProcessJSONResponse:
             is_always_per_customer=custom_field_data["is_always_per_customer"],
             extended_options=parent_id,
         ).run()
+        return self.identity_map.add(
+            models.CustomField, custom_field_data["pk"], instance
+        )
 
     def _save_custom_field_instance(
         self,
@@ -515,32 +937,37 @@ class ProcessJSONResponse:
         customer_type_rate_id=None,
         availability_id=None,
     ):
-        custom_field_instance = models.CustomFieldInstance.get_object_or_none(
-            cfi_data["pk"]
+        custom_field_instance = self.identity_map.get(
+            models.CustomFieldInstance, cfi_data["pk"]
         )
         if custom_field_instance:
             service = model_services.UpdateCustomFieldInstance
         else:
             service = model_services.CreateCustomFieldInstance
 
-        return service(
+        instance = service(
             custom_field_instance_id=cfi_data["pk"],
             timestamp=self.timestamp,
             custom_field_id=custom_field_id,
             availability_id=availability_id,
             customer_type_rate_id=customer_type_rate_id,
         ).run()
+        return self.identity_map.add(
+            models.CustomFieldInstance, cfi_data["pk"], instance
+        )
 
     def _save_custom_field_value(
         self, cfv_data, custom_field_id, customer_id=None, booking_id=None
     ):
-        custom_field_value = models.CustomFieldValue.get_object_or_none(cfv_data["pk"])
+        custom_field_value = self.identity_map.get(
+            models.CustomFieldValue, cfv_data["pk"]
+        )
         if custom_field_value:
             service = model_services.UpdateCustomFieldValue
         else:
             service = model_services.CreateCustomFieldValue
 
-        return service(
+        instance = service(
             custom_field_value_id=cfv_data["pk"],
             timestamp=self.timestamp,
             name=cfv_data["name"],
@@ -550,8 +977,15 @@ class ProcessJSONResponse:
             booking_id=booking_id,
             customer_id=customer_id,
         ).run()
+        return self.identity_map.add(models.CustomFieldValue, cfv_data["pk"], instance)
 
     def run(self):
+        if current_app.config.get("PERSISTENCE_ENGINE") == "bulk":
+            return bulk_services.BulkUpsertJSONResponse(self.data, self.timestamp).run()
+
+        self.identity_map = IdentityMap(self.data).run()
+        self.saved, self.duplicates = dict(), Counter()
+        self.rescheduled = False
         item = self._save_item()
         av = self._save_availability(item.id)
         company, affiliate_company = self._save_company_group()
@@ -563,34 +997,382 @@ class ProcessJSONResponse:
         self._save_cancellation_policy(b.id)
         self._save_customer_group(b.id, av.id)
         self._save_custom_field_group(av.id)
+        if self.rescheduled:
+            # The other bookings of the availability are not in the response.
+            model_services.update_effective_periods(current_app.config, av.id)
+            models.db.session.commit()
+        if self.duplicates:
+            logger.info(
+                f"Skipped {sum(self.duplicates.values())} duplicated entities: "
+                + f"{dict(self.duplicates)}"
+            )
+
+
+# The remaining capacity of the availability changes with the other bookings
+# of the availability rather than with the booking sent.
+VOLATILE_PATHS = frozenset((("booking", "availability", "capacity"),))
+
+
+def _drop_volatile_keys(data, path=()):
+    if isinstance(data, dict):
+        return {
+            key: _drop_volatile_keys(value, path + (key,))
+            for key, value in data.items()
+            if path + (key,) not in VOLATILE_PATHS
+        }
+    if isinstance(data, list):
+        return [_drop_volatile_keys(value, path) for value in data]
+    return data
+
+
+def get_content_hash(json_response):
+    """Hash the content of a response regardless of its key order and volatile paths."""
+    canonical = json.dumps(
+        _drop_volatile_keys(json_response),
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def is_redelivery(request_id, booking_id, content_hash, timestamp):
+    """Tell whether the last request processed for the booking had the same content."""
+    if not current_app.config.get("DEDUPLICATE_REDELIVERIES"):
+        return False
+    if booking_id is None or content_hash is None:
+        return False
+    sr = models.StoredRequest
+    last = (
+        sr.query.filter(
+            sr.booking_id == booking_id,
+            sr.processed_at.isnot(None),
+            sr.created_at <= timestamp,
+            sr.id != request_id,
+        )
+        .order_by(sr.created_at.desc(), sr.id.desc())
+        .first()
+    )
+    return last is not None and last.content_hash == content_hash
+
+
+def is_superseded(booking_id, timestamp):
+    """Tell whether a later request for the booking was already processed."""
+    if booking_id is None:
+        return False
+    sr = models.StoredRequest
+    later = sr.query.filter(
+        sr.booking_id == booking_id,
+        sr.processed_at.isnot(None),
+        sr.created_at > timestamp,
+    )
+    return models.db.session.query(later.exists()).scalar()
+
+
+def skip_redelivery(request_id, booking_id):
+    metrics.increment("redeliveries_skipped")
+    logger.info(
+        f"Request {request_id} repeats the last state of booking {booking_id}, "
+        + "skipping."
+    )
 
 
 @attr.s
 class SaveRequestToDB:
     """
     Handle all the services needed for the save of responses.
+
+    When process is False the request is only stored, leaving processed_at
+    empty so ProcessStoredRequests picks it up afterwards. Requests that
+    repeat the last processed state of the booking are closed without
+    writing anything else. When the processing fails the request is left
+    open with the failure recorded, see record_failure.
     """
 
     json_response = attr.ib(type=dict)
     timestamp = attr.ib(type=datetime)
     filename = attr.ib(type=str)
+    process = attr.ib(type=bool, default=True)
+    raw_body = attr.ib(type=bytes, default=None)
 
     def run(self):
+        if self.raw_body is not None:
+            body = self.raw_body.decode()
+        else:
+            body = json.dumps(self.json_response)
+        request_id = get_request_id(self.timestamp.timestamp())
+        booking_id = (self.json_response.get("booking") or {}).get("pk")
+        content_hash = get_content_hash(self.json_response)
         try:
             stored_request = model_services.CreateStoredRequest(
-                request_id=get_request_id_or_none(self.filename),
+                request_id=request_id,
                 filename=self.filename,
-                body=json.dumps(self.json_response),
+                body=body,
                 timestamp=self.timestamp,
+                booking_id=booking_id,
+                content_hash=content_hash,
             ).run()
-            ProcessJSONResponse(self.json_response, self.timestamp).run()
+            if not self.process:
+                return stored_request
+            if is_redelivery(request_id, booking_id, content_hash, self.timestamp):
+                skip_redelivery(request_id, booking_id)
+            else:
+                ProcessJSONResponse(self.json_response, self.timestamp).run()
             stored_request = model_services.CloseStoredRequest(stored_request).run()
-        except OperationalError as e:
-            logger.error(e)
+        except Exception as e:
+            # Whatever failed, the request stays stored for the worker to retry it.
+            models.db.session.rollback()
+            logger.error(f"Request {request_id} failed, error={e}")
+            record_failure(request_id, e)
             return None
         return stored_request
 
 
+def record_failure(request_id, error):
+    """
+    Count a failed attempt to process a stored request.
+
+    The next attempt is delayed twice as long after each failure, up to
+    ProcessStoredRequests.MAX_BACKOFF seconds. If the failure can't even be
+    recorded (e.g. the db is down) it's just logged.
+    """
+    stmt = text(
+        """
+        UPDATE stored_request SET
+            failures = failures + 1,
+            last_error = :error,
+            retry_at = now() + make_interval(
+                secs => least(:backoff * power(2, failures), :max_backoff)
+            )
+        WHERE id = :request_id
+        """
+    )
+    try:
+        models.db.session.rollback()
+        models.db.session.execute(
+            stmt,
+            {
+                "request_id": request_id,
+                "error": str(error),
+                "backoff": ProcessStoredRequests.BACKOFF,
+                "max_backoff": ProcessStoredRequests.MAX_BACKOFF,
+            },
+        )
+        models.db.session.commit()
+    except SQLAlchemyError as e:
+        models.db.session.rollback()
+        logger.error(f"Unable to record the failure of {request_id}, error={e}")
+
+
+def queue_depth():
+    """Return the number of stored requests that are waiting to be processed."""
+    return models.StoredRequest.query.filter(
+        models.StoredRequest.processed_at.is_(None)
+    ).count()
+
+
+class ProcessStoredRequests:
+    """
+    Process the stored requests that were saved but not processed yet.
+
+    This is the worker for the async ingestion mode, where the webhook only
+    stores the requests. Requests are processed in the order they arrived, so
+    only one worker drains the queue at a time, which is ensured through a
+    postgres advisory lock, any other worker just waits for the lock.
+
+    A request that fails is left unprocessed and the worker moves on to the
+    next ones, so it does not block the queue. Its failures are counted and
+    it's retried with an exponential backoff by the next drain once due. As
+    the webhook leaves unprocessed the requests that failed, this also
+    reprocesses them in sync mode, where `min_age` keeps the worker off the
+    requests the webhook is still on. A request older than the last one
+    processed for its booking is closed without processing it, so a retry
+    never rolls the booking back.
+
+    The catch up stores first the archived requests missing in the db, the
+    ones received while the db was down. Only the tail of the archive, since
+    the newest request stored, is read.
+    """
+
+    LOCK_KEY = 715_001
+    # Seconds before the first retry of a failed request, doubled after each
+    # failure up to the max.
+    BACKOFF = 60
+    MAX_BACKOFF = 6 * 3600
+    # Seconds before the newest request stored to start the catch up from, as
+    # the requests are not stored in strict order.
+    CATCH_UP_MARGIN = 60
+
+    def __init__(
+        self, app, batch_size=50, interval=1.0, min_age=0, ignore_backoff=False
+    ):
+        self.app = app
+        self.batch_size = batch_size
+        self.interval = interval
+        self.min_age = min_age
+        self.ignore_backoff = ignore_backoff
+        self.processed, self.failed, self.recovered = 0, 0, 0
+        self.last_seen = None
+        self.logger = app.logger
+
+    def _acquire_lock(self):
+        """Hold the lock in a connection of its own for the life of the worker."""
+        self.lock_connection = models.db.engine.connect()
+        query = text("SELECT pg_try_advisory_lock(:key)")
+        return self.lock_connection.execute(query, key=self.LOCK_KEY).scalar()
+
+    def _release_lock(self):
+        query = text("SELECT pg_advisory_unlock(:key)")
+        self.lock_connection.execute(query, key=self.LOCK_KEY)
+        self.lock_connection.close()
+
+    def _next_batch(self):
+        sr = models.StoredRequest
+        now = datetime.now(timezone.utc)
+        query = sr.query.filter(sr.processed_at.is_(None))
+        if not self.ignore_backoff:
+            query = query.filter(or_(sr.retry_at.is_(None), sr.retry_at <= now))
+        if self.min_age:
+            received_before = now - timedelta(seconds=self.min_age)
+            query = query.filter(sr.created_at <= received_before)
+        if self.last_seen:
+            created_at, request_id = self.last_seen
+            query = query.filter(
+                or_(
+                    sr.created_at > created_at,
+                    and_(sr.created_at == created_at, sr.id > request_id),
+                )
+            )
+        return query.order_by(sr.created_at, sr.id).limit(self.batch_size).all()
+
+    def _process(self, stored_request):
+        self.last_seen = (stored_request.created_at, stored_request.id)
+        try:
+            data = json.loads(stored_request.body)
+            if is_superseded(stored_request.booking_id, stored_request.created_at):
+                # A retry must not roll back the booking to an older state.
+                metrics.increment("superseded_skipped")
+                self.logger.info(
+                    f"Request {stored_request.id} is older than the last state "
+                    + f"of booking {stored_request.booking_id}, closing it."
+                )
+            elif is_redelivery(
+                stored_request.id,
+                stored_request.booking_id,
+                stored_request.content_hash,
+                stored_request.created_at,
+            ):
+                skip_redelivery(stored_request.id, stored_request.booking_id)
+            else:
+                ProcessJSONResponse(data, stored_request.created_at).run()
+            model_services.CloseStoredRequest(
+                stored_request, timestamp=datetime.now(timezone.utc)
+            ).run()
+        except Exception as e:
+            models.db.session.rollback()
+            self.logger.error(f"Request {stored_request.id} failed, error={e}")
+            record_failure(stored_request.id, e)
+            self.failed += 1
+        else:
+            self.processed += 1
+
+    def catch_up(self):
+        """Store the archived requests missing in the db, return how many."""
+        sr = models.StoredRequest
+        newest = models.db.session.query(func.max(sr.created_at)).scalar()
+        since = newest.timestamp() - self.CATCH_UP_MARGIN if newest else None
+        stored = set()
+        if since is not None:
+            since_at = datetime.fromtimestamp(since, tz=timezone.utc)
+            query = models.db.session.query(sr.id).filter(sr.created_at > since_at)
+            stored = {request_id for request_id, in query}
+
+        recovered = 0
+        records = archive.read_archive(
+            self.app.config["RESPONSES_PATH"], self.app.config["JOURNAL_PATH"], since
+        )
+        for record in records:
+            if get_request_id(record.timestamp) in stored:
+                continue
+            try:
+                data = record.load()
+                validate_booking(data["booking"])
+            except (ValueError, KeyError, TypeError, ValidationError) as e:
+                self.logger.info(f"Not catching up {record.name}, error={e}")
+                continue
+            timestamp = datetime.fromtimestamp(record.timestamp, tz=timezone.utc)
+            stored_request = SaveRequestToDB(
+                data, timestamp, record.name, process=False, raw_body=record.body
+            ).run()
+            recovered += stored_request is not None
+        self.recovered += recovered
+        if recovered:
+            self.logger.info(f"Caught up {recovered} requests missing in the db")
+        return recovered
+
+    def drain(self):
+        """Process all the pending requests and return how many were attempted."""
+        # The cursor only keeps a pass from reading again the requests it failed, each pass
+        # starts over to pick up the requests committed late and the retries due.
+        self.last_seen = None
+        attempted = 0
+        batch = self._next_batch()
+        while batch:
+            for stored_request in batch:
+                self._process(stored_request)
+            attempted += len(batch)
+            batch = self._next_batch()
+        return attempted
+
+    def run(self, once=False, catch_up=False):
+        while not self._acquire_lock():
+            self.lock_connection.close()
+            if once:
+                self.logger.info(
+                    "Another worker is processing the queue, retries included."
+                )
+                return
+            time.sleep(self.interval)
+
+        try:
+            if catch_up:
+                self.catch_up()
+            while True:
+                if self.drain():
+                    self.logger.info(
+                        f"Processed {self.processed} requests ({self.failed} failed), "
+                        + f"queue depth: {queue_depth()}"
+                    )
+                if once:
+                    return
+                time.sleep(self.interval)
+        finally:
+            self._release_lock()
+
+
+@attr.s
+class SaveResponseToJournal:
+    """
+    Append the content of the POST method to the journal.
+
+    It replaces SaveResponseAsFile, so the archive does not end up being a
+    directory with one file per request. Returns the name of the record in
+    the archive. When the raw body is given, those exact bytes are archived.
+    """
+
+    json_response = attr.ib(type=dict)
+    writer = attr.ib(type=archive.JournalWriter)
+    timestamp = attr.ib(type=datetime)
+    raw_body = attr.ib(type=bytes, default=None)
+
+    def run(self):
+        booking_pk = (self.json_response.get("booking") or {}).get("pk")
+        body = self.raw_body
+        if body is None:
+            body = json.dumps(self.json_response).encode()
+        return self.writer.append(body, self.timestamp.timestamp(), booking_pk)
+
+
 @attr.s
 class SaveResponseAsFile:
     """
@@ -598,12 +1380,13 @@ class SaveResponseAsFile:
 
     Before storing the data on the db we should know how that data looks
     to create the tables accordingly. So we need a way to store the data
-    to inspect it.
+    to inspect it. When the raw body is given, those exact bytes are saved.
     """
 
     json_response = attr.ib(type=dict)
     path = attr.ib(type=str)
     timestamp = attr.ib(type=datetime)
+    raw_body = attr.ib(type=bytes, default=None)
 
     def run(self):
         try:
@@ -613,11 +1396,132 @@ class SaveResponseAsFile:
         unix_timestamp = self.timestamp.timestamp()
         filename = str(unix_timestamp) + ".json"
         full_path = os.path.join(self.path, filename)
-        with open(full_path, "w") as fp:
-            json.dump(self.json_response, fp)
+        if self.raw_body is not None:
+            with open(full_path, "wb") as fp:
+                fp.write(self.raw_body)
+        else:
+            with open(full_path, "w") as fp:
+                json.dump(self.json_response, fp)
         return filename
 
 
+def _int_or_none(value):
+    return value if type(value) is int else None
+
+
+def get_archive_entry(name, unix_timestamp, json_response):
+    """Return the row indexing an archived request, whatever its content."""
+    booking = json_response.get("booking") if isinstance(json_response, dict) else None
+    booking = booking if isinstance(booking, dict) else dict()
+    availability = booking.get("availability")
+    availability = availability if isinstance(availability, dict) else dict()
+    uuid = booking.get("uuid")
+    timestamp = datetime.fromtimestamp(unix_timestamp, tz=timezone.utc)
+    return {
+        "name": name,
+        "created_at": timestamp,
+        "updated_at": timestamp,
+        "booking_id": _int_or_none(booking.get("pk")),
+        "booking_uuid": uuid if isinstance(uuid, str) and len(uuid) <= 40 else None,
+        "availability_id": _int_or_none(availability.get("pk")),
+    }
+
+
+def save_archive_entries(rows):
+    table = models.ArchiveEntry.__table__
+    stmt = insert(table).values(rows)
+    columns = ("updated_at", "booking_id", "booking_uuid", "availability_id")
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["name"], set_={name: stmt.excluded[name] for name in columns}
+    )
+    models.db.session.execute(stmt)
+    models.db.session.commit()
+
+
+@attr.s
+class IndexArchivedRequest:
+    """
+    Add a request just archived to the archive index.
+
+    The requests are indexed before being validated, so the ones rejected can
+    also be found. A failure is logged rather than losing the request, as the
+    index can be rebuilt out of the archive.
+    """
+
+    json_response = attr.ib(type=dict)
+    name = attr.ib(type=str)
+    timestamp = attr.ib(type=datetime)
+
+    def run(self):
+        row = get_archive_entry(
+            self.name, self.timestamp.timestamp(), self.json_response
+        )
+        try:
+            save_archive_entries([row])
+        except SQLAlchemyError as e:
+            models.db.session.rollback()
+            logger.error(f"Unable to index {self.name}, error={e}")
+
+
+class IndexArchive:
+    """Rebuild the archive index reading the whole archive."""
+
+    BATCH_SIZE = 1000
+
+    def __init__(self, app):
+        self.app = app
+        self.indexed = 0
+        self.logger = app.logger
+
+    def _save(self, rows):
+        if rows:
+            save_archive_entries(rows)
+            self.indexed += len(rows)
+            elapsed = time.monotonic() - self.started
+            self.logger.info(
+                f"Indexed {self.indexed} requests, "
+                + f"{self.indexed / elapsed if elapsed else 0:.1f} files/sec"
+            )
+
+    def run(self):
+        self.started = time.monotonic()
+        rows = list()
+        for record in archive.get_archive(self.app):
+            try:
+                data = record.extract(*archive.BOOKING_KEYS)
+            except ValueError:
+                data = None
+            rows.append(get_archive_entry(record.name, record.timestamp, data))
+            if len(rows) == self.BATCH_SIZE:
+                self._save(rows)
+                rows = list()
+        self._save(rows)
+        return self.indexed
+
+
+def get_history(app, **filters):
+    """
+    Return the archived requests of a booking, oldest first.
+
+    Filter by booking_id, booking_uuid or availability_id.
+    """
+    entry = models.ArchiveEntry
+    entries = entry.query.filter_by(**filters).order_by(entry.created_at, entry.name)
+    history = list()
+    for e in entries:
+        record = archive.read_record(
+            app.config["RESPONSES_PATH"], app.config["JOURNAL_PATH"], e.name
+        )
+        history.append(
+            {
+                "name": e.name,
+                "archived_at": e.created_at.astimezone(timezone.utc).isoformat(),
+                "request": record.load(),
+            }
+        )
+    return history
+
+
 class SSLSMTPHandler(SMTPHandler):
     """
     Handle the delivery of emails through SSL.
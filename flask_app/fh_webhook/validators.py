@@ -0,0 +1,289 @@
+"""
+Validate the FH payloads without going through marshmallow on every request.
+
+`BookingSchema().load` builds the schema on each request, recurses through the
+nested fields and returns a deserialized copy of the booking that the webhook
+throws away. CompiledSchema walks the schema tree once and turns it into a
+tree of plain checks that just tell whether a payload is valid.
+
+The checks are conservative: they only accept the values marshmallow accepts
+as they are (e.g. an int for an Integer field). Whatever they reject is then
+loaded through the schema itself, so invalid payloads raise the very same
+ValidationError and the values marshmallow coerces (e.g. "1" for an Integer)
+are still accepted.
+
+ValidateArchive runs the same validation over the whole archive with a pool
+of processes and aggregates the errors found per field.
+"""
+import logging
+import multiprocessing
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from itertools import islice
+
+import attr
+from flask import current_app
+from marshmallow import RAISE, Schema, ValidationError, fields
+from marshmallow.utils import missing
+
+from . import archive
+from .fast_json import loads
+from .schema import BookingSchema
+
+logger = logging.getLogger(__name__)
+
+
+def _is_str(value):
+    return type(value) is str
+
+
+def _is_int(value):
+    return type(value) is int
+
+
+def _is_bool(value):
+    return value is True or value is False
+
+
+def _is_anything(value):
+    return True
+
+
+FAST_CHECKS = {
+    fields.String: _is_str,
+    fields.Integer: _is_int,
+    fields.Boolean: _is_bool,
+    fields.Field: _is_anything,
+}
+
+
+def _deserializes(field):
+    """Check a value by deserializing it with the marshmallow field."""
+
+    def check(value):
+        try:
+            field.deserialize(value)
+        except ValidationError:
+            return False
+        return True
+
+    return check
+
+
+def _each(check):
+    def check_list(value):
+        if type(value) is not list:
+            return False
+        for item in value:
+            if not check(item):
+                return False
+        return True
+
+    return check_list
+
+
+def compile_field(field):
+    if field.validators:
+        return _deserializes(field)
+    if isinstance(field, fields.Nested) and not (field.only or field.exclude):
+        check = compile_schema(field.schema, field.unknown)
+        return _each(check) if field.many else check
+    if type(field) in FAST_CHECKS:
+        return FAST_CHECKS[type(field)]
+    return _deserializes(field)
+
+
+def compile_schema(schema: Schema, unknown=None):
+    """Return a function telling whether some data can be loaded by the schema."""
+    checks = tuple(
+        (
+            name if field.data_key is None else field.data_key,
+            field.required,
+            field.allow_none,
+            compile_field(field),
+        )
+        for name, field in schema.load_fields.items()
+    )
+    known_keys = frozenset(key for key, *_ in checks)
+    raise_unknown = (unknown or schema.unknown) == RAISE
+
+    def check(data):
+        if type(data) is not dict:
+            return False
+        if raise_unknown and not known_keys.issuperset(data):
+            return False
+        for key, required, allow_none, check_value in checks:
+            value = data.get(key, missing)
+            if value is missing:
+                if required:
+                    return False
+            elif value is None:
+                if not allow_none:
+                    return False
+            elif not check_value(value):
+                return False
+        return True
+
+    return check
+
+
+@attr.s
+class CompiledSchema:
+    """Validate data against a schema compiled once."""
+
+    schema_class = attr.ib()
+
+    def __attrs_post_init__(self):
+        self.check = compile_schema(self.schema_class())
+
+    def validate(self, data):
+        """Raise the same ValidationError `schema_class().load` would raise."""
+        if not self.check(data):
+            self.schema_class().load(data)
+
+
+compiled_booking_schema = CompiledSchema(BookingSchema)
+
+
+def validate_booking(data):
+    """Validate a booking with the engine set in SCHEMA_VALIDATOR."""
+    if current_app.config.get("SCHEMA_VALIDATOR") == "marshmallow":
+        BookingSchema().load(data)
+    else:
+        compiled_booking_schema.validate(data)
+
+
+def flatten_errors(messages, path=()):
+    """
+    Yield `(path, message)` for each error in the messages of a ValidationError.
+
+    The list indices in the path are replaced with `*`, so the errors of the
+    same field in different items are counted together.
+    """
+    if isinstance(messages, dict):
+        for key, value in messages.items():
+            yield from flatten_errors(value, path + ("*" if type(key) is int else key,))
+    elif isinstance(messages, list):
+        for message in messages:
+            yield from flatten_errors(message, path)
+    else:
+        yield ".".join(str(key) for key in path), str(messages)
+
+
+def validate_body(body):
+    """Return the errors found in the body of a request, an empty list if valid."""
+    try:
+        data = loads(body)
+    except ValueError as e:
+        return [("", f"Not a valid JSON: {e}")]
+    if not isinstance(data, dict) or "booking" not in data:
+        return [("booking", "Missing data for required field.")]
+    try:
+        compiled_booking_schema.validate(data["booking"])
+    except ValidationError as e:
+        return list(flatten_errors(e.messages, ("booking",)))
+    return []
+
+
+def _validate_record(record):
+    unix_timestamp, name, body = record
+    return unix_timestamp, name, validate_body(body)
+
+
+@attr.s
+class ValidationReport:
+    """Aggregate the errors found in the archive per field path and message."""
+
+    samples = attr.ib(type=int, default=3)
+
+    def __attrs_post_init__(self):
+        self.total, self.invalid = 0, 0
+        self.errors = dict()
+
+    def add(self, unix_timestamp, name, errors):
+        self.total += 1
+        if not errors:
+            return
+        self.invalid += 1
+        seen_at = datetime.fromtimestamp(unix_timestamp, tz=timezone.utc).isoformat()
+        for path, message in errors:
+            error = self.errors.setdefault(
+                (path, message), {"count": 0, "first_seen": seen_at, "samples": []}
+            )
+            error["count"] += 1
+            error["last_seen"] = seen_at
+            if len(error["samples"]) < self.samples and name not in error["samples"]:
+                error["samples"].append(name)
+
+    def as_dict(self):
+        errors = sorted(self.errors.items(), key=lambda item: -item[1]["count"])
+        return OrderedDict(
+            total=self.total,
+            invalid=self.invalid,
+            errors=[
+                dict(path=path, message=message, **error)
+                for (path, message), error in errors
+            ],
+        )
+
+
+@attr.s
+class ValidateArchive:
+    """
+    Validate every request in the archive against BookingSchema.
+
+    The records are validated by a pool of `workers` processes while they are
+    read, so the report covers the whole archive rather than stopping at the
+    first invalid request. The records are handed to the pool in windows of
+    a few chunks per worker, so the reader doesn't get ahead of the workers
+    with the whole archive in memory.
+    """
+
+    app = attr.ib()
+    workers = attr.ib(type=int, default=1)
+    samples = attr.ib(type=int, default=3)
+
+    # Records sent to each worker at once.
+    CHUNK_SIZE = 64
+    # Chunks per worker read ahead of the results.
+    WINDOW_CHUNKS = 4
+    # Records validated between the progress reports.
+    PROGRESS_EVERY = 1000
+
+    def _log_progress(self, report):
+        elapsed = time.monotonic() - self.started
+        rate = report.total / elapsed if elapsed else 0
+        logger.info(
+            f"Validated {report.total} requests ({report.invalid} invalid), "
+            + f"{rate:.1f} files/sec"
+        )
+
+    def run(self):
+        self.started = time.monotonic()
+        report = ValidationReport(self.samples)
+        records = (
+            (record.timestamp, record.name, record.body)
+            for record in archive.get_archive(self.app)
+        )
+        if self.workers > 1:
+            pool = multiprocessing.get_context("fork").Pool(self.workers)
+            size = self.workers * self.CHUNK_SIZE * self.WINDOW_CHUNKS
+            windows = iter(lambda: list(islice(records, size)), [])
+            results = (
+                result
+                for window in windows
+                for result in pool.imap(_validate_record, window, self.CHUNK_SIZE)
+            )
+        else:
+            pool, results = None, map(_validate_record, records)
+        try:
+            for result in results:
+                report.add(*result)
+                if report.total % self.PROGRESS_EVERY == 0:
+                    self._log_progress(report)
+        finally:
+            if pool:
+                pool.terminate()
+        self._log_progress(report)
+        return report
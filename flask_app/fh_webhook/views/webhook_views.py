@@ -1,12 +1,22 @@
 import os
 from datetime import datetime, timezone
 
-from flask import Blueprint, Response, current_app, request
+from flask import Blueprint, Response, current_app, jsonify, request
 from marshmallow.validate import ValidationError
 
+from fh_webhook.archive import get_journal_writer
 from fh_webhook.auth import get_auth
-from fh_webhook.schema import BookingSchema
-from fh_webhook.services import SaveRequestToDB, SaveResponseAsFile
+from fh_webhook.fast_json import loads
+from fh_webhook.metrics import get_counters
+from fh_webhook.services import (
+    IndexArchivedRequest,
+    SaveRequestToDB,
+    SaveResponseAsFile,
+    SaveResponseToJournal,
+    get_history,
+    queue_depth,
+)
+from fh_webhook.validators import validate_booking
 
 bp = Blueprint("webhook", __name__, url_prefix="/")
 auth = get_auth()
@@ -30,26 +40,84 @@ def save_content():
     logger = current_app.logger
     logger.info("New FH request received.")
     path = current_app.config.get("RESPONSES_PATH")
-    json_response = request.json
     timestamp = datetime.now(timezone.utc)
+
+    # Keep the bytes as they came, they are archived and stored untouched and
+    # parsed just once.
+    raw_body = request.get_data(cache=True)
+    json_response = None
+    if request.is_json and raw_body:
+        try:
+            json_response = loads(raw_body)
+        except ValueError as e:
+            logger.error(f"Unable to parse the request, error={e}")
+            return Response("The request is not a valid JSON", status=400)
+
     if json_response:
         # Let's save the data first of all, so we can populate the database if some error occurs.
-        filename = SaveResponseAsFile(json_response, path, timestamp).run()
+        if current_app.config.get("ARCHIVE_FORMAT") == "files":
+            filename = SaveResponseAsFile(
+                json_response, path, timestamp, raw_body
+            ).run()
+        else:
+            writer = get_journal_writer(current_app)
+            filename = SaveResponseToJournal(
+                json_response, writer, timestamp, raw_body
+            ).run()
+        IndexArchivedRequest(json_response, filename, timestamp).run()
 
         try:
-            BookingSchema().load(json_response["booking"])
+            validate_booking(json_response["booking"])
         except ValidationError as e:
-            logger.error(f"filename={timestamp.timestamp()}.json, error={e}")
+            logger.error(f"filename={filename}, error={e}")
             return Response(str(e), status=400)
 
     else:
         logger.error("The request was empty")
         return Response("The request was empty", status=400)
 
-    stored_request = SaveRequestToDB(json_response, timestamp, filename).run()
+    async_ingestion = current_app.config.get("ASYNC_INGESTION")
+    stored_request = SaveRequestToDB(
+        json_response,
+        timestamp,
+        filename,
+        process=not async_ingestion,
+        raw_body=raw_body,
+    ).run()
 
     if stored_request:
-        message = f"Request {stored_request.id} successfully processed."
+        action = "queued" if async_ingestion else "processed"
+        message = f"Request {stored_request.id} successfully {action}."
         logger.info(message)
         return Response(status=200)
     return Response(status=500)
+
+
+@bp.route("metrics/", methods=["GET"])
+@auth.login_required
+def get_metrics():
+    """Show the counters of the worker answering the request."""
+    return jsonify(get_counters())
+
+
+@bp.route("queue-depth/", methods=["GET"])
+@auth.login_required
+def get_queue_depth():
+    """Report how many requests are waiting for the async worker."""
+    return jsonify({"queue_depth": queue_depth()})
+
+
+@bp.route("bookings/<key>/history/", methods=["GET"])
+@auth.login_required
+def get_booking_history(key):
+    """Return the archived requests of a booking, by pk or uuid, oldest first."""
+    if key.isdigit():
+        return jsonify(get_history(current_app, booking_id=int(key)))
+    return jsonify(get_history(current_app, booking_uuid=key))
+
+
+@bp.route("availabilities/<int:availability_id>/history/", methods=["GET"])
+@auth.login_required
+def get_availability_history(availability_id):
+    """Return the archived requests of the bookings of an availability, oldest first."""
+    return jsonify(get_history(current_app, availability_id=availability_id))
@@ -0,0 +1,33 @@
+"""Add the booking id and the content hash to the stored requests.
+
+Revision ID: 4f1d2c7b9e10
+Revises: 93bcc34a9d67
+Create Date: 2026-10-18 09:12:41.120398
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "4f1d2c7b9e10"
+down_revision = "93bcc34a9d67"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("stored_request", sa.Column("booking_id", sa.BigInteger()))
+    op.add_column("stored_request", sa.Column("content_hash", sa.String(length=64)))
+    op.create_index(
+        op.f("ix_stored_request_booking_id"), "stored_request", ["booking_id"]
+    )
+    op.create_index(
+        op.f("ix_stored_request_content_hash"), "stored_request", ["content_hash"]
+    )
+
+
+def downgrade():
+    op.drop_index(op.f("ix_stored_request_content_hash"), table_name="stored_request")
+    op.drop_index(op.f("ix_stored_request_booking_id"), table_name="stored_request")
+    op.drop_column("stored_request", "content_hash")
+    op.drop_column("stored_request", "booking_id")
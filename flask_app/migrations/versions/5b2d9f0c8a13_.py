@@ -0,0 +1,37 @@
+"""Count the failures of the stored requests and index the unprocessed ones.
+
+Revision ID: 5b2d9f0c8a13
+Revises: c71b04e9a6d2
+Create Date: 2026-10-18 16:05:27.304215
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "5b2d9f0c8a13"
+down_revision = "c71b04e9a6d2"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "stored_request",
+        sa.Column("failures", sa.Integer(), server_default="0", nullable=False),
+    )
+    op.add_column("stored_request", sa.Column("last_error", sa.Text()))
+    op.add_column("stored_request", sa.Column("retry_at", sa.DateTime(timezone=True)))
+    op.create_index(
+        "ix_stored_request_unprocessed",
+        "stored_request",
+        ["created_at", "id"],
+        postgresql_where=sa.text("processed_at IS NULL"),
+    )
+
+
+def downgrade():
+    op.drop_index("ix_stored_request_unprocessed", table_name="stored_request")
+    op.drop_column("stored_request", "retry_at")
+    op.drop_column("stored_request", "last_error")
+    op.drop_column("stored_request", "failures")
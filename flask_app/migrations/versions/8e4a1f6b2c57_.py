@@ -0,0 +1,24 @@
+"""Index the availabilities by start and item.
+
+Revision ID: 8e4a1f6b2c57
+Revises: 5b2d9f0c8a13
+Create Date: 2026-10-18 17:21:09.841562
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "8e4a1f6b2c57"
+down_revision = "5b2d9f0c8a13"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        "ix_availability_start_at_item_id", "availability", ["start_at", "item_id"]
+    )
+
+
+def downgrade():
+    op.drop_index("ix_availability_start_at_item_id", table_name="availability")
@@ -0,0 +1,30 @@
+"""Add the replay checkpoints.
+
+Revision ID: a3e5c8d21f47
+Revises: 4f1d2c7b9e10
+Create Date: 2026-10-18 11:40:02.518337
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "a3e5c8d21f47"
+down_revision = "4f1d2c7b9e10"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "replay_checkpoint",
+        sa.Column("created_at", sa.DateTime(timezone=True), nullable=False),
+        sa.Column("updated_at", sa.DateTime(timezone=True), nullable=False),
+        sa.Column("id", sa.String(length=255), nullable=False),
+        sa.Column("archived_at", sa.Float(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+
+
+def downgrade():
+    op.drop_table("replay_checkpoint")
@@ -0,0 +1,31 @@
+"""Index the stored requests by booking and time.
+
+Revision ID: b6e3f1a07c94
+Revises: d4c7e2a9b813
+Create Date: 2026-10-18 21:14:52.306118
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "b6e3f1a07c94"
+down_revision = "d4c7e2a9b813"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        "ix_stored_request_booking_id_created_at",
+        "stored_request",
+        ["booking_id", "created_at", "id"],
+    )
+    # The composite index serves the lookups by booking alone too.
+    op.drop_index("ix_stored_request_booking_id", table_name="stored_request")
+
+
+def downgrade():
+    op.create_index("ix_stored_request_booking_id", "stored_request", ["booking_id"])
+    op.drop_index(
+        "ix_stored_request_booking_id_created_at", table_name="stored_request"
+    )
@@ -0,0 +1,44 @@
+"""Add the index of the archive by booking.
+
+Revision ID: c71b04e9a6d2
+Revises: a3e5c8d21f47
+Create Date: 2026-10-18 13:02:47.906114
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "c71b04e9a6d2"
+down_revision = "a3e5c8d21f47"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "archive_entry",
+        sa.Column("created_at", sa.DateTime(timezone=True), nullable=False),
+        sa.Column("updated_at", sa.DateTime(timezone=True), nullable=False),
+        sa.Column("name", sa.String(length=64), nullable=False),
+        sa.Column("booking_id", sa.BigInteger(), nullable=True),
+        sa.Column("booking_uuid", sa.String(length=40), nullable=True),
+        sa.Column("availability_id", sa.BigInteger(), nullable=True),
+        sa.PrimaryKeyConstraint("name"),
+    )
+    op.create_index(
+        op.f("ix_archive_entry_booking_id"), "archive_entry", ["booking_id"]
+    )
+    op.create_index(
+        op.f("ix_archive_entry_booking_uuid"), "archive_entry", ["booking_uuid"]
+    )
+    op.create_index(
+        op.f("ix_archive_entry_availability_id"), "archive_entry", ["availability_id"]
+    )
+
+
+def downgrade():
+    op.drop_index(op.f("ix_archive_entry_availability_id"), table_name="archive_entry")
+    op.drop_index(op.f("ix_archive_entry_booking_uuid"), table_name="archive_entry")
+    op.drop_index(op.f("ix_archive_entry_booking_id"), table_name="archive_entry")
+    op.drop_table("archive_entry")
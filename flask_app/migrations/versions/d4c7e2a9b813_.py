@@ -0,0 +1,39 @@
+"""Store when the bikes of the bookings are in use.
+
+Revision ID: d4c7e2a9b813
+Revises: 8e4a1f6b2c57
+Create Date: 2026-10-18 19:02:37.518204
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "d4c7e2a9b813"
+down_revision = "8e4a1f6b2c57"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "booking",
+        sa.Column("effective_start_at", sa.DateTime(timezone=True), nullable=True),
+    )
+    op.add_column(
+        "booking",
+        sa.Column("effective_end_at", sa.DateTime(timezone=True), nullable=True),
+    )
+    op.create_index(
+        "ix_booking_effective_period",
+        "booking",
+        [sa.text("tstzrange(effective_start_at, effective_end_at, '[]')")],
+        postgresql_using="gist",
+        postgresql_where=sa.text("effective_start_at IS NOT NULL"),
+    )
+
+
+def downgrade():
+    op.drop_index("ix_booking_effective_period", table_name="booking")
+    op.drop_column("booking", "effective_end_at")
+    op.drop_column("booking", "effective_start_at")
@@ -0,0 +1,99 @@
+"""
+Compare how the availabilities of a day are looked up by the bike tracker.
+
+DailyActivities used to filter on `DATE(availability.start_at)`, which no index
+can serve, so each call scanned the whole table. Now it filters on the
+`[day_start, next_day_start)` range of the day in Europe/Madrid, served by the
+index on availability(start_at, item_id).
+
+The script fills the db with some seasons of synthetic availabilities, prints
+the plan and the time of both filters and rolls everything back, so it can be
+run against a copy of the production db.
+
+To execute this script:
+$> export FLASK_APP=run.py
+$> flask shell < benchmark_daily_activities.py
+"""
+import timeit
+from datetime import date
+
+from flask import current_app
+from sqlalchemy import text
+
+from fh_webhook.bike_tracker_services import get_day_window
+from fh_webhook.models import db
+
+SEASONS = 6
+AVAILABILITIES_PER_DAY = 40
+# Far from the ids given by FH.
+FIRST_ID = 9_000_000_000
+
+items = [
+    item_id
+    for item_ids in current_app.config["BIKE_TRACKER_ITEMS"].values()
+    for item_id in item_ids
+]
+db.session.execute(
+    text(
+        """
+        INSERT INTO item (created_at, updated_at, id, name)
+        SELECT now(), now(), item_id, 'benchmark' FROM unnest(:items) AS item_id
+        ON CONFLICT (id) DO NOTHING
+        """
+    ),
+    {"items": items},
+)
+db.session.execute(
+    text(
+        """
+        INSERT INTO availability (
+            created_at, updated_at, id, capacity, start_at, end_at, item_id
+        )
+        SELECT now(), now(), :first_id + n, 10,
+            start_at, start_at + interval '2 hours', (:items)[1 + n % :n_items]
+        FROM generate_series(0, :days * :per_day - 1) AS n,
+            LATERAL (
+                SELECT date_trunc('year', now()) - make_interval(years => :seasons)
+                    + make_interval(days => n / :per_day, mins => 15 * (n % :per_day))
+                    AS start_at
+            ) AS s
+        """
+    ),
+    {
+        "first_id": FIRST_ID,
+        "items": items,
+        "n_items": len(items),
+        "days": SEASONS * 365,
+        "per_day": AVAILABILITIES_PER_DAY,
+        "seasons": SEASONS,
+    },
+)
+db.session.execute(text("ANALYZE availability"))
+
+for_date = date(date.today().year - SEASONS // 2, 7, 21)
+day_start, day_end = get_day_window(for_date)
+tours = current_app.config["BIKE_TRACKER_ITEMS"]["regular_tours"]
+filters = (
+    ("date(start_at)", "DATE(start_at) = :for_date"),
+    ("start_at range", "start_at >= :day_start AND start_at < :day_end"),
+)
+params = {
+    "for_date": for_date,
+    "day_start": day_start,
+    "day_end": day_end,
+    "items": tours,
+}
+count = db.session.execute(text("SELECT count(*) FROM availability")).scalar()
+print(f"{count} availabilities, looking up {for_date}\n")
+for name, where in filters:
+    query = f"SELECT id FROM availability WHERE {where} AND item_id = ANY(:items)"
+    plan = db.session.execute(text(f"EXPLAIN ANALYZE {query}"), params)
+    print(f"{name}:")
+    print("\n".join(f"    {row[0]}" for row in plan))
+    number = 50
+    elapsed = timeit.timeit(
+        lambda: db.session.execute(text(query), params).fetchall(), number=number
+    )
+    print(f"    {elapsed / number * 1000:.2f} ms per lookup\n")
+
+db.session.rollback()
@@ -15,45 +15,23 @@ The script is expecting the csv to be in ./scripts/data/
 We want only to fill the bookings whose `created_by` is staff as the others
 carry the value of the company.
 
+The CSV is copied to a temp table and all the creators are applied with a single
+`UPDATE ... FROM` (see PopulateCreatedBy in fh_webhook/backfill.py), so this is the same as:
+$> flask populate-created-by scripts/data/created_by.csv
+
 To execute this script:
 $> export FLASK_APP=run.py
 $> flask shell < populate_created_by.py
-Pray.
 """
 
-import csv
 import os
-from collections import defaultdict
 
-from fh_webhook.models import Booking, db
+from fh_webhook.backfill import PopulateCreatedBy
 
 path = "scripts/data/created_by.csv"
 
 if not os.path.isfile(path):
     raise ValueError("Ensure there's a file called created_by.csv in scripts/data dir")
 
-# Prepare data
-res = defaultdict(list)
-with open(path) as f:
-    reader = csv.DictReader(f)
-    f.readline()  # usually FH downloads have an extra top line.
-    for row in reader:
-        try:
-            b_id = row["Booking ID"]
-            creator = row["Created By"]
-        except KeyError as e:
-            app.logger.exception(f"The key was not found {e}")
-            exit()
-        else:
-            res[creator].append(b_id)
-
-# Update db
-for user, bookings in res.items():
-    query = (
-        db.session.query(Booking)
-        .filter(Booking.created_by == "staff")
-        .filter(Booking.display_id.in_(bookings))
-    )
-    query.update({"created_by": user}, synchronize_session="fetch")
-
-db.session.commit()
+for user, n in PopulateCreatedBy(path).run().items():
+    print(f"{user}: {n} bookings updated")
@@ -5,7 +5,9 @@ from uuid import uuid4
 import pytest
 
 from fh_webhook import create_app, model_services
+from fh_webhook.cache import reference_cache
 from fh_webhook.models import db
+from fh_webhook.occupancy import bike_occupancy
 
 
 @pytest.fixture(scope="session")
@@ -40,6 +42,8 @@ def database(request):
     ctx.push()
     db.drop_all()
     db.create_all()
+    reference_cache.clear()
+    bike_occupancy.clear()
 
     yield db
 
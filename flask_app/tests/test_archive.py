@@ -0,0 +1,171 @@
+import json
+import os
+
+import pytest
+
+from fh_webhook import archive
+
+
+@pytest.fixture
+def journal_path(tmp_path):
+    return str(tmp_path / "journal")
+
+
+def body(n):
+    return json.dumps({"booking": {"pk": n}}).encode()
+
+
+def test_journal_round_trip(journal_path):
+    writer = archive.JournalWriter(journal_path)
+    names = [writer.append(body(n), 1000.0 + n, booking_pk=n) for n in range(3)]
+
+    records = list(archive.JournalReader(journal_path))
+    assert [r.name for r in records] == names
+    assert [r.timestamp for r in records] == [1000.0, 1001.0, 1002.0]
+    assert [r.load()["booking"]["pk"] for r in records] == [0, 1, 2]
+    assert names[0] == "0000001000.000000.jnl@0"
+
+
+def test_journal_stores_uncompressed_records(journal_path):
+    writer = archive.JournalWriter(journal_path, compress=False)
+    writer.append(body(1), 1000.0)
+    segment = archive.list_segments(journal_path)[0]
+    header_size = archive.RECORD_HEADER.size
+    with open(os.path.join(journal_path, segment), "rb") as fp:
+        assert fp.read()[header_size:] == body(1)
+    assert list(archive.JournalReader(journal_path))[0].body == body(1)
+
+
+def test_journal_rotates_segments_by_size(journal_path):
+    writer = archive.JournalWriter(journal_path, max_bytes=1)
+    for n in range(3):
+        writer.append(body(n), 1000.0 + n)
+    assert len(archive.list_segments(journal_path)) == 3
+    assert len(list(archive.JournalReader(journal_path))) == 3
+
+
+def test_journal_rotates_segments_by_age(journal_path):
+    writer = archive.JournalWriter(journal_path, max_age=10)
+    writer.append(body(0), 1000.0)
+    writer.append(body(1), 1005.0)
+    writer.append(body(2), 1010.0)
+    assert archive.list_segments(journal_path) == [
+        "0000001000.000000.jnl",
+        "0000001010.000000.jnl",
+    ]
+
+
+def test_journal_reads_the_records_appended_late_in_order(tmp_path, journal_path):
+    # The requests are stamped when they arrive but appended in lock order.
+    writer = archive.JournalWriter(journal_path, max_age=10)
+    for timestamp in (1000.0, 1003.0, 1001.0, 1010.0, 1002.0, 1011.0):
+        writer.append(body(int(timestamp)), timestamp)
+    assert len(archive.list_segments(journal_path)) == 2
+
+    records = list(archive.JournalReader(journal_path))
+    assert [r.timestamp for r in records] == [1000, 1001, 1002, 1003, 1010, 1011]
+    assert all(r.load()["booking"]["pk"] == r.timestamp for r in records)
+    since = archive.JournalReader(journal_path, since=1001.0)
+    assert [r.timestamp for r in since] == [1002, 1003, 1010, 1011]
+    (tmp_path / "1001.5.json").write_bytes(body(1))
+    merged = archive.read_archive(str(tmp_path), journal_path)
+    assert [r.timestamp for r in merged][:4] == [1000, 1001, 1001.5, 1002]
+
+
+def test_journal_read_at_and_index(journal_path):
+    writer = archive.JournalWriter(journal_path)
+    writer.append(body(7), 1000.0, booking_pk=7)
+    name = writer.append(body(8), 1001.0)
+
+    reader = archive.JournalReader(journal_path)
+    assert reader.read_at(name).load() == {"booking": {"pk": 8}}
+
+    segment, offset = name.split("@")
+    entries = list(reader.read_index(segment))
+    assert [e[:3] for e in entries] == [(1000.0, 7, 0), (1001.0, -1, int(offset))]
+
+
+def test_journal_drops_torn_records(journal_path):
+    writer = archive.JournalWriter(journal_path)
+    writer.append(body(0), 1000.0)
+    segment = os.path.join(journal_path, archive.list_segments(journal_path)[0])
+    with open(segment, "ab") as fp:
+        fp.write(writer.encode(body(1), 1001.0)[:10])  # a crash mid write
+
+    assert len(list(archive.JournalReader(journal_path))) == 1
+
+    writer.append(body(2), 1002.0)
+    records = list(archive.JournalReader(journal_path))
+    assert [r.load()["booking"]["pk"] for r in records] == [0, 2]
+
+
+def test_journal_waits_for_the_record_being_written(journal_path, caplog):
+    writer = archive.JournalWriter(journal_path, max_bytes=1)
+    writer.append(body(0), 1000.0)
+    writer.append(body(1), 1001.0)
+    older, active = [
+        os.path.join(journal_path, segment)
+        for segment in archive.list_segments(journal_path)
+    ]
+    record = writer.encode(body(2), 1002.0)
+    with open(active, "ab") as fp:
+        fp.write(record[:-5])
+
+    assert len(list(archive.JournalReader(journal_path))) == 2
+    assert caplog.messages == []
+
+    with open(older, "ab") as fp:
+        fp.write(record[:10])
+    assert len(list(archive.JournalReader(journal_path))) == 2
+    assert caplog.messages[0].startswith("Skipping torn record 0000001000.000000.jnl")
+
+
+def test_journal_skips_corrupted_records(journal_path, caplog):
+    writer = archive.JournalWriter(journal_path, compress=False)
+    writer.append(body(0), 1000.0)
+    segment = os.path.join(journal_path, archive.list_segments(journal_path)[0])
+    with open(segment, "r+b") as fp:
+        fp.seek(-2, os.SEEK_END)
+        fp.write(b"xx")
+
+    assert list(archive.JournalReader(journal_path)) == []
+    assert caplog.messages[0].startswith("Corrupted journal record")
+
+
+def test_get_file_timestamp():
+    assert archive.get_file_timestamp("1626842330.051856.json") == 1626842330.051856
+    assert archive.get_file_timestamp("1626842330.051856") is None
+    assert archive.get_file_timestamp("foo.json") is None
+
+
+def test_loose_files_reader_sorts_files_numerically(tmp_path):
+    for name in ("999.5.json", "1000.1.json", "notes.txt"):
+        (tmp_path / name).write_bytes(b"{}")
+    records = list(archive.LooseFilesReader(str(tmp_path)))
+    assert [r.name for r in records] == ["999.5.json", "1000.1.json"]
+
+
+def test_read_archive_merges_files_and_journal(tmp_path, journal_path):
+    (tmp_path / "1000.5.json").write_bytes(body(1))
+    (tmp_path / "1003.0.json").write_bytes(body(3))
+    writer = archive.JournalWriter(journal_path)
+    writer.append(body(0), 1000.0)
+    writer.append(body(2), 1002.0)
+
+    records = archive.read_archive(str(tmp_path), journal_path)
+    assert [r.load()["booking"]["pk"] for r in records] == [0, 1, 2, 3]
+
+
+def test_read_archive_since_skips_the_older_records(tmp_path, journal_path):
+    (tmp_path / "1000.5.json").write_bytes(body(1))
+    (tmp_path / "1003.0.json").write_bytes(body(3))
+    writer = archive.JournalWriter(journal_path, max_bytes=1)
+    writer.append(body(0), 1000.0)
+    writer.append(body(2), 1002.0)
+    writer.append(body(4), 1004.0)
+    reader = archive.JournalReader(journal_path, since=1002.0)
+    older, newer = archive.list_segments(journal_path)[1:]
+    assert (reader._is_older(older), reader._is_older(newer)) == (True, False)
+
+    records = archive.read_archive(str(tmp_path), journal_path, since=1000.5)
+    assert [r.load()["booking"]["pk"] for r in records] == [2, 3, 4]
@@ -0,0 +1,213 @@
+import json
+from datetime import timedelta
+
+import pytest
+from flask import current_app
+
+from fh_webhook import archive, bulk_services, models
+from fh_webhook.backfill import (
+    EXTRACTORS,
+    Backfill,
+    PopulateCreatedBy,
+    PopulateEffectivePeriod,
+    extractor,
+)
+
+SAMPLE_FILE = "tests/sample_data/sample_booking/1626842330.051856.json"
+
+
+@pytest.fixture
+def sample_data():
+    with open(SAMPLE_FILE) as response:
+        return json.load(response)
+
+
+@pytest.fixture
+def archived(database, sample_data, file_timestamp, tmp_path):
+    """Save the sample and archive it along with a later snapshot."""
+    bulk_services.BulkUpsertJSONResponse(sample_data, file_timestamp).run()
+    writer = archive.JournalWriter(str(tmp_path / "journal"))
+    writer.append(json.dumps(sample_data).encode(), file_timestamp.timestamp())
+    sample_data["booking"]["availability"]["headline"] = "Bilbao by bike"
+    sample_data["booking"]["contact"]["language"] = "es"
+    later = file_timestamp + timedelta(hours=1)
+    writer.append(json.dumps(sample_data).encode(), later.timestamp())
+    writer.append(b'{"foo": "bar"}', later.timestamp() + 1)
+
+    config = current_app.config
+    config["RESPONSES_PATH"], config["JOURNAL_PATH"] = str(tmp_path), writer.path
+    yield sample_data
+    config["RESPONSES_PATH"] = "tests/responses/"
+    config["JOURNAL_PATH"] = "tests/journal/"
+
+
+def test_builtin_extractors_are_registered():
+    assert EXTRACTORS["headline"].model is models.Availability
+    assert EXTRACTORS["customer_type_rate"].columns == ("customer_type_rate_id",)
+
+
+def test_backfill_updates_the_rows_that_differ(archived, file_timestamp):
+    service = Backfill(current_app, ["headline", "contact_language"])
+    counts = service.run()
+    models.db.session.expire_all()
+
+    assert counts["headline"] == {"found": 1, "updated": 1}
+    assert counts["contact_language"] == {"found": 1, "updated": 1}
+    av = models.Availability.get(619118440)
+    assert av.headline == "Bilbao by bike"
+    assert av.updated_at == file_timestamp
+    assert models.Contact.get(75125154).language == "es"
+
+    counts = Backfill(current_app, ["headline"]).run()
+    assert counts["headline"] == {"found": 1, "updated": 0}
+
+
+def test_backfill_parses_only_the_declared_paths(archived):
+    seen = list()
+
+    @extractor("test_paths", models.Booking, "note", paths=("booking.pk",))
+    @extractor("test_full", models.Booking, "note")
+    def booking_keys(booking):
+        seen.append(booking)
+        return []
+
+    try:
+        Backfill(current_app, ["test_paths"]).run()
+        streamed, seen[:] = list(seen), []
+        Backfill(current_app, ["test_paths", "test_full"]).run()
+    finally:
+        del EXTRACTORS["test_paths"], EXTRACTORS["test_full"]
+
+    assert streamed == [{"pk": 75125154}, {"pk": 75125154}]
+    assert seen[-1]["contact"] == archived["booking"]["contact"]
+
+
+def test_backfill_dry_run_rolls_back(archived):
+    counts = Backfill(current_app, ["headline"], dry_run=True).run()
+    models.db.session.expire_all()
+
+    assert counts["headline"] == {"found": 1, "updated": 1}
+    assert models.Availability.get(619118440).headline != "Bilbao by bike"
+
+
+def test_backfill_in_batches(archived):
+    customer = models.Customer.query.first()
+    ctr_id = customer.customer_type_rate_id
+    customer.customer_type_rate_id = (
+        models.CustomerTypeRate.query.filter(models.CustomerTypeRate.id != ctr_id)
+        .first()
+        .id
+    )
+    models.db.session.commit()
+
+    counts = Backfill(current_app, ["customer_type_rate"], batch_size=1).run()
+    models.db.session.expire_all()
+
+    assert counts["customer_type_rate"] == {"found": 1, "updated": 1}
+    assert models.Customer.get(customer.id).customer_type_rate_id == ctr_id
+
+
+def test_backfill_counts_the_extractor_errors(archived, tmp_path):
+    del archived["booking"]["customers"]
+    writer = archive.JournalWriter(str(tmp_path / "journal"))
+    writer.append(json.dumps(archived).encode(), 2_000_000_000)
+
+    service = Backfill(current_app, ["customer_type_rate", "headline"])
+    counts = service.run()
+
+    assert service.errors == 1
+    assert counts["headline"]["found"] == 1
+
+
+def test_backfill_command(archived, app, runner):
+    app.config["RESPONSES_PATH"] = current_app.config["RESPONSES_PATH"]
+    app.config["JOURNAL_PATH"] = current_app.config["JOURNAL_PATH"]
+    try:
+        result = runner.invoke(args=["backfill", "--dry-run", "headline"])
+        listed = runner.invoke(args=["backfill"])
+        unknown = runner.invoke(args=["backfill", "foo"])
+    finally:
+        app.config["RESPONSES_PATH"] = "tests/responses/"
+        app.config["JOURNAL_PATH"] = "tests/journal/"
+
+    assert result.output == "headline: 1 rows found, 1 would be updated\n"
+    assert "headline: availability.headline\n" in listed.output
+    assert unknown.exit_code == 2
+
+
+@pytest.fixture
+def created_by_csv(database, booking_factory, tmp_path):
+    """Create some bookings and the CSV FH gives with their creators."""
+    for n, created_by in enumerate(["staff", "staff", "staff", "civitatis"]):
+        booking_factory.booking_id = n + 1
+        booking_factory.display_id = f"#{n + 1}"
+        booking_factory.uuid = f"uuid-{n}"
+        booking_factory.created_by = created_by
+        booking_factory.run()
+    path = tmp_path / "created_by.csv"
+    path.write_text(
+        '"Bookings",""\n'
+        + '"Booking ID","Created By"\n'
+        + '"#1","John Doe"\n'
+        + '"#2","Jane Doe"\n'
+        + '"#2","John Doe"\n'
+        + '"#3","John Doe"\n'
+        + '"#4","John Doe"\n'
+        + '"#5","John Doe"\n'
+    )
+    return str(path)
+
+
+def test_populate_created_by(created_by_csv):
+    counts = PopulateCreatedBy(created_by_csv).run()
+    models.db.session.expire_all()
+
+    assert counts == {"Jane Doe": 1, "John Doe": 2}
+    creators = [models.Booking.get(pk).created_by for pk in range(1, 5)]
+    assert creators == ["John Doe", "Jane Doe", "John Doe", "civitatis"]
+    assert PopulateCreatedBy(created_by_csv).run() == {}
+
+
+def test_populate_created_by_command(created_by_csv, runner, tmp_path):
+    dry_run = runner.invoke(args=["populate-created-by", "--dry-run", created_by_csv])
+    models.db.session.expire_all()
+    assert models.Booking.get(1).created_by == "staff"
+    assert dry_run.output.splitlines() == [
+        "Jane Doe: 1 bookings would be updated",
+        "John Doe: 2 bookings would be updated",
+    ]
+
+    path = tmp_path / "wrong.csv"
+    path.write_text('"Booking ID","Creator"\n')
+    wrong = runner.invoke(args=["populate-created-by", str(path)])
+    assert "misses the columns Created By" in wrong.output
+
+
+@pytest.fixture
+def without_period(database, sample_data, file_timestamp):
+    """Save the sample as if it was saved before the effective period existed."""
+    bulk_services.BulkUpsertJSONResponse(sample_data, file_timestamp).run()
+    b = models.Booking.get(75125154)
+    period = (b.effective_start_at, b.effective_end_at)
+    b.effective_start_at = b.effective_end_at = None
+    models.db.session.commit()
+    return period
+
+
+def test_populate_effective_period(app, without_period):
+    assert PopulateEffectivePeriod(app).run() == 1
+    models.db.session.expire_all()
+
+    b = models.Booking.get(75125154)
+    assert (b.effective_start_at, b.effective_end_at) == without_period
+    assert PopulateEffectivePeriod(app).run() == 0
+
+
+def test_populate_effective_period_command(app, without_period, runner):
+    result = runner.invoke(args=["populate-effective-period", "--dry-run"])
+    assert result.output == "1 bookings would be updated\n"
+    models.db.session.expire_all()
+    assert models.Booking.get(75125154).effective_start_at is None
+
+    result = runner.invoke(args=["populate-effective-period"])
+    assert result.output == "1 bookings updated\n"
@@ -4,8 +4,9 @@ from uuid import uuid4
 
 import pytest
 from conftest import randomizer
+from sqlalchemy import event
 
-from fh_webhook.bike_tracker_services import DailyActivities
+from fh_webhook.bike_tracker_services import DailyActivities, get_day_window
 from fh_webhook.model_services import CreateBikeUsages
 from fh_webhook.models import Booking
 
@@ -192,6 +193,7 @@ def test_daily_activities_success_for_rental_items(
         (315001, "24.0"),
         (315002, "24.0"),
         (690082, "24.0"),
+        (123456, "2.0"),  # not in the map, the default
     ),
 )
 def test_daily_activities_success_for_rental_durations(
@@ -360,3 +362,56 @@ def test_daily_activities_does_not_show_any_tour_when_item_is_not_valid(
 
     d = DailyActivities(for_date=date.today()).run()
     assert bool(d) is expected
+
+
+def test_get_day_window_in_madrid():
+    start, end = get_day_window(date(2021, 7, 21))
+    assert start == datetime(2021, 7, 20, 22, tzinfo=timezone.utc)
+    assert end == datetime(2021, 7, 21, 22, tzinfo=timezone.utc)
+
+    # The day the clocks go forward lasts 23h.
+    start, end = get_day_window(date(2021, 3, 28))
+    assert start == datetime(2021, 3, 27, 23, tzinfo=timezone.utc)
+    assert end - start == timedelta(hours=23)
+
+
+def test_daily_activities_uses_the_madrid_day(database, booking_factory, item_factory):
+    s = item_factory
+    s.item_id = 159053
+    item = s.run()
+    b, b_id = randomizer(booking_factory.run())
+    # 00:30 of the 21st in Bilbao.
+    b.availability.start_at = datetime(2021, 7, 20, 22, 30, tzinfo=timezone.utc)
+    b.availability.end_at = datetime(2021, 7, 20, 23, 30, tzinfo=timezone.utc)
+    b.availability.item = item
+    b.rebooked_to = None
+    database.session.commit()
+
+    assert DailyActivities(for_date=date(2021, 7, 20)).run() == []
+    activities = DailyActivities(for_date=date(2021, 7, 21)).run()
+    assert [a["timestamp"] for a in activities] == ["00:30:00"]
+
+
+def test_daily_activities_in_a_single_query(database, booking_factory, item_factory):
+    s = item_factory
+    s.item_id = 159053
+    item = s.run()
+    b, b_id = randomizer(booking_factory.run())
+    b.availability.start_at = datetime.now(timezone.utc)
+    b.availability.item = item
+    b.rebooked_to = None
+    database.session.commit()
+
+    statements = list()
+
+    def collect(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(database.engine, "before_cursor_execute", collect)
+    try:
+        DailyActivities(for_date=date.today()).run()
+    finally:
+        event.remove(database.engine, "before_cursor_execute", collect)
+
+    assert len(statements) == 1
+    assert statements[0].lstrip().startswith("WITH tracked AS")
@@ -0,0 +1,262 @@
+import json
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+
+import pytest
+from flask import current_app
+
+from fh_webhook import bulk_services, metrics, models, services
+
+SAMPLE_FILE = "tests/sample_data/sample_booking/1626842330.051856.json"
+
+
+@pytest.fixture
+def sample_data(app):
+    with open(SAMPLE_FILE) as response:
+        return json.load(response)
+
+
+@pytest.fixture
+def per_entity_engine(database):
+    """Process the responses through the model services."""
+    current_app.config["PERSISTENCE_ENGINE"] = "per_entity"
+    yield
+    current_app.config["PERSISTENCE_ENGINE"] = "bulk"
+
+
+def test_collect_rows_keeps_one_row_per_pk(sample_data):
+    rows = bulk_services.CollectRows(sample_data).run().rows
+    assert len(rows[models.Item]) == 1
+    assert len(rows[models.Company]) == 2
+    assert len(rows[models.CustomerType]) == 7
+    assert len(rows[models.CustomerPrototype]) == 7
+    assert len(rows[models.CustomerTypeRate]) == 7
+    assert len(rows[models.CustomFieldInstance]) == 7
+    assert len(rows[models.CustomFieldValue]) == 5
+    assert rows[models.Customer][224262373]["customer_type_rate_id"] == 2576873546
+
+
+def test_collect_rows_counts_duplicates(sample_data):
+    collector = bulk_services.CollectRows(sample_data).run()
+    assert collector.duplicates == {
+        "customer_type": 1,
+        "customer_prototype": 1,
+        "customer_type_rate": 1,
+        "custom_field": 10,
+    }
+
+
+def test_collect_rows_keeps_last_occurrence(sample_data):
+    customer_ctr = sample_data["booking"]["customers"][0]["customer_type_rate"]
+    customer_ctr["total"] = 1
+    collector = bulk_services.CollectRows(sample_data).run()
+    assert collector.rows[models.CustomerTypeRate][2576873546]["total"] == 1
+    assert collector.duplicates["customer_type_rate"] == 1
+
+
+def test_collect_rows_resolves_created_by(sample_data):
+    collector = bulk_services.CollectRows(sample_data).run()
+    booking = collector.rows[models.Booking][75125154]
+    assert booking["created_by"] == "civitatiseuro"
+    assert collector.company_short_names == {
+        "company_id": "tournebilbao",
+        "affiliate_company_id": "civitatiseuro",
+    }
+
+
+def test_collect_rows_computes_the_effective_period(sample_data):
+    rows = bulk_services.CollectRows(sample_data).run().rows
+    booking = rows[models.Booking][75125154]
+    # A rental of eight hours.
+    start_at = datetime(2021, 4, 5, 10, 30, tzinfo=timezone.utc)
+    assert booking["effective_start_at"] == start_at
+    assert booking["effective_end_at"] == start_at + timedelta(hours=8)
+
+    sample_data["booking"]["availability"]["item"]["pk"] = 159053  # a tour
+    rows = bulk_services.CollectRows(sample_data).run().rows
+    booking = rows[models.Booking][75125154]
+    assert booking["effective_end_at"] == start_at + timedelta(minutes=30)
+
+
+def test_bulk_upsert_creates_rows(database, sample_data, file_timestamp):
+    counts = bulk_services.BulkUpsertJSONResponse(sample_data, file_timestamp).run()
+    assert counts["booking"] == 1
+    assert counts["customer_type_rate"] == 7
+
+    b = models.Booking.get(75125154)
+    assert b.company_id == models.Company.get("tournebilbao").id
+    assert b.affiliate_company_id == models.Company.get("civitatiseuro").id
+    assert b.order["display_id"] == "BBVBQV"
+    assert b.created_at == b.updated_at == file_timestamp
+
+    cf = models.CustomField.query.filter(
+        models.CustomField.extended_options.isnot(None)
+    ).first()
+    assert cf.title is None
+    assert cf.is_required is False
+
+
+def test_bulk_upsert_updates_existing_rows(database, sample_data, file_timestamp):
+    bulk_services.BulkUpsertJSONResponse(sample_data, file_timestamp).run()
+    company_id = models.Company.get("tournebilbao").id
+
+    later = file_timestamp + timedelta(hours=1)
+    sample_data["booking"]["status"] = "cancelled"
+    sample_data["booking"]["company"]["name"] = "Tourne Bilbao"
+    bulk_services.BulkUpsertJSONResponse(sample_data, later).run()
+    database.session.expire_all()
+
+    b = models.Booking.get(75125154)
+    assert b.status == "cancelled"
+    assert b.created_at == file_timestamp
+    assert b.updated_at == later
+    company = models.Company.get("tournebilbao")
+    assert company.id == company_id
+    assert company.name == "Tourne Bilbao"
+    assert len(models.Company.query.all()) == 2
+
+
+def test_bulk_upsert_rolls_back_on_error(database, sample_data, file_timestamp):
+    sample_data["booking"]["contact"]["name"] = None  # not nullable
+    with pytest.raises(Exception):
+        bulk_services.BulkUpsertJSONResponse(sample_data, file_timestamp).run()
+    assert models.Item.get_object_or_none(159068) is None
+    assert models.Booking.get_object_or_none(75125154) is None
+
+
+def test_per_entity_engine_is_still_available(
+    per_entity_engine, sample_data, file_timestamp
+):
+    assert services.ProcessJSONResponse(sample_data, file_timestamp).run() is None
+
+    assert len(models.CustomerTypeRate.query.all()) == 7
+    b = models.Booking.get(75125154)
+    assert b.created_by == "civitatiseuro"
+    assert b.effective_end_at - b.effective_start_at == timedelta(hours=8)
+
+
+def test_per_entity_engine_leaves_an_unchanged_booking_alone(
+    per_entity_engine, sample_data, file_timestamp
+):
+    services.ProcessJSONResponse(sample_data, file_timestamp).run()
+    later = file_timestamp + timedelta(hours=1)
+    metrics.reset()
+    services.ProcessJSONResponse(sample_data, later).run()
+
+    counters = metrics.get_counters()
+    assert not [name for name in counters if name.endswith(".changed")]
+    assert counters["availability.unchanged"] == 1
+    assert counters["effective_cancellation_policy.unchanged"] == 1
+    assert models.Availability.get(619118440).updated_at == file_timestamp
+
+
+@pytest.mark.parametrize("engine", ["bulk", "per_entity"])
+def test_rescheduling_moves_the_other_bookings(
+    engine, database, booking_factory, sample_data, file_timestamp, monkeypatch
+):
+    monkeypatch.setitem(current_app.config, "PERSISTENCE_ENGINE", engine)
+    services.ProcessJSONResponse(sample_data, file_timestamp).run()
+    av = models.Availability.get(619118440)
+    s = booking_factory
+    s.availability_id = av.id
+    s.effective_start_at, s.effective_end_at = av.start_at, av.end_at
+    other_id = s.run().id
+
+    later = file_timestamp + timedelta(hours=1)
+    sample_data["booking"]["availability"]["start_at"] = "2021-04-06T12:30:00+0200"
+    sample_data["booking"]["availability"]["end_at"] = "2021-04-06T13:00:00+0200"
+    services.ProcessJSONResponse(sample_data, later).run()
+    database.session.expire_all()
+
+    start_at = datetime(2021, 4, 6, 10, 30, tzinfo=timezone.utc)
+    other = models.Booking.get(other_id)
+    assert other.effective_start_at == start_at
+    assert other.effective_end_at == start_at + timedelta(minutes=30)
+    b = models.Booking.get(75125154)
+    assert b.effective_end_at == start_at + timedelta(hours=8)
+
+
+@patch("fh_webhook.model_services.UpdateCustomField.run")
+@patch("fh_webhook.model_services.UpdateCustomerTypeRate.run")
+def test_per_entity_engine_saves_repeated_entities_once(
+    ctr_mock, cf_mock, per_entity_engine, sample_data, file_timestamp
+):
+    service = services.ProcessJSONResponse(sample_data, file_timestamp)
+    service.run()
+
+    assert ctr_mock.call_count == 0
+    assert cf_mock.call_count == 0
+    assert service.duplicates["customer_type_rate"] == 1
+    assert service.duplicates["custom_field"] == 10
+
+
+@pytest.mark.parametrize("engine", ["bulk", "per_entity"])
+def test_engines_keep_the_last_of_differing_duplicates(
+    engine, database, sample_data, file_timestamp
+):
+    current_app.config["PERSISTENCE_ENGINE"] = engine
+    customer_ctr = sample_data["booking"]["customers"][0]["customer_type_rate"]
+    customer_ctr["total"] = 1
+    try:
+        services.ProcessJSONResponse(sample_data, file_timestamp).run()
+    finally:
+        current_app.config["PERSISTENCE_ENGINE"] = "bulk"
+    database.session.expire_all()
+
+    assert models.CustomerTypeRate.get(2576873546).total == 1
+
+
+def test_bulk_upsert_leaves_unchanged_rows_alone(database, sample_data, file_timestamp):
+    service = bulk_services.BulkUpsertJSONResponse(sample_data, file_timestamp)
+    service.run()
+    assert service.changes["booking"] == {"changed": 1, "unchanged": 0}
+
+    later = file_timestamp + timedelta(hours=1)
+    sample_data["booking"]["status"] = "cancelled"
+    service = bulk_services.BulkUpsertJSONResponse(sample_data, later)
+    counts = service.run()
+    database.session.expire_all()
+
+    assert counts["booking"] == 1
+    assert service.changes["booking"] == {"changed": 1, "unchanged": 0}
+    assert service.changes["custom_field"] == {"changed": 0, "unchanged": 12}
+    assert service.changes["company"] == {"changed": 0, "unchanged": 2}
+    assert models.Booking.get(75125154).updated_at == later
+    assert models.Item.get(159068).updated_at == file_timestamp
+    b = models.Booking.get(75125154)
+    assert b.company_id == models.Company.get("tournebilbao").id
+    assert b.affiliate_company_id == models.Company.get("civitatiseuro").id
+
+
+def test_unordered_upsert_keeps_the_newest_values(
+    database, sample_data, file_timestamp
+):
+    later = file_timestamp + timedelta(hours=1)
+    sample_data["booking"]["availability"]["item"]["name"] = "Alquiler"
+    bulk_services.BulkUpsertJSONResponse(sample_data, later, unordered=True).run()
+
+    sample_data["booking"]["availability"]["item"]["name"] = "Rental"
+    service = bulk_services.BulkUpsertJSONResponse(
+        sample_data, file_timestamp, unordered=True
+    )
+    service.run()
+    database.session.expire_all()
+
+    item = models.Item.get(159068)
+    assert item.name == "Alquiler"
+    assert (item.created_at, item.updated_at) == (file_timestamp, later)
+    assert service.changes["item"] == {"changed": 1, "unchanged": 0}
+    b = models.Booking.get(75125154)
+    assert b.company_id == models.Company.get("tournebilbao").id
+
+
+def test_bulk_upsert_can_backdate_the_rows_created(
+    database, sample_data, file_timestamp
+):
+    later = file_timestamp + timedelta(hours=1)
+    bulk_services.BulkUpsertJSONResponse(
+        sample_data, later, created_at=file_timestamp
+    ).run()
+
+    b = models.Booking.get(75125154)
+    assert (b.created_at, b.updated_at) == (file_timestamp, later)
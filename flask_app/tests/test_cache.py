@@ -0,0 +1,175 @@
+import json
+import threading
+from datetime import timedelta
+from unittest.mock import patch
+
+import pytest
+from sqlalchemy import event
+
+from fh_webhook import bulk_services, model_services, models
+from fh_webhook.cache import ReferenceCache, reference_cache
+from fh_webhook.identity_map import IdentityMap
+
+SAMPLE_FILE = "tests/sample_data/sample_booking/1626842330.051856.json"
+
+
+@pytest.fixture
+def sample_data():
+    with open(SAMPLE_FILE) as response:
+        return json.load(response)
+
+
+@pytest.fixture
+def statements(database):
+    """Collect the statements sent to the db."""
+    sent = list()
+
+    def collect(conn, cursor, statement, *args):
+        sent.append(statement)
+
+    event.listen(database.engine, "before_cursor_execute", collect)
+    yield sent
+    event.remove(database.engine, "before_cursor_execute", collect)
+
+
+def test_reference_cache_counts_hits_and_misses():
+    cache = ReferenceCache()
+    assert cache.get(models.Item, 1) is None
+    cache.set(models.Item, 1, {"id": 1})
+    assert cache.get(models.Item, 1) == {"id": 1}
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_reference_cache_expires_entries():
+    cache = ReferenceCache(ttl=10)
+    with patch("fh_webhook.cache.time.monotonic", return_value=100):
+        cache.set(models.Item, 1, {"id": 1})
+    with patch("fh_webhook.cache.time.monotonic", return_value=109):
+        assert cache.get(models.Item, 1) == {"id": 1}
+    with patch("fh_webhook.cache.time.monotonic", return_value=110):
+        assert cache.get(models.Item, 1) is None
+    assert len(cache) == 0
+
+
+def test_reference_cache_evicts_the_least_recently_used():
+    cache = ReferenceCache(max_size=2)
+    cache.set(models.Item, 1, {"id": 1})
+    cache.set(models.Item, 2, {"id": 2})
+    cache.get(models.Item, 1)
+    cache.set(models.Item, 3, {"id": 3})
+    assert cache.get(models.Item, 2) is None
+    assert cache.get(models.Item, 1) == {"id": 1}
+    assert cache.get(models.Item, 3) == {"id": 3}
+
+
+def test_reference_cache_invalidate_and_disable():
+    cache = ReferenceCache()
+    cache.set(models.Item, 1, {"id": 1})
+    cache.invalidate(models.Item, 1)
+    assert cache.get(models.Item, 1) is None
+
+    cache.configure(ttl=0, max_size=10)
+    cache.set(models.Item, 1, {"id": 1})
+    assert len(cache) == 0
+
+
+def test_reference_cache_is_thread_safe():
+    cache = ReferenceCache(max_size=50)
+
+    def work(n):
+        for i in range(1000):
+            cache.set(models.Item, (n, i % 100), {"id": i})
+            cache.get(models.Item, (n, (i + 1) % 100))
+
+    threads = [threading.Thread(target=work, args=(n,)) for n in range(8)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    assert len(cache) == 50
+    assert cache.hits + cache.misses == 8000
+
+
+def test_get_object_or_none_uses_the_cache(item_factory, statements):
+    item_id = item_factory.run().id
+    models.db.session.expunge_all()
+
+    assert models.Item.get_object_or_none(item_id).name == "foo"
+    models.db.session.expunge_all()
+    statements.clear()
+
+    cached = models.Item.get_object_or_none(item_id)
+    assert cached.name == "foo"
+    assert cached in models.db.session
+    assert statements == []
+
+
+def test_get_object_or_none_does_not_cache_missing_rows(database):
+    assert models.Item.get_object_or_none(1) is None
+    assert len(reference_cache) == 0
+
+
+def test_company_is_cached_by_short_name(company_factory, statements):
+    company = company_factory.run()
+    company_id, short_name = company.id, company.short_name
+    models.db.session.expunge_all()
+    models.Company.get_object_or_none(short_name)
+    models.db.session.expunge_all()
+    statements.clear()
+
+    assert models.Company.get_object_or_none(short_name).id == company_id
+    assert statements == []
+
+
+def test_updates_invalidate_the_cache(database, item_factory, file_timestamp):
+    item_id = item_factory.run().id
+    models.Item.get_object_or_none(item_id)
+
+    later = file_timestamp + timedelta(hours=1)
+    model_services.UpdateItem(item_id, "renamed", later).run()
+    models.db.session.expunge_all()
+
+    assert reference_cache.get(models.Item, item_id) is None
+    assert models.Item.get_object_or_none(item_id).name == "renamed"
+
+
+def test_bulk_upsert_sends_the_cached_reference_rows(
+    database, sample_data, file_timestamp, statements
+):
+    bulk_services.BulkUpsertJSONResponse(sample_data, file_timestamp).run()
+    assert models.Item.get_object_or_none(159068).name == "Alquiler Urbana"
+    # Renamed by some other worker, so the cache is stale.
+    database.session.execute("UPDATE item SET name = 'renamed' WHERE id = 159068")
+    database.session.commit()
+    statements.clear()
+
+    later = file_timestamp + timedelta(hours=1)
+    service = bulk_services.BulkUpsertJSONResponse(sample_data, later)
+    service.run()
+    database.session.expire_all()
+
+    inserts = [s.split(" (")[0] for s in statements if s.startswith("INSERT")]
+    assert "INSERT INTO item" in inserts
+    assert "INSERT INTO company" in inserts
+    assert service.changes["item"] == {"changed": 1, "unchanged": 0}
+    assert service.changes["company"] == {"changed": 0, "unchanged": 2}
+    assert reference_cache.get(models.Item, 159068) is None
+    b = models.Booking.get(75125154)
+    assert b.company_id == models.Company.get("tournebilbao").id
+    assert models.Item.get(159068).name == "Alquiler Urbana"
+
+
+def test_identity_map_loads_the_reference_data_from_the_db(
+    database, sample_data, file_timestamp
+):
+    bulk_services.BulkUpsertJSONResponse(sample_data, file_timestamp).run()
+    IdentityMap(sample_data).run()
+    assert models.Company.get_object_or_none("civitatiseuro").name == "Civitatis - EUR"
+    database.session.execute(
+        "UPDATE company SET name = 'renamed' WHERE short_name = 'civitatiseuro'"
+    )
+    database.session.commit()
+    database.session.expunge_all()
+
+    identity_map = IdentityMap(sample_data).run()
+
+    assert identity_map.get(models.Company, "civitatiseuro").name == "renamed"
+    assert len(identity_map.instances[models.CustomField]) == 12
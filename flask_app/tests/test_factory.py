@@ -9,6 +9,8 @@ from uuid import uuid4
 import jwt
 from decouple import config
 
+from fh_webhook import metrics
+from fh_webhook.archive import JournalReader, JournalWriter
 from fh_webhook.models import Booking, StoredRequest
 from fh_webhook.result import Result
 from tests.conftest import randomizer
@@ -61,11 +63,15 @@ def test_dummy_webhook_saves_content_to_a_file(keys_svc, client, database):
     with open("tests/sample_data/sample_booking/1626842330.051856.json") as f:
         data = json.load(f)
 
-    response = client.post(
-        "/",
-        headers=get_headers(),
-        json=data,
-    )
+    client.application.config["ARCHIVE_FORMAT"] = "files"
+    try:
+        response = client.post(
+            "/",
+            headers=get_headers(),
+            json=data,
+        )
+    finally:
+        client.application.config["ARCHIVE_FORMAT"] = "journal"
 
     files_in_dir = os.listdir(path)
     assert response.status_code == 200
@@ -81,9 +87,91 @@ def test_dummy_webhook_saves_content_to_a_file(keys_svc, client, database):
     [os.remove(os.path.join(path, f)) for f in os.listdir(path)]
 
 
+@patch("fh_webhook.views.webhook_views.get_journal_writer")
+def test_dummy_webhook_appends_content_to_the_journal(
+    writer_factory, client, database, tmp_path
+):
+    writer_factory.return_value = JournalWriter(str(tmp_path))
+    with open("tests/sample_data/sample_booking/1626842330.051856.json") as f:
+        data = json.load(f)
+
+    response = client.post("/", headers=get_headers(), json=data)
+
+    assert response.status_code == 200
+    records = list(JournalReader(str(tmp_path)))
+    assert len(records) == 1
+    assert records[0].load() == data
+    stored_request = StoredRequest.query.one()
+    assert stored_request.filename == records[0].name
+
+
+@patch("fh_webhook.views.webhook_views.get_journal_writer")
+def test_booking_history(writer_factory, client, database, tmp_path):
+    writer_factory.return_value = JournalWriter(str(tmp_path))
+    client.application.config["JOURNAL_PATH"] = str(tmp_path)
+    with open("tests/sample_data/sample_booking/1626842330.051856.json") as f:
+        data = json.load(f)
+    try:
+        client.post("/", headers=get_headers(), json=data)
+        data["booking"]["status"] = "cancelled"
+        client.post("/", headers=get_headers(), json=data)
+
+        by_pk = client.get("/bookings/75125154/history/", headers=get_headers())
+        uuid = data["booking"]["uuid"]
+        by_uuid = client.get(f"/bookings/{uuid}/history/", headers=get_headers())
+        availability_id = data["booking"]["availability"]["pk"]
+        by_availability = client.get(
+            f"/availabilities/{availability_id}/history/", headers=get_headers()
+        )
+        unknown = client.get("/bookings/1/history/", headers=get_headers())
+    finally:
+        client.application.config["JOURNAL_PATH"] = "tests/journal/"
+
+    history = by_pk.json
+    assert [h["request"]["booking"]["status"] for h in history] == [
+        "booked",
+        "cancelled",
+    ]
+    assert history[0]["name"] == StoredRequest.query.order_by("id").first().filename
+    assert by_uuid.json == history
+    assert by_availability.json == history
+    assert unknown.json == []
+
+
+@patch("fh_webhook.views.webhook_views.get_journal_writer")
+def test_dummy_webhook_keeps_the_raw_body(writer_factory, client, database, tmp_path):
+    writer_factory.return_value = JournalWriter(str(tmp_path))
+    with open("tests/sample_data/sample_booking/1626842330.051856.json", "rb") as f:
+        raw_body = f.read()  # indented, so any reserialization would change it
+
+    response = client.post(
+        "/", headers=get_headers(), data=raw_body, content_type="application/json"
+    )
+
+    assert response.status_code == 200
+    record = next(iter(JournalReader(str(tmp_path))))
+    assert record.body == raw_body
+    assert StoredRequest.query.one().body == raw_body.decode()
+    assert Booking.get(75125154).display_id == "#75125154"
+
+
+def test_dummy_webhook_rejects_invalid_json(client, caplog):
+    response = client.post(
+        "/",
+        headers=get_headers(),
+        data=b'{"booking": ',
+        content_type="application/json",
+    )
+
+    assert response.status_code == 400
+    assert response.data == b"The request is not a valid JSON"
+    assert caplog.records[0].msg.startswith("Unable to parse the request")
+
+
 @patch("fh_webhook.services.ProcessJSONResponse.run")
 @patch(
-    "fh_webhook.services.SaveResponseAsFile.run", return_value="1626842330.051856.json"
+    "fh_webhook.services.SaveResponseToJournal.run",
+    return_value="1626842330.051856.jnl@0",
 )
 def test_dummy_webhook_does_not_find_new_keys(
     save_file_svc, process_svc, client, database, caplog
@@ -105,7 +193,8 @@ def test_dummy_webhook_does_not_find_new_keys(
 
 
 @patch(
-    "fh_webhook.services.SaveResponseAsFile.run", return_value="1626842330.051856.json"
+    "fh_webhook.services.SaveResponseToJournal.run",
+    return_value="1626842330.051856.jnl@0",
 )
 def test_dummy_webhook_trows_requests_with_missing_data_to_a_log(
     file_svc, client, database, caplog
@@ -125,7 +214,7 @@ def test_dummy_webhook_trows_requests_with_missing_data_to_a_log(
     response_msg = "{'display_id': ['Missing data for required field.']}"
     assert response.status_code == 400
     assert response.data.decode() == response_msg
-    assert caplog.records[0].msg.startswith("filename=")
+    assert caplog.records[0].msg.startswith("filename=1626842330.051856.jnl@0,")
 
 
 def test_dummy_webhook_trows_empty_requests_to_a_log(client, caplog):
@@ -406,3 +495,41 @@ def test_replace_bikes_failure(client):
     assert response.status_code == 404
     assert mock_svc.call_count == 1
     assert response.json == {"error": "some error"}
+
+
+@patch("fh_webhook.services.ProcessJSONResponse.run")
+@patch(
+    "fh_webhook.services.SaveResponseToJournal.run",
+    return_value="1626842330.051856.jnl@0",
+)
+def test_webhook_only_stores_requests_in_async_mode(
+    save_file_svc, process_svc, client, database
+):
+    with open("tests/sample_data/sample_booking/1626842330.051856.json") as f:
+        data = json.load(f)
+
+    client.application.config["ASYNC_INGESTION"] = True
+    try:
+        response = client.post("/", headers=get_headers(), json=data)
+    finally:
+        client.application.config["ASYNC_INGESTION"] = False
+
+    assert response.status_code == 200
+    assert process_svc.call_count == 0
+    stored_request = StoredRequest.query.one()
+    assert stored_request.processed_at is None
+
+    response = client.get("/queue-depth/", headers=get_headers())
+    assert response.json == {"queue_depth": 1}
+
+
+def test_metrics_shows_the_worker_counters(client):
+    metrics.reset()
+    metrics.increment("redeliveries_skipped")
+    metrics.increment("redeliveries_skipped")
+
+    response = client.get("/metrics/", headers=get_headers())
+
+    assert response.status_code == 200
+    assert response.json == {"redeliveries_skipped": 2}
+    metrics.reset()
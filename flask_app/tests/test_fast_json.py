@@ -0,0 +1,56 @@
+from unittest.mock import patch
+
+import pytest
+
+from fh_webhook import fast_json
+
+
+def test_loads_parses_bytes_and_str():
+    assert fast_json.loads(b'{"pk": 1, "name": "\\u00f1"}') == {"pk": 1, "name": "ñ"}
+    assert fast_json.loads('{"total": 12.5}') == {"total": 12.5}
+
+
+def test_loads_falls_back_to_json():
+    with patch.object(fast_json, "orjson", None):
+        assert fast_json.loads(b'[1, 2, {"a": null}]') == [1, 2, {"a": None}]
+
+
+SAMPLE_FILE = "tests/sample_data/sample_booking/1626842330.051856.json"
+PATHS = [
+    "booking.pk",
+    "booking.availability.pk",
+    "booking.contact",
+    "booking.customers.*.customer_type_rate.pk",
+    "booking.missing",
+]
+
+
+def test_extract_builds_only_the_paths():
+    with open(SAMPLE_FILE, "rb") as f:
+        body = f.read()
+    full = fast_json.loads(body)["booking"]
+
+    streamed = fast_json.extract(body, PATHS)
+    with patch.object(fast_json, "ijson", None):
+        pruned = fast_json.extract(body, PATHS)
+
+    assert streamed == pruned
+    assert streamed["booking"] == {
+        "pk": full["pk"],
+        "availability": {"pk": full["availability"]["pk"]},
+        "contact": full["contact"],
+        "customers": [
+            {"customer_type_rate": {"pk": c["customer_type_rate"]["pk"]}}
+            for c in full["customers"]
+        ],
+    }
+
+
+@pytest.mark.parametrize("ijson", [fast_json.ijson, None])
+def test_extract_values(ijson):
+    with patch.object(fast_json, "ijson", ijson):
+        assert fast_json.extract(b'{"a": [1, 2], "b": 1.5}', ["a"]) == {"a": [1, 2]}
+        assert fast_json.extract(b'{"a": 1.5, "b": {}}', ["a"]) == {"a": 1.5}
+        assert fast_json.extract('[{"a": null, "b": 2}]', ["*.a"]) == [{"a": None}]
+        with pytest.raises(ValueError):
+            fast_json.extract(b'{"a": ', ["a"])
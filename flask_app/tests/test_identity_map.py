@@ -0,0 +1,54 @@
+import json
+
+import pytest
+from sqlalchemy import event
+
+from fh_webhook import bulk_services, models
+from fh_webhook.identity_map import IdentityMap
+
+SAMPLE_FILE = "tests/sample_data/sample_booking/1626842330.051856.json"
+
+
+@pytest.fixture
+def sample_data():
+    with open(SAMPLE_FILE) as response:
+        return json.load(response)
+
+
+def test_identity_map_is_empty_for_new_responses(database, sample_data):
+    identity_map = IdentityMap(sample_data).run()
+    assert identity_map.get(models.Booking, 75125154) is None
+    assert identity_map.get(models.Company, "tournebilbao") is None
+
+
+def test_identity_map_loads_existing_instances(database, sample_data, file_timestamp):
+    bulk_services.BulkUpsertJSONResponse(sample_data, file_timestamp).run()
+
+    identity_map = IdentityMap(sample_data).run()
+    assert identity_map.get(models.Booking, 75125154).id == 75125154
+    assert identity_map.get(models.Company, "civitatiseuro").name == "Civitatis - EUR"
+    assert len(identity_map.instances[models.CustomerTypeRate]) == 7
+    assert len(identity_map.instances[models.CustomField]) == 12
+
+
+def test_identity_map_runs_one_query_per_table(database, sample_data, file_timestamp):
+    bulk_services.BulkUpsertJSONResponse(sample_data, file_timestamp).run()
+    statements = list()
+
+    def count(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    engine = database.engine
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        IdentityMap(sample_data).run()
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+    assert len(statements) == len(bulk_services.UPSERT_ORDER)
+
+
+def test_identity_map_add(database, sample_data):
+    identity_map = IdentityMap(sample_data).run()
+    item = models.Item(id=159068, name="foo")
+    assert identity_map.add(models.Item, 159068, item) is item
+    assert identity_map.get(models.Item, 159068) is item
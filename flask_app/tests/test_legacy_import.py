@@ -0,0 +1,189 @@
+import csv
+import json
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from fh_webhook import models
+from fh_webhook.legacy_import import (
+    AVAILABILITY_COLUMNS,
+    BOOKING_COLUMNS,
+    LegacyImport,
+)
+
+CREATED = {"create_date": "2019-05-01", "create_time": "10:30:00"}
+
+
+def write_csv(path, columns, rows):
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, columns)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({**CREATED, **row})
+    return str(path)
+
+
+def availability_row(av_id, article_id, **values):
+    row = {
+        "av_id": av_id,
+        "article_id": article_id,
+        "start_date": "2019-06-01",
+        "start_hour": "10:00",
+        "public_header": "Bilbao tour",
+    }
+    row.update(values)
+    return row
+
+
+def booking_row(pk, av_id, **values):
+    row = {
+        "id": pk,
+        "av_id": av_id,
+        "voucher": "",
+        "pax": "2",
+        "notes": "",
+        "cancelled": "",
+        "subtotal": "50.0",
+        "tax_total": "10.5",
+        "total": "60.50",
+        "invoice_total": "12.345",
+        "opt_in_txt": "Subscribed",
+        "affiliate": "",
+        "contact": "Foo Bar",
+        "email": "foo@bar.baz",
+        "language": "ES",
+        "phone": "",
+        "opt_in_email": "",
+    }
+    row.update(values)
+    return row
+
+
+@pytest.fixture
+def legacy_csvs(database, item_factory, company_factory, tmp_path):
+    item_factory.item_id = 1001
+    item_factory.run()
+    item_factory.item_id = 1003
+    item_factory.run()
+    company_id = company_factory.run().id
+    availabilities = write_csv(
+        tmp_path / "availabilities.csv",
+        AVAILABILITY_COLUMNS,
+        [
+            availability_row("1", "#1001"),
+            availability_row("2", "1003"),
+            availability_row("3", "#1002"),
+            availability_row("4", "1001", start_date="2019-02-30"),
+            availability_row("2", "1001"),
+        ],
+    )
+    bookings = write_csv(
+        tmp_path / "bookings.csv",
+        BOOKING_COLUMNS + ("unused",),
+        [
+            booking_row("10", "1", affiliate="Civitatis"),
+            booking_row("11", "2", cancelled="Cancelled", notes="Back, on time"),
+            booking_row("12", "3"),
+            booking_row("13", "1", total="60"),
+            booking_row("14", "1", affiliate="Unknown"),
+            booking_row("10", "2"),
+        ],
+    )
+    return {
+        "availabilities_path": availabilities,
+        "bookings_path": bookings,
+        "rejected_path": str(tmp_path / "rejected.csv"),
+        "thirty_min_articles": ["1003"],
+        "affiliates": {"Civitatis": company_id, "Unknown": company_id + 100},
+    }
+
+
+def test_legacy_import_merges_the_valid_rows(legacy_csvs):
+    counts = LegacyImport(**legacy_csvs).run()
+
+    assert counts["availability"] == {"read": 5, "rejected": 3, "inserted": 2}
+    assert counts["booking"] == {"read": 6, "rejected": 4, "inserted": 2}
+    assert counts["contact"]["inserted"] == 2
+
+    created_at = datetime(2019, 5, 1, 10, 30, tzinfo=timezone.utc)
+    start_at = datetime(2019, 6, 1, 10, tzinfo=timezone.utc)
+    av = models.Availability.get(1)
+    assert (av.item_id, av.created_at, av.start_at) == (1001, created_at, start_at)
+    assert av.end_at - av.start_at == timedelta(hours=24)
+    av = models.Availability.get(2)
+    assert (av.item_id, av.end_at - av.start_at) == (1003, timedelta(minutes=30))
+
+    b = models.Booking.get(10)
+    assert (b.receipt_subtotal, b.receipt_taxes) == (5000, 1050)
+    assert (b.receipt_total, b.invoice_price) == (6050, 1234)
+    assert (b.display_id, b.status, b.created_by) == ("#10", "booked", "staff")
+    assert b.affiliate_company_id == legacy_csvs["affiliates"]["Civitatis"]
+    assert b.is_subscribed_for_sms_updates is True
+    assert len(b.uuid) == 32
+    b = models.Booking.get(11)
+    assert (b.status, b.note, b.affiliate_company_id) == (
+        "cancelled",
+        "Back, on time",
+        None,
+    )
+    contact = models.Contact.get(10)
+    assert (contact.name, contact.phone, contact.phone_country) == ("Foo Bar", "", "ES")
+    assert contact.is_subscribed_for_email_updates is False
+
+
+def test_legacy_import_reports_the_rejected_rows(legacy_csvs):
+    LegacyImport(**legacy_csvs).run()
+
+    with open(legacy_csvs["rejected_path"]) as f:
+        rejected = list(csv.DictReader(f))
+    reasons = [(r["file"], r["line"], r["reason"]) for r in rejected]
+    assert reasons == [
+        ("availabilities", "4", "unknown item"),
+        ("availabilities", "5", "invalid start date"),
+        ("availabilities", "6", "duplicated av_id"),
+        ("bookings", "4", "unknown availability"),
+        ("bookings", "5", "invalid price"),
+        ("bookings", "6", "unknown affiliate company"),
+        ("bookings", "7", "duplicated id"),
+    ]
+    assert json.loads(rejected[0]["row"])["article_id"] == "#1002"
+
+
+def test_legacy_import_leaves_the_existing_rows(legacy_csvs):
+    LegacyImport(**legacy_csvs).run()
+    models.Booking.get(10).note = "From the webhook"
+    models.db.session.commit()
+
+    counts = LegacyImport(**legacy_csvs).run()
+
+    assert counts["availability"]["inserted"] == 0
+    assert counts["booking"]["inserted"] == 0
+    assert models.Booking.get(10).note == "From the webhook"
+
+
+def test_legacy_import_checks_the_columns(database, tmp_path):
+    path = write_csv(tmp_path / "availabilities.csv", ["av_id"], [])
+    with pytest.raises(ValueError, match="misses the columns article_id"):
+        LegacyImport(path, path, str(tmp_path / "rejected.csv")).run()
+
+
+def test_import_legacy_command(legacy_csvs, app, runner):
+    result = runner.invoke(
+        args=[
+            "import-legacy",
+            legacy_csvs["availabilities_path"],
+            legacy_csvs["bookings_path"],
+            "--rejected",
+            legacy_csvs["rejected_path"],
+            "--thirty-min-articles",
+            "1003,1004",
+            "--affiliates",
+            json.dumps(legacy_csvs["affiliates"]),
+        ]
+    )
+
+    assert result.output.splitlines() == [
+        "availability: 5 rows read, 3 rejected, 2 inserted",
+        "booking: 6 rows read, 4 rejected, 2 inserted",
+        "contact: 6 rows read, 4 rejected, 2 inserted",
+    ]
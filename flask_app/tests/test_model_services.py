@@ -1,11 +1,13 @@
 from datetime import datetime, timedelta, timezone
 from random import randint
+from unittest.mock import patch
 from uuid import uuid4
 
 import pytest
 from sqlalchemy.exc import IntegrityError
 
 from fh_webhook import model_services, models
+from fh_webhook.backfill import PopulateEffectivePeriod
 from fh_webhook.exceptions import DoesNotExist
 from fh_webhook.model_services import BikeOperations, bikes_in_use
 
@@ -66,6 +68,20 @@ def test_update_item(database, item_factory):
     assert item.updated_at == timestamp
 
 
+@patch("fh_webhook.metrics.increment")
+def test_update_item_leaves_unchanged_items_alone(metrics_mock, database, item_factory):
+    old_item = item_factory.run()
+    updated_at = old_item.updated_at
+    timestamp = datetime.now(timezone.utc)
+    s = model_services.UpdateItem(
+        item_id=old_item.id, name=old_item.name, timestamp=timestamp
+    )
+    s.run()
+    item = models.Item.get(old_item.id)
+    assert item.updated_at == updated_at
+    metrics_mock.assert_called_once_with("item.unchanged")
+
+
 def test_delete_item(database, item_factory):
     item = item_factory.run()
     model_services.DeleteItem(item.id).run()
@@ -984,6 +1000,7 @@ def test_get_bikes_in_use_for_tours(
     database.session.commit()
 
     bike_uuids = [bike.uuid for bike in bikes]
+    PopulateEffectivePeriod(client.application).run()
     r = bikes_in_use(bike_uuids, now)
     assert r == {bike.uuid for bike in bikes[:2]}
 
@@ -1043,10 +1060,144 @@ def test_get_bikes_in_use_for_rentals(
     database.session.commit()
 
     bike_uuids = [bike.uuid for bike in bikes]
+    PopulateEffectivePeriod(client.application).run()
     r = bikes_in_use(bike_uuids, now)
     assert r == {bike.uuid for bike in bikes[:2]}
 
 
+@pytest.mark.parametrize(
+    "customer_type_id, started, in_use",
+    [(315001, timedelta(hours=30), True), (314998, timedelta(hours=30), False)],
+)
+def test_get_bikes_in_use_for_several_days_rentals(
+    client,
+    database,
+    availability_factory,
+    bike_factory,
+    item_factory,
+    booking_factory,
+    customer_type_factory,
+    customer_type_rate_factory,
+    customer_factory,
+    customer_type_id,
+    started,
+    in_use,
+):
+    now = datetime.now(timezone.utc)
+    s = item_factory
+    s.item_id = client.application.config["BIKE_TRACKER_ITEMS"]["rentals"][0]
+    item = s.run()
+
+    s = availability_factory
+    s.availability_id = randint(1, 10_000)
+    s.start_at = now - started
+    s.end_at = now - started + timedelta(minutes=30)
+    s.item_id = item.id
+    av1 = s.run()
+
+    s = booking_factory
+    s.booking_id = randint(1, 10_000)
+    s.uuid = uuid4().hex
+    s.availability_id = av1.id
+    s.rebooked_to = None
+    b = s.run()
+
+    ct = customer_type_factory(customer_type_id=customer_type_id)
+    s = customer_type_rate_factory
+    s.ctr_id = randint(1, 10_000)
+    s.customer_type_id = ct.id
+    ctr = s.run()
+    s = customer_factory
+    s.booking_id = b.id
+    s.customer_type_rate_id = ctr.id
+    s.run()
+
+    bike = bike_factory()
+    av1.bike_usages = [bike]
+    database.session.commit()
+
+    PopulateEffectivePeriod(client.application).run()
+    assert bikes_in_use([bike.uuid], now) == ({bike.uuid} if in_use else set())
+
+
+def test_get_bikes_in_use_skips_the_bookings_without_period(
+    client, database, availability_factory, bike_factory, item_factory, booking_factory
+):
+    s = item_factory
+    s.item_id = client.application.config["BIKE_TRACKER_ITEMS"]["regular_tours"][0]
+    item = s.run()
+
+    now = datetime.now(timezone.utc)
+    s = availability_factory
+    s.availability_id = randint(1, 10_000)
+    s.start_at = now - timedelta(hours=1)
+    s.end_at = now + timedelta(hours=1)
+    s.item_id = item.id
+    av1 = s.run()
+
+    s = booking_factory
+    s.booking_id = randint(1, 10_000)
+    s.uuid = uuid4().hex
+    s.availability_id = av1.id
+    s.rebooked_to = None
+    s.run()
+
+    bike = bike_factory()
+    av1.bike_usages = [bike]
+    database.session.commit()
+
+    # Not populated yet.
+    assert bikes_in_use([bike.uuid], now) == set()
+    PopulateEffectivePeriod(client.application).run()
+    assert bikes_in_use([bike.uuid], now) == {bike.uuid}
+    assert bikes_in_use([bike.uuid], now + timedelta(hours=2)) == set()
+
+
+def booking_data(item_id, *customer_type_ids):
+    return {
+        "availability": {
+            "start_at": "2021-04-05T12:30:00+0200",
+            "end_at": "2021-04-05T13:00:00+0200",
+            "item": {"pk": item_id},
+        },
+        "customers": [
+            {"customer_type_rate": {"customer_type": {"pk": ct}}}
+            for ct in customer_type_ids
+        ],
+    }
+
+
+@pytest.mark.parametrize(
+    "item, customer_type_ids, duration",
+    [
+        ("regular_tours", (314997,), timedelta(minutes=30)),
+        ("rentals", (314997, 315001), timedelta(days=2)),
+        ("rentals", (314998, 123456), timedelta(hours=4)),
+        ("rentals", (123456,), timedelta(minutes=30)),
+    ],
+)
+def test_get_effective_period(app, item, customer_type_ids, duration):
+    item_id = app.config["BIKE_TRACKER_ITEMS"][item][0]
+    start_at, end_at = model_services.get_effective_period(
+        booking_data(item_id, *customer_type_ids)
+    )
+    assert start_at == datetime(2021, 4, 5, 10, 30, tzinfo=timezone.utc)
+    assert end_at - start_at == duration
+
+
+def test_get_bikes_in_use_prepares_the_query_once(database):
+    now = datetime.now(timezone.utc)
+    bikes_in_use(["foo"], now)
+    bikes_in_use(["foo"], now)
+    database.session.rollback()
+    assert bikes_in_use(["foo"], now) == set()
+
+    prepared = database.session.execute(
+        "SELECT count(*) FROM pg_prepared_statements WHERE name = 'bikes_in_use'"
+    ).scalar()
+    assert prepared == 1
+
+
 def test_bike_operations_works_for_bookings(database, booking_factory):
     timestamp = datetime.now(timezone.utc)
     b = booking_factory.run()
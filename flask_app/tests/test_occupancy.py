@@ -0,0 +1,126 @@
+import time
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+
+import pytest
+
+from fh_webhook import metrics, model_services, models
+from fh_webhook.occupancy import BikePeriods, bike_occupancy
+
+
+def test_bike_periods_find_the_periods_started_before():
+    periods = BikePeriods()
+    periods.extend([(10, 20, 2), (0, 100, 1), (120, 130, 3)])
+
+    assert periods.starts == [0, 10, 120]
+    assert periods.latest_ends == [100, 100, 130]
+    assert [periods.in_use(at) for at in (-1, 0, 50, 100, 110, 125, 131)] == [
+        False,
+        True,
+        True,
+        True,
+        False,
+        True,
+        False,
+    ]
+
+    periods.discard(1)
+    assert periods.in_use(50) is False
+    assert periods.in_use(15) is True
+
+
+@pytest.fixture
+def now():
+    return datetime.now(timezone.utc)
+
+
+@pytest.fixture
+def booked_availability(database, booking_factory, now):
+    """Return an availability with a booking going on."""
+    s = booking_factory
+    s.effective_start_at = now - timedelta(hours=1)
+    s.effective_end_at = now + timedelta(hours=1)
+    s.rebooked_to = None
+    return s.run().availability
+
+
+@pytest.fixture
+def bikes(database, bike_factory):
+    return [bike_factory(readable_name=f"bike{n}").uuid for n in range(3)]
+
+
+@pytest.fixture
+def reloads():
+    metrics.reset()
+    yield lambda: metrics.get_counters().get("bike_occupancy.reloads", 0)
+    metrics.reset()
+
+
+def add_bikes(availability, bike_uuids, now):
+    return model_services.CreateBikeUsages(
+        instance_id=availability.id, timestamp=now, bike_uuids=bike_uuids
+    ).run()
+
+
+def test_in_use_matches_the_db(booked_availability, bikes, now, reloads):
+    add_bikes(booked_availability, bikes[:2], now)
+
+    in_use = bike_occupancy.in_use(models.db.session, bikes, now)
+    assert in_use == model_services.bikes_in_use(bikes, now) == set(bikes[:2])
+    later = now + timedelta(hours=2)
+    assert bike_occupancy.in_use(models.db.session, bikes, later) == set()
+    assert reloads() == 1
+
+
+def test_in_use_reloads_out_of_the_window(booked_availability, bikes, now, reloads):
+    add_bikes(booked_availability, bikes[:1], now)
+    bike_occupancy.in_use(models.db.session, bikes, now)
+
+    next_week = now + timedelta(days=7)
+    assert bike_occupancy.in_use(models.db.session, bikes, next_week) == set()
+    assert bike_occupancy.window_start == next_week - bike_occupancy.window
+    assert reloads() == 2
+
+
+def test_bike_usages_update_the_index(booked_availability, bikes, now, reloads):
+    assert bike_occupancy.in_use(models.db.session, bikes, now) == set()
+
+    add_bikes(booked_availability, bikes[:2], now)
+    assert bike_occupancy.in_use(models.db.session, bikes, now) == set(bikes[:2])
+
+    model_services.UpdateBikeUsage(
+        instance_id=booked_availability.id,
+        timestamp=now,
+        bike_returned_uuid=bikes[0],
+        bike_picked_uuid=bikes[2],
+    ).run()
+    assert bike_occupancy.in_use(models.db.session, bikes, now) == set(bikes[1:])
+    assert reloads() == 1
+
+
+def test_index_is_reconciled_after_the_ttl(booked_availability, bikes, now):
+    add_bikes(booked_availability, bikes[:1], now)
+    bike_occupancy.in_use(models.db.session, bikes, now)
+
+    # Cancelled by FH, the index doesn't know until it's reloaded.
+    booked_availability.bookings[0].status = "cancelled"
+    models.db.session.commit()
+    assert bike_occupancy.in_use(models.db.session, bikes, now) == set(bikes[:1])
+
+    expired = time.monotonic() + bike_occupancy.ttl
+    with patch("fh_webhook.occupancy.time.monotonic", return_value=expired):
+        assert bike_occupancy.in_use(models.db.session, bikes, now) == set()
+
+
+@pytest.mark.parametrize("ttl", [60, 0])
+def test_conflicting_bikes_are_reported(booked_availability, bikes, now, ttl):
+    add_bikes(booked_availability, bikes[:1], now)
+    bike_occupancy.configure(ttl, bike_occupancy.window)
+
+    with patch("fh_webhook.model_services.bikes_in_use", return_value=set()) as sql:
+        with patch("fh_webhook.model_services.current_app") as app:
+            model_services.BikeOperations._check_conflicting_bikes({bikes[0]})
+    bike_occupancy.configure(60, bike_occupancy.window)
+
+    assert sql.called is (ttl == 0)
+    assert app.logger.warning.called is (ttl > 0)
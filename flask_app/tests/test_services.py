@@ -1,11 +1,16 @@
+import itertools
 import json
 import os
-from datetime import datetime, timezone
-from unittest.mock import patch
+from datetime import datetime, timedelta, timezone
+from unittest.mock import call, patch
 
-from sqlalchemy.exc import OperationalError
+import pytest
+from flask import current_app
+from sqlalchemy.exc import IntegrityError, OperationalError
 
-from fh_webhook import models, services
+from fh_webhook import archive, metrics, models, services
+from fh_webhook.cache import reference_cache
+from fh_webhook.exceptions import DoesNotExist, ReplayWorkerDied
 
 
 def test_save_response_as_file(app):
@@ -28,6 +33,17 @@ def test_save_response_as_file(app):
     [os.remove(os.path.join(path, f)) for f in os.listdir(path)]
 
 
+def test_save_response_as_file_keeps_the_raw_body(app, tmp_path):
+    raw_body = b'{"foo":  "bar"}\n'
+    timestamp = datetime.now(timezone.utc)
+
+    filename = services.SaveResponseAsFile(
+        {"foo": "bar"}, str(tmp_path), timestamp, raw_body
+    ).run()
+
+    assert (tmp_path / filename).read_bytes() == raw_body
+
+
 def test_get_request_id(app):
     app.config["RESPONSES_PATH"] = "tests/sample_data/sample_booking/"
     assert services.get_request_id_or_none("188.12.json") == 18812
@@ -59,8 +75,254 @@ def test_populate_db_creates_stored_request(database, app, file_timestamp):
     stored_request = models.StoredRequest.get(request_id)
     assert stored_request.filename == "1626842330.051856.json"
     assert stored_request.processed_at is not None
-    assert stored_request.body[:20] == '{"booking": {"vouche'
-    assert stored_request.body[-20:] == 'lay_id": "BBVBQV"}}}'
+    with open("tests/sample_data/sample_booking/1626842330.051856.json") as f:
+        assert stored_request.body == f.read()
+
+
+def test_populate_db_reads_the_journal(database, app, file_timestamp, tmp_path):
+    with open("tests/sample_data/sample_booking/1626842330.051856.json", "rb") as f:
+        body = f.read()
+    journal_path = str(tmp_path / "journal")
+    name = archive.JournalWriter(journal_path).append(
+        body, file_timestamp.timestamp(), 75125154
+    )
+    app.config["RESPONSES_PATH"] = str(tmp_path)
+    app.config["JOURNAL_PATH"] = journal_path
+    try:
+        services.PopulateDB(app).run()
+        service = services.PopulateDB(app, resume=False)
+        service.run()
+    finally:
+        app.config["JOURNAL_PATH"] = "tests/journal/"
+
+    assert service.skipped == 1
+    stored_request = models.StoredRequest.get(1626842330051856)
+    assert stored_request.filename == name
+    assert stored_request.processed_at is not None
+    assert stored_request.body == body.decode()
+    assert models.Booking.get(75125154).created_at == file_timestamp
+
+
+def write_booking_snapshots(journal_path, file_timestamp, bookings=4, snapshots=3):
+    """Journal several snapshots of several bookings sharing the availability."""
+    with open("tests/sample_data/sample_booking/1626842330.051856.json") as f:
+        sample = f.read()
+    writer = archive.JournalWriter(journal_path)
+    for n in range(bookings * snapshots):
+        k = n % bookings
+        data = json.loads(sample)
+        b_data = data["booking"]
+        b_data["pk"] += k
+        b_data["uuid"] += f"-{k}"
+        b_data["status"] = "cancelled" if n // bookings % 2 else "booked"
+        b_data["note"] = f"snapshot {n}"
+        b_data["availability"]["item"]["name"] = f"Item {n}"
+        b_data["availability"]["headline"] = f"Headline {n}"
+        for c_data in b_data["customers"]:
+            c_data["pk"] += k
+        for cfv_data in b_data["custom_field_values"]:
+            cfv_data["pk"] += 100 * k
+        writer.append(
+            json.dumps(data).encode(), file_timestamp.timestamp() + n, b_data["pk"]
+        )
+
+
+def dump_tables(database):
+    """
+    Return the content of every table but the columns telling when rows were written.
+
+    Companies get their ids in the order they are inserted, so they are
+    referred to by short name. The replay checkpoints are left out.
+    """
+    company = models.Company
+    short_names = dict(database.session.query(company.id, company.short_name))
+    tables = dict()
+    for table in database.metadata.sorted_tables:
+        if table is models.ReplayCheckpoint.__table__:
+            continue
+        skip = ("updated_at", "processed_at")
+        if table is company.__table__:
+            skip += ("id",)
+        columns = [c for c in table.columns if c.name not in skip]
+        query = database.session.query(*columns).order_by(*columns)
+        tables[table.name] = [
+            tuple(
+                short_names.get(value)
+                if column.name in ("company_id", "affiliate_company_id")
+                else value
+                for column, value in zip(columns, row)
+            )
+            for row in query
+        ]
+    return tables
+
+
+def test_populate_db_in_parallel_matches_the_serial_run(
+    database, app, file_timestamp, tmp_path
+):
+    write_booking_snapshots(str(tmp_path / "journal"), file_timestamp)
+    app.config["RESPONSES_PATH"] = str(tmp_path)
+    app.config["JOURNAL_PATH"] = str(tmp_path / "journal")
+    try:
+        services.PopulateDB(app).run()
+        serial = dump_tables(database)
+
+        database.session.remove()
+        database.drop_all()
+        database.create_all()
+        # The company ids cached by the serial run are gone with the db.
+        reference_cache.clear()
+        service = services.PopulateDB(app, workers=3)
+        service.run()
+        parallel = dump_tables(database)
+        services.PopulateDB(app, workers=3, resume=False).run()
+    finally:
+        app.config["JOURNAL_PATH"] = "tests/journal/"
+
+    assert (service.processed, service.skipped, service.failed) == (12, 0, 0)
+    assert parallel == serial
+    assert models.Item.get(159068).name == "Item 11"
+    assert models.Item.get(159068).created_at == file_timestamp
+    booking = models.Booking.get(75125154)
+    assert (booking.status, booking.note) == ("booked", "snapshot 8")
+    assert booking.created_at == file_timestamp
+    assert models.StoredRequest.query.filter_by(processed_at=None).count() == 0
+
+
+def test_populate_db_in_parallel_skips_requests_without_booking(
+    database, app, file_timestamp, tmp_path
+):
+    writer = archive.JournalWriter(str(tmp_path / "journal"))
+    writer.append(b'{"foo": "bar"}', file_timestamp.timestamp())
+    app.config["RESPONSES_PATH"] = str(tmp_path)
+    app.config["JOURNAL_PATH"] = str(tmp_path / "journal")
+    try:
+        service = services.PopulateDB(app, workers=2)
+        service.run()
+    finally:
+        app.config["JOURNAL_PATH"] = "tests/journal/"
+
+    assert (service.processed, service.skipped) == (0, 1)
+
+
+def test_populate_db_aborts_when_a_worker_dies(database, app, file_timestamp, tmp_path):
+    write_booking_snapshots(str(tmp_path / "journal"), file_timestamp)
+    app.config["RESPONSES_PATH"] = str(tmp_path)
+    app.config["JOURNAL_PATH"] = str(tmp_path / "journal")
+    service = services.PopulateDB(app, workers=2)
+    service.QUEUE_SIZE, service.PROGRESS_INTERVAL = 1, 0.1
+    try:
+        with patch.object(service, "_replay_partition", lambda *args: os._exit(3)):
+            with pytest.raises(ReplayWorkerDied, match="exited with code 3"):
+                service.run()
+    finally:
+        app.config["JOURNAL_PATH"] = "tests/journal/"
+
+    assert models.ReplayCheckpoint.query.count() == 0
+
+
+def test_populate_db_compacted_matches_the_serial_run(
+    database, app, file_timestamp, tmp_path
+):
+    write_booking_snapshots(str(tmp_path / "journal"), file_timestamp)
+    app.config["RESPONSES_PATH"] = str(tmp_path)
+    app.config["JOURNAL_PATH"] = str(tmp_path / "journal")
+    try:
+        services.PopulateDB(app).run()
+        serial = dump_tables(database)
+
+        database.session.remove()
+        database.drop_all()
+        database.create_all()
+        reference_cache.clear()
+        service = services.PopulateDB(app, compact=True, audit=True)
+        with patch("fh_webhook.services.ProcessJSONResponse.run") as mock_service:
+            service.run()
+    finally:
+        app.config["JOURNAL_PATH"] = "tests/journal/"
+
+    assert mock_service.call_count == 0
+    assert (service.processed, service.compacted) == (4, 8)
+    assert dump_tables(database) == serial
+    assert models.StoredRequest.query.filter_by(processed_at=None).count() == 0
+
+
+def test_populate_db_compacted_in_parallel(database, app, file_timestamp, tmp_path):
+    write_booking_snapshots(str(tmp_path / "journal"), file_timestamp)
+    app.config["RESPONSES_PATH"] = str(tmp_path)
+    app.config["JOURNAL_PATH"] = str(tmp_path / "journal")
+    try:
+        service = services.PopulateDB(app, workers=2, compact=True)
+        service.run()
+    finally:
+        app.config["JOURNAL_PATH"] = "tests/journal/"
+
+    assert (service.processed, service.compacted, service.failed) == (4, 8, 0)
+    assert len(models.StoredRequest.query.all()) == 4
+    assert models.Item.get(159068).name == "Item 11"
+    booking = models.Booking.get(75125154)
+    assert (booking.note, booking.created_at) == ("snapshot 8", file_timestamp)
+    checkpoint = models.ReplayCheckpoint.get(service.archive_name)
+    assert checkpoint.archived_at == file_timestamp.timestamp() + 11
+
+
+@patch("fh_webhook.models.StoredRequest.get_object_or_none")
+def test_populate_db_loads_the_stored_ids_at_once(
+    mock_get, database, app, file_timestamp, tmp_path
+):
+    write_booking_snapshots(str(tmp_path / "journal"), file_timestamp, 2, 1)
+    app.config["RESPONSES_PATH"] = str(tmp_path)
+    app.config["JOURNAL_PATH"] = str(tmp_path / "journal")
+    try:
+        services.PopulateDB(app).run()
+        service = services.PopulateDB(app, resume=False)
+        service.run()
+    finally:
+        app.config["JOURNAL_PATH"] = "tests/journal/"
+
+    assert (service.processed, service.skipped) == (0, 2)
+    assert mock_get.call_count == 0
+
+
+@patch("fh_webhook.services.ProcessJSONResponse.run")
+def test_populate_db_resumes_from_the_checkpoint(
+    mock_service, database, app, file_timestamp, tmp_path
+):
+    write_booking_snapshots(str(tmp_path / "journal"), file_timestamp, 4, 1)
+    app.config["RESPONSES_PATH"] = str(tmp_path)
+    app.config["JOURNAL_PATH"] = str(tmp_path / "journal")
+    mock_service.side_effect = [None, None, RuntimeError("interrupted"), None]
+    try:
+        service = services.PopulateDB(app)
+        with pytest.raises(RuntimeError):
+            service.run()
+        checkpoint = models.ReplayCheckpoint.get(service.archive_name)
+        assert checkpoint.archived_at == file_timestamp.timestamp() + 1
+
+        service = services.PopulateDB(app)
+        service.run()
+    finally:
+        app.config["JOURNAL_PATH"] = "tests/journal/"
+
+    # The interrupted request was stored, it's left to process-requests.
+    assert (service.processed, service.skipped) == (1, 1)
+    assert mock_service.call_count == 4
+    checkpoint = models.ReplayCheckpoint.get(service.archive_name)
+    assert checkpoint.archived_at == file_timestamp.timestamp() + 3
+
+
+def test_save_response_to_journal(tmp_path):
+    json_response = {"booking": {"pk": 1}}
+    timestamp = datetime.now(timezone.utc)
+    writer = archive.JournalWriter(str(tmp_path))
+
+    name = services.SaveResponseToJournal(json_response, writer, timestamp).run()
+
+    record = archive.JournalReader(str(tmp_path)).read_at(name)
+    assert record.load() == json_response
+    assert record.timestamp == timestamp.timestamp()
+    segment = name.split("@")[0]
+    assert next(archive.JournalReader(str(tmp_path)).read_index(segment))[1] == 1
 
 
 def test_populate_db_creates_item(database, app, file_timestamp):
@@ -439,3 +701,387 @@ def test_save_request_to_db_raises_error_for_close_stored_request(
     assert close_mock.call_count == 1
 
     assert s is None
+
+
+def stored_request_instance(data, timestamp):
+    """Store a request as the webhook does in async mode."""
+    return services.SaveRequestToDB(
+        data, timestamp, f"{timestamp.timestamp()}.json", process=False
+    ).run()
+
+
+def test_save_request_to_db_without_processing(database, file_timestamp):
+    with open("tests/sample_data/sample_booking/1626842330.051856.json") as f:
+        data = json.load(f)
+
+    with patch("fh_webhook.services.ProcessJSONResponse.run") as json_mock:
+        stored_request = stored_request_instance(data, file_timestamp)
+
+    assert json_mock.call_count == 0
+    assert stored_request.processed_at is None
+    assert services.queue_depth() == 1
+
+
+def test_process_stored_requests_in_order(database, app, file_timestamp):
+    with open("tests/sample_data/sample_booking/1626842330.051856.json") as f:
+        data = json.load(f)
+    data["booking"]["status"] = "cancelled"
+    stored_request_instance(data, file_timestamp + timedelta(seconds=1))
+    data["booking"]["status"] = "booked"
+    stored_request_instance(data, file_timestamp)
+
+    worker = services.ProcessStoredRequests(app)
+    worker.run(once=True)
+
+    assert worker.processed == 2
+    assert services.queue_depth() == 0
+    assert models.Booking.get(75125154).status == "cancelled"
+    for stored_request in models.StoredRequest.query.all():
+        assert stored_request.processed_at is not None
+
+
+def test_process_stored_requests_skips_failures(database, app, file_timestamp):
+    with open("tests/sample_data/sample_booking/1626842330.051856.json") as f:
+        data = json.load(f)
+    stored_request_instance({"booking": {}}, file_timestamp)
+    stored_request_instance(data, file_timestamp + timedelta(seconds=1))
+
+    worker = services.ProcessStoredRequests(app)
+    worker.run(once=True)
+
+    assert worker.processed == 1
+    assert worker.failed == 1
+    assert services.queue_depth() == 1
+    assert models.Booking.get(75125154)
+
+
+def test_process_stored_requests_backs_off_failures(database, app, file_timestamp):
+    stored_request_instance({"booking": {}}, file_timestamp)
+    sr = models.StoredRequest
+
+    services.ProcessStoredRequests(app).run(once=True)
+    failed = sr.query.one()
+    assert (failed.failures, failed.processed_at) == (1, None)
+    assert failed.last_error
+    backoff = failed.retry_at - datetime.now(timezone.utc)
+    assert timedelta(seconds=50) < backoff <= timedelta(seconds=60)
+
+    worker = services.ProcessStoredRequests(app)
+    worker.run(once=True)
+    assert worker.failed == 0
+
+    worker = services.ProcessStoredRequests(app, ignore_backoff=True)
+    worker.run(once=True)
+    models.db.session.expire_all()
+    assert worker.failed == 1
+    failed = sr.query.one()
+    backoff = failed.retry_at - datetime.now(timezone.utc)
+    assert (failed.failures, backoff > timedelta(seconds=110)) == (2, True)
+
+
+def test_process_stored_requests_picks_up_the_requests_stored_late(
+    database, app, file_timestamp
+):
+    with open("tests/sample_data/sample_booking/1626842330.051856.json") as f:
+        data = json.load(f)
+    stored_request_instance(data, file_timestamp + timedelta(seconds=1))
+    worker = services.ProcessStoredRequests(app)
+    worker.drain()
+
+    # Received before the one processed but committed after it.
+    data["booking"]["pk"] += 1
+    data["booking"]["uuid"] += "-1"
+    stored_request_instance(data, file_timestamp)
+    assert worker.drain() == 1
+    assert worker.processed == 2
+    assert services.queue_depth() == 0
+
+
+def test_process_stored_requests_retries_the_failures_once_due(
+    database, app, file_timestamp
+):
+    with open("tests/sample_data/sample_booking/1626842330.051856.json") as f:
+        data = json.load(f)
+    stored_request_instance(data, file_timestamp)
+    worker = services.ProcessStoredRequests(app)
+    with patch(
+        "fh_webhook.services.ProcessJSONResponse.run",
+        side_effect=OperationalError("SELECT 1", None, None),
+    ):
+        worker.drain()
+    assert worker.drain() == 0
+
+    sr = models.StoredRequest
+    sr.query.update({"retry_at": datetime.now(timezone.utc)})
+    models.db.session.commit()
+    assert worker.drain() == 1
+    assert (worker.processed, worker.failed) == (1, 1)
+    assert services.queue_depth() == 0
+
+
+def test_process_stored_requests_closes_the_superseded_retries(
+    database, app, file_timestamp
+):
+    with open("tests/sample_data/sample_booking/1626842330.051856.json") as f:
+        data = json.load(f)
+    failed = stored_request_instance(data, file_timestamp)
+    data["booking"]["status"] = "cancelled"
+    stored_request_instance(data, file_timestamp + timedelta(seconds=1))
+    sr = models.StoredRequest
+    retry_at = datetime.now(timezone.utc) + timedelta(minutes=1)
+    sr.query.filter_by(id=failed.id).update({"failures": 1, "retry_at": retry_at})
+    models.db.session.commit()
+    worker = services.ProcessStoredRequests(app)
+    worker.drain()
+    assert models.Booking.get(75125154).status == "cancelled"
+
+    metrics.reset()
+    sr.query.filter_by(id=failed.id).update({"retry_at": None})
+    models.db.session.commit()
+    with patch("fh_webhook.services.ProcessJSONResponse.run") as json_mock:
+        assert worker.drain() == 1
+
+    assert json_mock.call_count == 0
+    assert metrics.get_counters()["superseded_skipped"] == 1
+    assert sr.query.get(failed.id).processed_at is not None
+    assert models.Booking.get(75125154).status == "cancelled"
+
+
+def test_process_stored_requests_leaves_the_newest(database, app):
+    with open("tests/sample_data/sample_booking/1626842330.051856.json") as f:
+        data = json.load(f)
+    stored_request_instance(data, datetime.now(timezone.utc))
+
+    worker = services.ProcessStoredRequests(app, min_age=60)
+    worker.run(once=True)
+
+    assert worker.processed == 0
+    assert services.queue_depth() == 1
+
+
+def test_save_request_to_db_records_the_failures(database, file_timestamp):
+    with open("tests/sample_data/sample_booking/1626842330.051856.json") as f:
+        data = json.load(f)
+
+    with patch(
+        "fh_webhook.services.ProcessJSONResponse.run",
+        side_effect=OperationalError("SELECT 1", None, None),
+    ):
+        assert services.SaveRequestToDB(data, file_timestamp, "0.json").run() is None
+
+    stored_request = models.StoredRequest.query.one()
+    assert (stored_request.failures, stored_request.processed_at) == (1, None)
+
+
+@pytest.mark.parametrize(
+    "error",
+    [IntegrityError("INSERT", None, None), DoesNotExist("booking"), KeyError("pk")],
+)
+def test_save_request_to_db_records_any_failure(database, file_timestamp, error):
+    with open("tests/sample_data/sample_booking/1626842330.051856.json") as f:
+        data = json.load(f)
+
+    with patch("fh_webhook.services.ProcessJSONResponse.run", side_effect=error):
+        assert services.SaveRequestToDB(data, file_timestamp, "0.json").run() is None
+
+    stored_request = models.StoredRequest.query.one()
+    assert (stored_request.failures, stored_request.processed_at) == (1, None)
+    assert stored_request.last_error == str(error)
+
+
+@pytest.fixture
+def archive_with_missing_requests(database, app, file_timestamp, tmp_path):
+    """Archive 4 snapshots of a booking, the second one is the newest stored."""
+    journal_path = str(tmp_path / "journal")
+    write_booking_snapshots(journal_path, file_timestamp, 1, 4)
+    archive.JournalWriter(journal_path).append(b"{", file_timestamp.timestamp() + 5)
+    second = next(itertools.islice(archive.JournalReader(journal_path), 1, None))
+    stored_request_instance(second.load(), file_timestamp + timedelta(seconds=1))
+    app.config["RESPONSES_PATH"] = str(tmp_path)
+    app.config["JOURNAL_PATH"] = journal_path
+    yield
+    app.config["RESPONSES_PATH"] = "tests/responses/"
+    app.config["JOURNAL_PATH"] = "tests/journal/"
+
+
+def test_process_stored_requests_catches_up(app, archive_with_missing_requests):
+    worker = services.ProcessStoredRequests(app)
+    with patch.object(worker, "CATCH_UP_MARGIN", 0):
+        worker.run(once=True, catch_up=True)
+
+    assert (worker.recovered, worker.processed, worker.failed) == (2, 3, 0)
+    assert models.StoredRequest.query.count() == 3
+    assert models.Booking.get(75125154).note == "snapshot 3"
+
+
+def test_reprocess_requests_command(app, runner, archive_with_missing_requests):
+    result = runner.invoke(args=["reprocess-requests", "--no-catch-up"])
+    assert result.output == "0 requests caught up, 1 processed, 0 failed.\n"
+
+    result = runner.invoke(args=["reprocess-requests"])
+    assert result.output == "3 requests caught up, 3 processed, 0 failed.\n"
+    assert services.queue_depth() == 0
+
+
+def test_get_content_hash_ignores_key_order_and_volatile_keys():
+    response = {"booking": {"pk": 1, "availability": {"pk": 2, "capacity": 10}}}
+    reordered = {"booking": {"availability": {"capacity": 3, "pk": 2}, "pk": 1}}
+    changed = {"booking": {"pk": 1, "availability": {"pk": 3, "capacity": 10}}}
+
+    assert services.get_content_hash(response) == services.get_content_hash(reordered)
+    assert services.get_content_hash(response) != services.get_content_hash(changed)
+
+
+def test_get_content_hash_only_ignores_the_availability_capacity():
+    response = {
+        "booking": {
+            "availability": {"capacity": 10, "customer_type_rates": [{"capacity": 4}]}
+        }
+    }
+    changed = json.loads(json.dumps(response))
+    changed["booking"]["availability"]["customer_type_rates"][0]["capacity"] = 2
+
+    assert services.get_content_hash(response) != services.get_content_hash(changed)
+
+
+def test_save_request_to_db_processes_nested_capacity_changes(database, file_timestamp):
+    with open("tests/sample_data/sample_booking/1626842330.051856.json") as f:
+        data = json.load(f)
+    changed = json.loads(json.dumps(data))
+    ctr_data = changed["booking"]["availability"]["customer_type_rates"][0]
+    ctr_data["capacity"] = (ctr_data["capacity"] or 0) + 1
+
+    with patch("fh_webhook.services.ProcessJSONResponse.run") as json_mock:
+        for n, response in enumerate((data, changed)):
+            timestamp = file_timestamp + timedelta(seconds=n)
+            services.SaveRequestToDB(response, timestamp, f"{n}.json").run()
+
+    assert json_mock.call_count == 2
+
+
+@patch("fh_webhook.metrics.increment")
+def test_save_request_to_db_skips_redeliveries(metrics_mock, database, file_timestamp):
+    with open("tests/sample_data/sample_booking/1626842330.051856.json") as f:
+        data = json.load(f)
+    services.SaveRequestToDB(data, file_timestamp, "0.json").run()
+
+    later = file_timestamp + timedelta(seconds=1)
+    with patch("fh_webhook.services.ProcessJSONResponse.run") as json_mock:
+        stored_request = services.SaveRequestToDB(data, later, "1.json").run()
+
+    assert json_mock.call_count == 0
+    assert stored_request.processed_at is not None
+    assert stored_request.booking_id == 75125154
+    assert metrics_mock.call_args_list.count(call("redeliveries_skipped")) == 1
+    assert models.Booking.get(75125154).updated_at == file_timestamp
+
+
+def test_save_request_to_db_processes_reverted_states(database, file_timestamp):
+    with open("tests/sample_data/sample_booking/1626842330.051856.json") as f:
+        data = json.load(f)
+    cancelled = json.loads(json.dumps(data))
+    cancelled["booking"]["status"] = "cancelled"
+
+    with patch("fh_webhook.services.ProcessJSONResponse.run") as json_mock:
+        for n, response in enumerate((data, cancelled, data)):
+            timestamp = file_timestamp + timedelta(seconds=n)
+            services.SaveRequestToDB(response, timestamp, f"{n}.json").run()
+
+    assert json_mock.call_count == 3
+
+
+def test_save_request_to_db_deduplication_can_be_disabled(database, file_timestamp):
+    with open("tests/sample_data/sample_booking/1626842330.051856.json") as f:
+        data = json.load(f)
+
+    current_app.config["DEDUPLICATE_REDELIVERIES"] = False
+    try:
+        with patch("fh_webhook.services.ProcessJSONResponse.run") as json_mock:
+            for n in range(2):
+                timestamp = file_timestamp + timedelta(seconds=n)
+                services.SaveRequestToDB(data, timestamp, f"{n}.json").run()
+    finally:
+        current_app.config["DEDUPLICATE_REDELIVERIES"] = True
+
+    assert json_mock.call_count == 2
+
+
+def test_process_stored_requests_skips_redeliveries(database, app, file_timestamp):
+    with open("tests/sample_data/sample_booking/1626842330.051856.json") as f:
+        data = json.load(f)
+    for n in range(3):
+        stored_request_instance(data, file_timestamp + timedelta(seconds=n))
+
+    worker = services.ProcessStoredRequests(app)
+    with patch("fh_webhook.services.skip_redelivery") as skip_mock:
+        worker.run(once=True)
+
+    assert worker.processed == 3
+    assert skip_mock.call_count == 2
+    assert services.queue_depth() == 0
+
+
+def test_get_archive_entry_takes_whatever_it_can():
+    entry = services.get_archive_entry("1.json", 1.0, {"booking": {"pk": "1"}})
+    assert entry["booking_id"] is None
+    assert services.get_archive_entry("2.json", 2.0, None)["booking_uuid"] is None
+    entry = services.get_archive_entry(
+        "3.json", 3.0, {"booking": {"pk": 3, "availability": {"pk": 4}}}
+    )
+    assert (entry["booking_id"], entry["availability_id"]) == (3, 4)
+
+
+def test_index_archive_and_get_history(database, app, file_timestamp, tmp_path):
+    write_booking_snapshots(str(tmp_path / "journal"), file_timestamp, 2, 2)
+    (tmp_path / "1.0.json").write_bytes(b"not json")
+    app.config["RESPONSES_PATH"] = str(tmp_path)
+    app.config["JOURNAL_PATH"] = str(tmp_path / "journal")
+    try:
+        assert services.IndexArchive(app).run() == 5
+        assert services.IndexArchive(app).run() == 5
+        history = services.get_history(app, booking_id=75125155)
+        by_uuid = services.get_history(
+            app, booking_uuid="c6c1c394-3c31-4e30-bf9d-da3e1dde7d6e-1"
+        )
+        by_availability = services.get_history(app, availability_id=619118440)
+    finally:
+        app.config["JOURNAL_PATH"] = "tests/journal/"
+
+    assert len(models.ArchiveEntry.query.all()) == 5
+    assert [h["request"]["booking"]["note"] for h in history] == [
+        "snapshot 1",
+        "snapshot 3",
+    ]
+    assert history[0]["archived_at"] == "2021-07-21T04:38:51.051856+00:00"
+    assert by_uuid == history
+    assert len(by_availability) == 4
+
+
+def test_index_archived_request_logs_the_errors(database):
+    timestamp = datetime.now(timezone.utc)
+    with patch("fh_webhook.services.save_archive_entries") as save, patch(
+        "fh_webhook.services.logger"
+    ) as logger:
+        save.side_effect = OperationalError("INSERT", {}, "db is down")
+        services.IndexArchivedRequest({}, "1.json", timestamp).run()
+    assert logger.error.call_args[0][0].startswith("Unable to index 1.json")
+
+
+def test_history_commands(database, app, runner, file_timestamp, tmp_path):
+    write_booking_snapshots(str(tmp_path / "journal"), file_timestamp, 2, 1)
+    app.config["RESPONSES_PATH"] = str(tmp_path)
+    app.config["JOURNAL_PATH"] = str(tmp_path / "journal")
+    try:
+        indexed = runner.invoke(args=["index-archive"])
+        by_pk = runner.invoke(args=["booking-history", "75125155"])
+        by_availability = runner.invoke(
+            args=["booking-history", "--availability", "619118440"]
+        )
+    finally:
+        app.config["RESPONSES_PATH"] = "tests/responses/"
+        app.config["JOURNAL_PATH"] = "tests/journal/"
+
+    assert indexed.output == "2 requests indexed.\n"
+    lines = [json.loads(line) for line in by_pk.output.splitlines()]
+    assert [line["request"]["booking"]["pk"] for line in lines] == [75125155]
+    assert len(by_availability.output.splitlines()) == 2
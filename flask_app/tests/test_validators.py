@@ -0,0 +1,188 @@
+import json
+import os
+from unittest.mock import patch
+
+import pytest
+from flask import current_app
+from marshmallow import ValidationError
+
+from fh_webhook import archive, validators
+from fh_webhook.schema import BookingSchema
+
+SAMPLES_PATH = "tests/sample_data/sample_booking/"
+REPLACEMENTS = (None, "1", 1, 1.5, True, {})
+
+
+def sample_bookings():
+    for f in sorted(os.listdir(SAMPLES_PATH)):
+        with open(os.path.join(SAMPLES_PATH, f)) as response:
+            yield json.load(response)["booking"]
+
+
+def paths(data, path=()):
+    """
+    Yield the path to every value in a JSON document.
+
+    Only the first item of the lists is visited, the rest share its schema.
+    """
+    if isinstance(data, dict):
+        items = data.items()
+    elif isinstance(data, list):
+        items = enumerate(data[:1])
+    else:
+        return
+    for key, value in items:
+        yield path + (key,)
+        yield from paths(value, path + (key,))
+
+
+def mutations(booking):
+    """
+    Replace or remove one value at a time and add unknown fields.
+
+    The booking is changed in place and restored after each yield, as copying
+    it for each one of the mutations is slow.
+    """
+    for path in list(paths(booking)):
+        parent = booking
+        for key in path[:-1]:
+            parent = parent[key]
+        key = path[-1]
+        original = parent[key]
+        for replacement in REPLACEMENTS:
+            parent[key] = replacement
+            yield booking
+        parent[key] = original
+        if isinstance(parent, dict):
+            del parent[key]
+            yield booking
+            parent[key] = original
+        if isinstance(original, dict):
+            original["unknown_field"] = 1
+            yield booking
+            del original["unknown_field"]
+
+
+def outcome(validate, data):
+    try:
+        validate(data)
+    except ValidationError as e:
+        return e.messages
+    return None
+
+
+@pytest.mark.parametrize("booking", sample_bookings())
+def test_compiled_schema_matches_marshmallow(booking):
+    compiled = validators.CompiledSchema(BookingSchema)
+    assert outcome(compiled.validate, booking) is None
+
+    n = 0
+    for n, mutated in enumerate(mutations(booking), 1):
+        expected = outcome(BookingSchema().load, mutated)
+        assert outcome(compiled.validate, mutated) == expected
+    assert n > 1000
+
+
+def test_compiled_schema_rejects_what_marshmallow_coerces():
+    booking = next(sample_bookings())
+    booking["customer_count"] = "2"
+    booking["is_eligible_for_cancellation"] = "true"
+    assert validators.compiled_booking_schema.check(booking) is False
+    assert validators.compiled_booking_schema.validate(booking) is None
+
+
+def test_validate_booking_engines(app):
+    booking = next(sample_bookings())
+    del booking["display_id"]
+    for engine in ("marshmallow", "compiled"):
+        current_app.config["SCHEMA_VALIDATOR"] = engine
+        with pytest.raises(ValidationError) as e:
+            validators.validate_booking(booking)
+        assert e.value.messages == {"display_id": ["Missing data for required field."]}
+    current_app.config["SCHEMA_VALIDATOR"] = "compiled"
+
+
+def test_flatten_errors():
+    messages = {"customers": {0: {"pk": ["Not a valid integer."]}, 2: {"pk": ["x"]}}}
+    assert list(validators.flatten_errors(messages, ("booking",))) == [
+        ("booking.customers.*.pk", "Not a valid integer."),
+        ("booking.customers.*.pk", "x"),
+    ]
+
+
+def test_validate_body():
+    booking = next(sample_bookings())
+    assert validators.validate_body(json.dumps({"booking": booking})) == []
+    assert validators.validate_body(b"{")[0][1].startswith("Not a valid JSON")
+    assert validators.validate_body(b"{}") == [
+        ("booking", "Missing data for required field.")
+    ]
+    booking["customer_count"] = "many"
+    assert validators.validate_body(json.dumps({"booking": booking})) == [
+        ("booking.customer_count", "Not a valid integer.")
+    ]
+
+
+@pytest.fixture
+def archive_with_errors(app, tmp_path):
+    writer = archive.JournalWriter(str(tmp_path / "journal"))
+    booking = next(sample_bookings())
+    pk, names = booking["customers"][0]["pk"], list()
+    for n in range(5):
+        booking["customers"][0]["pk"] = "pk" if n % 2 else pk
+        body = json.dumps({"booking": booking}).encode()
+        names.append(writer.append(body, 1000.0 + n))
+    writer.append(b"{}", 2000.0)
+    app.config["RESPONSES_PATH"] = str(tmp_path)
+    app.config["JOURNAL_PATH"] = writer.path
+    yield names
+    app.config["RESPONSES_PATH"] = "tests/responses/"
+    app.config["JOURNAL_PATH"] = "tests/journal/"
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_validate_archive_reports_every_error(app, archive_with_errors, workers):
+    report = validators.ValidateArchive(app, workers, samples=2).run().as_dict()
+
+    assert (report["total"], report["invalid"]) == (6, 3)
+    customer_error, booking_error = report["errors"]
+    assert customer_error == {
+        "path": "booking.customers.*.pk",
+        "message": "Not a valid integer.",
+        "count": 2,
+        "first_seen": "1970-01-01T00:16:41+00:00",
+        "last_seen": "1970-01-01T00:16:43+00:00",
+        "samples": [archive_with_errors[1], archive_with_errors[3]],
+    }
+    assert booking_error["path"] == "booking"
+
+
+def test_validate_archive_reads_a_window_ahead(app, archive_with_errors):
+    read, seen = list(), list()
+    get_archive, add = archive.get_archive, validators.ValidationReport.add
+
+    def reading(app):
+        for record in get_archive(app):
+            read.append(record.name)
+            yield record
+
+    def adding(report, *args):
+        seen.append(len(read))
+        add(report, *args)
+
+    service = validators.ValidateArchive(app, workers=2)
+    service.CHUNK_SIZE, service.WINDOW_CHUNKS = 1, 1
+    with patch("fh_webhook.validators.archive.get_archive", reading):
+        with patch.object(validators.ValidationReport, "add", adding):
+            report = service.run()
+
+    assert report.total == 6
+    assert seen == [2, 2, 4, 4, 6, 6]
+
+
+def test_validate_archive_command(app, archive_with_errors, runner):
+    result = runner.invoke(args=["validate-archive", "--workers", "2", "--as-json"])
+    assert json.loads(result.output)["invalid"] == 3
+
+    result = runner.invoke(args=["validate-archive", "--workers", "1"])
+    assert result.output.splitlines()[0] == "3 of 6 requests are invalid."